@@ -0,0 +1,489 @@
+# -*- coding: utf-8 -*-
+"""
+    Annotation Store
+
+    Compact per-document storage for custom token annotations (MENTION, LA,
+    tense, TIME, ...). Instead of one doc.user_data entry per token and
+    attribute, each attribute is stored in a single integer-coded column with
+    one value per token. String values are coded by their ID in the
+    vocabulary's StringStore and 0 stands for no value (False).
+
+    Annotators write to the columns in bulk over token slices. The custom
+    attributes registered with register_extension() remain available as
+    token._.X, which is a view on the store.
+
+    The columns are kept in doc.user_data as a plain dictionary of arrays, so
+    documents can still be serialized with Doc.to_bytes(), pickle or
+    DocBin(store_user_data=True). The AnnotationStore returned by get_store()
+    is a view on this dictionary. get_store() also realigns the columns with
+    the tokens after a document has been retokenized; the token._.X getters
+    do not, so code that retokenizes a document outside of the annotators
+    must call get_store() before reading the annotations again.
+
+    Attributes registered with register_bitset() (e.g. the LA labels of the
+    lexicons) also have a bitset column (e.g. LA_SET), with one bit per label,
+    so a token can carry the labels of several lexicons. The string column
+    keeps the last label written. A label written by a rule replaces all the
+    labels of a token, in both columns. Rule predicates on these attributes
+    are compiled to bitmask tests (see get_bitset_predicate()).
+"""
+
+import numpy as np
+
+from functools import partial
+from spacy.symbols import LENGTH, SPACY
+from spacy.tokens import Token
+
+# Key of the annotation store in doc.user_data
+STORE_KEY = 'annotation_store'
+# Suffix of the bitset column of an attribute
+BITSET_SUFFIX = '_SET'
+# Maximum number of labels of a bitset attribute
+MAX_LABELS = 64
+# Labels of each bitset attribute, by bit
+BITSET_LABELS = {}
+
+
+def get_token_starts(doc):
+    """
+    Get the character offset of each token in a document.
+
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+
+    Return:
+        - starts: numpy array; the character offset of each token.
+    """
+    if len(doc) == 0:
+        return np.zeros(0, dtype='int64')
+    lengths = doc.to_array([LENGTH, SPACY]).astype('int64').sum(axis=1)
+    starts = np.zeros(len(doc), dtype='int64')
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return starts
+
+
+class AnnotationStore(object):
+    """
+    Annotation Store
+
+    Holds one integer-coded column per custom token attribute for a document.
+    """
+
+    def __init__(self, doc, data=None):
+        """
+        Create a new AnnotationStore instance.
+
+        Arguments:
+            - doc: spaCy Doc; the document the annotations belong to.
+            - data: dict; the serializable data of the store in
+                    doc.user_data, or None for a new store.
+        """
+        if data is None:
+            data = {'length': len(doc),
+                    'starts': get_token_starts(doc),
+                    'columns': {},
+                    'strings': [],
+                    'labels': BITSET_LABELS}
+        self.data = data
+        self.strings = doc.vocab.strings
+        self.columns = data['columns']
+        self.values = data['strings']
+
+    @property
+    def length(self):
+        return self.data['length']
+
+    def restore(self):
+        """
+        Restore the data of a store that was deserialized, e.g. with
+        Doc.from_bytes(): the values are added to the vocabulary and the bits
+        of the bitset columns are mapped to the labels of this process.
+        """
+        for value in self.values:
+            self.strings.add(value)
+        for attr in self.data['labels']:
+            column = self.columns.get(attr + BITSET_SUFFIX, None)
+            if column is None:
+                continue
+            bits = np.zeros(self.length, dtype='uint64')
+            for (bit, label) in enumerate(self.data['labels'][attr]):
+                bits[(column >> np.uint64(bit)) & np.uint64(1) == 1] |= np.uint64(get_label_mask(attr, [label]))
+            self.columns[attr + BITSET_SUFFIX] = bits
+        self.data['labels'] = BITSET_LABELS
+
+    def sync(self, doc):
+        """
+        Realign the columns with the tokens of the document after it has been
+        retokenized. As for spaCy's own token extension data, a merged token
+        keeps the values of its first token and tokens created by a split have
+        no value.
+
+        Arguments:
+            - doc: spaCy Doc; the document the annotations belong to.
+        """
+        if len(doc) == self.length:
+            return
+        starts = get_token_starts(doc)
+        old_starts = self.data['starts']
+        positions = np.searchsorted(old_starts, starts)
+        positions[positions >= self.length] = 0
+        aligned = old_starts[positions] == starts if self.length > 0 else np.zeros(len(doc), dtype='bool')
+        for attr in self.columns:
+            column = np.zeros(len(doc), dtype='uint64')
+            if self.length > 0:
+                column[aligned] = self.columns[attr][positions[aligned]]
+            self.columns[attr] = column
+        self.data['length'] = len(doc)
+        self.data['starts'] = starts
+
+    def encode(self, value):
+        """
+        Get the integer code of an annotation value.
+
+        Arguments:
+            - value: str or bool; the annotation value (False for no value).
+
+        Return:
+            - code: int; the integer code of the value.
+        """
+        if value is False or value is None:
+            return 0
+        if not isinstance(value, str):
+            raise ValueError('-- Error: annotation values must be strings: ' + str(value))
+        # the values are kept with the columns for the vocabulary of the
+        # process a serialized document is read in
+        if value not in self.values:
+            self.values.append(value)
+        return self.strings.add(value)
+
+    def decode(self, code):
+        """
+        Get the annotation value for an integer code.
+
+        Arguments:
+            - code: int; the integer code of the value.
+
+        Return:
+            - value: str or bool; the annotation value (False for no value).
+        """
+        if code == 0:
+            return False
+        return self.strings[int(code)]
+
+    def column(self, attr):
+        """
+        Get the column of an attribute, creating it if needed.
+
+        Arguments:
+            - attr: str; the name of the custom attribute.
+
+        Return:
+            - column: numpy array; the integer codes of the attribute values.
+        """
+        column = self.columns.get(attr, None)
+        if column is None:
+            column = np.zeros(self.length, dtype='uint64')
+            self.columns[attr] = column
+        return column
+
+    def get(self, attr, i):
+        """
+        Get the value of an attribute for a token.
+
+        Arguments:
+            - attr: str; the name of the custom attribute.
+            - i: int; the token index.
+
+        Return:
+            - value: str or bool; the annotation value (False for no value).
+        """
+        column = self.columns.get(attr, None)
+        if column is None:
+            return False
+        return self.decode(column[i])
+
+    def set(self, attr, start, end, value):
+        """
+        Set the value of an attribute for a slice of tokens.
+
+        Arguments:
+            - attr: str; the name of the custom attribute.
+            - start: int; the index of the first token.
+            - end: int; the index after the last token.
+            - value: str or bool; the annotation value (False for no value).
+        """
+        self.column(attr)[start:end] = self.encode(value)
+        if attr in BITSET_LABELS:
+            self.set_bits(attr, slice(start, end), value)
+
+    def set_bits(self, attr, indices, value):
+        """
+        Set the bitset column of an attribute to a single label for a set of
+        tokens, or remove all labels. As in the string column, the label
+        replaces the earlier labels of the tokens: only the lexicons add
+        labels to the ones already set (see
+        lexical_annotator.add_lexical_annotations()).
+
+        Arguments:
+            - attr: str; the name of the custom attribute.
+            - indices: array-like; the token indices (or a slice).
+            - value: str or bool; the label (False to remove all labels).
+        """
+        bits = self.column(attr + BITSET_SUFFIX)
+        if value is False or value is None:
+            bits[indices] = 0
+        else:
+            bits[indices] = np.uint64(get_label_mask(attr, [value]))
+
+    def set_codes(self, attr, indices, codes):
+        """
+        Set already encoded values of an attribute for a set of tokens.
+
+        Arguments:
+            - attr: str; the name of the custom attribute.
+            - indices: array-like; the token indices (or a slice).
+            - codes: int or array-like; the integer codes of the values.
+        """
+        self.column(attr)[indices] = codes
+        if attr in BITSET_LABELS:
+            if np.ndim(codes) == 0:
+                self.set_bits(attr, indices, self.decode(codes))
+            else:
+                indices = np.arange(self.length)[indices]
+                codes = np.asarray(codes)
+                for code in np.unique(codes).tolist():
+                    self.set_bits(attr, indices[codes == code], self.decode(code))
+
+    def to_dict(self):
+        """
+        Get a serializable copy of the columns, e.g. to store the annotations
+        of a document with DocBin.
+
+        Return:
+            - data: dict; the value of each token (None for no value) by
+                    attribute name.
+        """
+        data = {}
+        for attr in self.columns:
+            if attr.endswith(BITSET_SUFFIX) and attr[:-len(BITSET_SUFFIX)] in BITSET_LABELS:
+                # bits are assigned per process, so labels are stored by name
+                labels = BITSET_LABELS[attr[:-len(BITSET_SUFFIX)]]
+                data[attr] = [None if bits == 0 else '|'.join(get_bit_labels(labels, bits)) for bits in self.columns[attr].tolist()]
+            else:
+                data[attr] = [None if code == 0 else self.strings[int(code)] for code in self.columns[attr].tolist()]
+        return data
+
+    def from_dict(self, data):
+        """
+        Restore columns from a serialized copy (see to_dict()).
+
+        Arguments:
+            - data: dict; the value of each token (None for no value) by
+                    attribute name.
+        """
+        for attr in data:
+            values = data[attr]
+            if len(values) != self.length:
+                raise ValueError('-- Error: annotation column ' + attr + ' does not match the document length.')
+            if attr.endswith(BITSET_SUFFIX) and attr[:-len(BITSET_SUFFIX)] in BITSET_LABELS:
+                name = attr[:-len(BITSET_SUFFIX)]
+                self.columns[attr] = np.array([0 if value is None else get_label_mask(name, value.split('|')) for value in values], dtype='uint64')
+            else:
+                self.columns[attr] = np.array([self.encode(value) for value in values], dtype='uint64')
+
+
+def get_store(doc):
+    """
+    Get the annotation store of a document, creating it if needed. The
+    columns of an existing store are realigned with the tokens if the
+    document has been retokenized, and restored if it has been deserialized.
+
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+
+    Return:
+        - store: AnnotationStore; the annotation store of the document.
+    """
+    data = doc.user_data.get(STORE_KEY, None)
+    if data is None:
+        store = AnnotationStore(doc)
+        doc.user_data[STORE_KEY] = store.data
+        return store
+    store = AnnotationStore(doc, data)
+    if data['labels'] is not BITSET_LABELS:
+        store.restore()
+    store.sync(doc)
+    return store
+
+
+def get_token_attributes(doc):
+    """
+    Get the names of all custom token attributes that have been set on a
+    document, either in the annotation store or as standard extension data.
+
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+
+    Return:
+        - attrs: list; the sorted attribute names.
+    """
+    attrs = set()
+    for key in doc.user_data:
+        if key == STORE_KEY:
+            attrs.update(doc.user_data[key]['columns'].keys())
+        elif isinstance(key, tuple) and len(key) == 4 and key[2] is not None:
+            attrs.add(key[1])
+    return sorted(attrs)
+
+
+def get_columns(doc):
+    """
+    Get the annotation columns of a document for reading, without realigning
+    them with the tokens (see get_store()).
+
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+
+    Return:
+        - columns: dict; the integer-coded columns by attribute name, or None
+                   if the document has no annotations.
+    """
+    data = doc.user_data.get(STORE_KEY, None)
+    if data is None:
+        return None
+    if data['labels'] is not BITSET_LABELS:
+        return get_store(doc).columns
+    return data['columns']
+
+
+def _get_token_value(attr, token):
+    columns = get_columns(token.doc)
+    if columns is None or attr not in columns:
+        return False
+    code = columns[attr][token.i]
+    if code == 0:
+        return False
+    return token.doc.vocab.strings[int(code)]
+
+
+def _set_token_value(attr, token, value):
+    store = get_store(token.doc)
+    store.set(attr, token.i, token.i + 1, value)
+
+
+def register_extension(attr):
+    """
+    Register a custom token attribute that is backed by the annotation store.
+
+    Arguments:
+        - attr: str; the name of the custom attribute.
+    """
+    Token.set_extension(attr, getter=partial(_get_token_value, attr),
+                        setter=partial(_set_token_value, attr), force=True)
+
+
+def get_label_mask(attr, labels):
+    """
+    Get the bitmask of a set of labels of a bitset attribute, assigning a bit
+    to each new label.
+
+    Arguments:
+        - attr: str; the name of the bitset attribute.
+        - labels: list; the labels.
+
+    Return:
+        - mask: int; the bitmask.
+    """
+    bit_labels = BITSET_LABELS.setdefault(attr, [])
+    mask = 0
+    for label in labels:
+        if label not in bit_labels:
+            if len(bit_labels) >= MAX_LABELS:
+                raise ValueError('-- Error: too many labels for bitset attribute ' + attr + ': ' + label)
+            bit_labels.append(label)
+        mask |= 1 << bit_labels.index(label)
+    return mask
+
+
+def get_bit_labels(labels, bits):
+    """
+    Get the labels of a bitset value.
+
+    Arguments:
+        - labels: list; the labels of the attribute, by bit.
+        - bits: int; the bitset value.
+
+    Return:
+        - labels: list; the labels whose bit is set.
+    """
+    return [label for (bit, label) in enumerate(labels) if bits & (1 << bit)]
+
+
+def _get_token_labels(attr, token):
+    columns = get_columns(token.doc)
+    if columns is None:
+        return False
+    column = columns.get(attr + BITSET_SUFFIX, None)
+    if column is None or column[token.i] == 0:
+        return False
+    return '|'.join(get_bit_labels(BITSET_LABELS[attr], int(column[token.i])))
+
+
+def _test_token_bits(attr, mask, negate, token):
+    columns = get_columns(token.doc)
+    bits = 0
+    if columns is not None:
+        column = columns.get(attr + BITSET_SUFFIX, None)
+        if column is not None:
+            bits = int(column[token.i])
+    return (bits & mask != 0) != negate
+
+
+def register_bitset(attr):
+    """
+    Register a custom token attribute whose labels are also stored in a
+    bitset column (see get_bitset_predicate()). The labels of a token are
+    available as token._.<attr>_SET, e.g. 'INTERNET|SOCIAL_MEDIA'.
+
+    Arguments:
+        - attr: str; the name of the custom attribute.
+    """
+    register_extension(attr)
+    BITSET_LABELS.setdefault(attr, [])
+    Token.set_extension(attr + BITSET_SUFFIX, getter=partial(_get_token_labels, attr), force=True)
+
+
+def is_bitset(attr):
+    """
+    Check whether a custom token attribute has a bitset column.
+
+    Arguments:
+        - attr: str; the name of the custom attribute.
+
+    Return:
+        - bitset: bool; True if the attribute was registered with
+                  register_bitset().
+    """
+    return attr in BITSET_LABELS
+
+
+def get_bitset_predicate(attr, labels, negate=False):
+    """
+    Get a boolean custom token attribute that tests whether a token has any
+    (or, negated, none) of a set of labels in the bitset column of an
+    attribute, registering it if needed. A rule predicate such as
+    {'_': {'LA': {'IN': [...]}}} is compiled to {'_': {<name>: True}}.
+
+    Arguments:
+        - attr: str; the name of the bitset attribute.
+        - labels: list; the labels.
+        - negate: bool; test that the token has none of the labels.
+
+    Return:
+        - name: str; the name of the custom attribute.
+    """
+    mask = get_label_mask(attr, labels)
+    name = attr + ('_NONE_' if negate else '_ANY_') + format(mask, 'x')
+    if not Token.has_extension(name):
+        Token.set_extension(name, getter=partial(_test_token_bits, attr, mask, negate))
+    return name
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks
+
+    Throughput benchmarks for the Online Activity Annotator pipeline. Each
+    benchmark is a sub-command, e.g.:
+
+        python benchmark.py staging -c corpus.txt -n 3
+
+    The corpus is either a text file with one document per line, a directory
+    of .txt files or, by default, the test examples (examples/test_examples.py).
+"""
+
+import argparse
+import ast
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+EXAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples', 'test_examples.py')
+
+
+def load_corpus(path=None):
+    """
+    Load the documents of a benchmark corpus.
+
+    Arguments:
+        - path: str; a text file with one document per line, a directory of
+                .txt files, or None for the test examples.
+
+    Return:
+        - texts: list; the document texts.
+    """
+    if path is None:
+        # collect every string assigned in the examples file
+        with open(EXAMPLES_PATH, 'r', encoding='utf-8') as fin:
+            tree = ast.parse(fin.read())
+        texts = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+                texts.append(node.value.value)
+        return texts
+    if os.path.isdir(path):
+        texts = []
+        for f in sorted(os.listdir(path)):
+            if f.endswith('.txt'):
+                with open(os.path.join(path, f), 'r', encoding='Latin-1') as fin:
+                    texts.append(fin.read())
+        return texts
+    with open(path, 'r', encoding='utf-8') as fin:
+        return [line.rstrip('\n') for line in fin if line.strip() != '']
+
+
+def get_mentions(oaa, doc):
+    """
+    Get the mentions annotated in a document as comparable tuples.
+
+    Arguments:
+        - oaa: OnlineActivityAnnotator; the annotator.
+        - doc: spaCy Doc; the annotated document.
+
+    Return:
+        - mentions: list; (start, end, class) tuples sorted by offset.
+    """
+    mentions = oaa.build_ehost_output(oaa.merge_spans(doc)).values()
+    return sorted((int(m['start']), int(m['end']), m['class']) for m in mentions)
+
+
+def time_annotator(oaa, texts, n_iter):
+    """
+    Annotate a corpus several times and measure the throughput.
+
+    Arguments:
+        - oaa: OnlineActivityAnnotator; the annotator.
+        - texts: list; the document texts.
+        - n_iter: int; the number of passes over the corpus.
+
+    Return:
+        - docs_per_sec: float; the best throughput over all passes.
+        - mentions: list; the mentions of each document in the last pass.
+    """
+    best = None
+    mentions = []
+    for _ in range(n_iter):
+        mentions = []
+        t0 = time.perf_counter()
+        for text in texts:
+            mentions.append(get_mentions(oaa, oaa.nlp(text)))
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return len(texts) / max(best, 1e-9), mentions
+
+
+def benchmark_staging(args):
+    """
+    Compare the throughput of the annotator with and without staging of the
+    token sequence rules, and check that both produce identical mentions.
+    """
+    from online_activity_annotator import OnlineActivityAnnotator
+
+    texts = load_corpus(args.corpus)
+    print('-- Corpus:', len(texts), 'documents', file=sys.stderr)
+
+    results = {}
+    for staged in [False, True]:
+        oaa = OnlineActivityAnnotator(staged=staged)
+        results[staged] = time_annotator(oaa, texts, args.iterations)
+
+    print('{:<12}{:>12}'.format('MODE', 'DOCS/SEC'))
+    print('{:<12}{:>12.1f}'.format('unstaged', results[False][0]))
+    print('{:<12}{:>12.1f}'.format('staged', results[True][0]))
+    print('{:<12}{:>12.2f}'.format('speed-up', results[True][0] / results[False][0]))
+
+    diff = [i for i, (a, b) in enumerate(zip(results[False][1], results[True][1])) if a != b]
+    if len(diff) > 0:
+        print('-- Error: mentions differ for', len(diff), 'documents:', diff[:10], file=sys.stderr)
+        return 1
+    print('-- Mentions identical for all documents.', file=sys.stderr)
+    return 0
+
+
+def benchmark_windowed(args):
+    """
+    Compare the throughput of the annotator with full and windowed tagging
+    (see WindowedTagger), and check that both produce identical mentions.
+    """
+    from online_activity_annotator import OnlineActivityAnnotator
+
+    texts = load_corpus(args.corpus)
+    print('-- Corpus:', len(texts), 'documents', file=sys.stderr)
+
+    results = {}
+    for windowed in [False, True]:
+        oaa = OnlineActivityAnnotator(windowed=windowed)
+        results[windowed] = time_annotator(oaa, texts, args.iterations)
+        tagger = oaa.nlp.get_pipe('tagger')
+        if windowed and hasattr(tagger, 'n_tagged'):
+            print('-- Tagged tokens:', tagger.n_tagged, 'of', tagger.n_tokens, file=sys.stderr)
+
+    print('{:<12}{:>12}'.format('MODE', 'DOCS/SEC'))
+    print('{:<12}{:>12.1f}'.format('full', results[False][0]))
+    print('{:<12}{:>12.1f}'.format('windowed', results[True][0]))
+    print('{:<12}{:>12.2f}'.format('speed-up', results[True][0] / results[False][0]))
+
+    diff = [i for i, (a, b) in enumerate(zip(results[False][1], results[True][1])) if a != b]
+    if len(diff) > 0:
+        print('-- Error: mentions differ for', len(diff), 'documents:', diff[:10], file=sys.stderr)
+        return 1
+    print('-- Mentions identical for all documents.', file=sys.stderr)
+    return 0
+
+
+def benchmark_batch(args):
+    """
+    Compare the throughput of the single-text API (process_text()) and the
+    batch API (process_texts()) on the same corpus, and check that both
+    produce identical mentions.
+    """
+    from online_activity_annotator import OnlineActivityAnnotator
+
+    texts = load_corpus(args.corpus)
+    print('-- Corpus:', len(texts), 'documents', file=sys.stderr)
+    oaa = OnlineActivityAnnotator()
+    items = [(str(i), text) for i, text in enumerate(texts)]
+
+    def get_offsets(mentions):
+        return sorted((int(m['start']), int(m['end']), m['class']) for m in mentions.values())
+
+    results = {}
+    for mode in ['single', 'batch']:
+        best = None
+        for _ in range(args.iterations):
+            t0 = time.perf_counter()
+            if mode == 'single':
+                mentions = [get_offsets(oaa.process_text(text, text_id)[text_id]) for text_id, text in items]
+            else:
+                mentions = [get_offsets(m) for _, m in oaa.process_texts(items, batch_size=args.batch_size)]
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results[mode] = (len(texts) / max(best, 1e-9), mentions)
+
+    print('{:<12}{:>12}'.format('MODE', 'DOCS/SEC'))
+    print('{:<12}{:>12.1f}'.format('single', results['single'][0]))
+    print('{:<12}{:>12.1f}'.format('batch', results['batch'][0]))
+    print('{:<12}{:>12.2f}'.format('speed-up', results['batch'][0] / results['single'][0]))
+
+    diff = [i for i, (a, b) in enumerate(zip(results['single'][1], results['batch'][1])) if a != b]
+    if len(diff) > 0:
+        print('-- Error: mentions differ for', len(diff), 'documents:', diff[:10], file=sys.stderr)
+        return 1
+    print('-- Mentions identical for all documents.', file=sys.stderr)
+    return 0
+
+
+def make_lemma_corpus(vocab, n_lemmas, n_docs, doc_length, seed=0):
+    """
+    Create synthetic tagged documents whose lemmas are drawn at random from
+    a synthetic lemma vocabulary.
+
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary.
+        - n_lemmas: int; the size of the lemma vocabulary.
+        - n_docs: int; the number of documents.
+        - doc_length: int; the number of tokens per document.
+        - seed: int; the random seed.
+
+    Return:
+        - docs: list; the documents.
+    """
+    from spacy.tokens import Doc
+
+    rand = random.Random(seed)
+    docs = []
+    for _ in range(n_docs):
+        lemmas = ['lemma' + str(rand.randrange(n_lemmas)) for _ in range(doc_length)]
+        doc = Doc(vocab, words=lemmas)
+        for token, lemma in zip(doc, lemmas):
+            token.lemma_ = lemma
+        doc.is_tagged = True
+        docs.append(doc)
+    return docs
+
+
+def make_lemma_lexicon(n_entries, n_lemmas, seed=0):
+    """
+    Create a synthetic lexicon of lemma sequences of 1 to 3 lemmas.
+
+    Arguments:
+        - n_entries: int; the number of entries.
+        - n_lemmas: int; the size of the lemma vocabulary.
+        - seed: int; the random seed.
+
+    Return:
+        - lemma_sequences: list; the lemma sequences.
+    """
+    rand = random.Random(seed)
+    entries = set()
+    while len(entries) < n_entries:
+        length = rand.choice([1, 2, 2, 3])
+        entries.add(' '.join(['lemma' + str(rand.randrange(n_lemmas)) for _ in range(length)]))
+    return sorted(entries)
+
+
+def benchmark_lemma_lexicon(args):
+    """
+    Compare the build and match time of lemma lexicons compiled into one token
+    Matcher pattern per entry (former LemmaAnnotator) and into a PhraseMatcher
+    on LEMMA (current LemmaAnnotator), for synthetic lexicons of growing size.
+    """
+    import spacy
+
+    from lexical_annotator import make_lemma_pattern_docs
+    from spacy.matcher import Matcher, PhraseMatcher
+    from spacy.symbols import LEMMA
+
+    nlp = spacy.blank('en')
+    docs = make_lemma_corpus(nlp.vocab, args.lemmas, args.docs, args.length)
+
+    print('{:<10}{:<14}{:>12}{:>14}{:>12}'.format('ENTRIES', 'MATCHER', 'BUILD (s)', 'DOCS/SEC', 'MATCHES'))
+    for n_entries in args.sizes:
+        lemma_sequences = make_lemma_lexicon(n_entries, args.lemmas)
+        results = {}
+
+        t0 = time.perf_counter()
+        matcher = Matcher(nlp.vocab)
+        for lemmas in lemma_sequences:
+            matcher.add('LEX', None, [{LEMMA: lemma} for lemma in lemmas.split()])
+        results['Matcher'] = (matcher, time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        matcher = PhraseMatcher(nlp.vocab, attr=LEMMA)
+        matcher.add('LEX', None, *make_lemma_pattern_docs(nlp.vocab, lemma_sequences))
+        results['PhraseMatcher'] = (matcher, time.perf_counter() - t0)
+
+        counts = {}
+        for name in ['Matcher', 'PhraseMatcher']:
+            matcher, build_time = results[name]
+            t0 = time.perf_counter()
+            counts[name] = sum(len(matcher(doc)) for doc in docs)
+            docs_per_sec = len(docs) / max(time.perf_counter() - t0, 1e-9)
+            print('{:<10}{:<14}{:>12.2f}{:>14.1f}{:>12}'.format(n_entries, name, build_time, docs_per_sec, counts[name]))
+
+        if counts['Matcher'] != counts['PhraseMatcher']:
+            print('-- Error: the matchers found a different number of matches.', file=sys.stderr)
+            return 1
+    return 0
+
+
+def get_rss():
+    """
+    Get the resident set size of the current process, split into private
+    (anonymous) and shared (file-backed, e.g. memory-mapped) memory.
+
+    Return:
+        - rss: dict; the total, anonymous and file-backed RSS in kB (Linux
+               only, else the peak RSS as total).
+    """
+    rss = {}
+    try:
+        with open('/proc/self/status', 'r') as fin:
+            for line in fin:
+                key, _, value = line.partition(':')
+                if key in ['VmRSS', 'RssAnon', 'RssFile']:
+                    rss[key] = int(value.split()[0])
+    except OSError:
+        import resource
+        rss['VmRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss
+
+
+def make_large_lexicon(path, n_entries, seed=0):
+    """
+    Write a synthetic lexicon of app, game and website names of 1 to 3 words.
+
+    Arguments:
+        - path: str; the path to the lexicon file.
+        - n_entries: int; the number of entries.
+        - seed: int; the random seed.
+
+    Return:
+        - terms: list; the terms.
+    """
+    rand = random.Random(seed)
+    labels = ['APP', 'GAME', 'WEBSITE']
+    terms = set()
+    while len(terms) < n_entries:
+        length = rand.choice([1, 2, 2, 3])
+        terms.add(' '.join(['name' + str(rand.randrange(n_entries * 2)) for _ in range(length)]))
+    terms = sorted(terms)
+    with open(path, 'w') as fout:
+        for term in terms:
+            print(term + '\t' + rand.choice(labels), file=fout)
+    return terms
+
+
+def measure_lexicon_load(mode, path, texts):
+    """
+    Load a lexicon in the current process and measure the load time, the
+    increase of the resident set size and the matches in a set of texts.
+    Run in a new process for each measurement.
+
+    Arguments:
+        - mode: str; 'matcher' (PhraseMatcher) or 'store' (memory-mapped).
+        - path: str; the path to the lexicon file.
+        - texts: list; the texts to match.
+
+    Return:
+        - result: dict; the load time (s), the RSS before and after loading
+                  (see get_rss()) and the number of matches.
+    """
+    import spacy
+
+    from lexical_annotator import CombinedLexicalAnnotator, LexicalAnnotatorSequence
+    from lexicon_store import load_lexicon_store
+    from spacy.symbols import LOWER
+
+    nlp = spacy.blank('en')
+    annotator = CombinedLexicalAnnotator(nlp)
+    rss_before = get_rss()
+    t0 = time.perf_counter()
+    if mode == 'matcher':
+        lsa = LexicalAnnotatorSequence(nlp, path, LOWER, 'LA')
+        lsa.load_lexicon()
+        lsa.add_to_component(annotator)
+        del lsa
+    else:
+        annotator.add_store(load_lexicon_store(nlp, path, LOWER), 'LA')
+    load_time = time.perf_counter() - t0
+    rss_after = get_rss()
+    n_matches = sum(len(annotator(nlp.make_doc(text)).ents) for text in texts)
+    return {'load_time': load_time, 'rss_before': rss_before, 'rss_after': rss_after, 'matches': n_matches}
+
+
+def benchmark_lexicon_store(args):
+    """
+    Compare the load time and memory use of large synthetic lexicons loaded
+    as PhraseMatcher patterns and as memory-mapped stores (see
+    lexicon_store). Each lexicon is loaded in a new process, after a first
+    load that fills the compiled caches.
+    """
+    context = multiprocessing.get_context('spawn')
+    rand = random.Random(1)
+
+    print('{:<10}{:<10}{:>12}{:>12}{:>14}{:>14}{:>10}'.format('ENTRIES', 'MODE', 'LOAD (ms)', 'RSS+ (MB)', 'PRIVATE+ (MB)', 'SHARED+ (MB)', 'MATCHES'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_entries in args.sizes:
+            path = os.path.join(tmp_dir, 'lexicon_' + str(n_entries) + '.txt')
+            terms = make_large_lexicon(path, n_entries)
+            texts = []
+            for _ in range(args.docs):
+                words = [rand.choice(terms) if rand.random() < 0.05 else 'word' + str(rand.randrange(1000)) for _ in range(200)]
+                texts.append(' '.join(words))
+
+            counts = {}
+            for mode in ['matcher', 'store']:
+                with context.Pool(1) as pool:
+                    pool.apply(measure_lexicon_load, (mode, path, []))
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure_lexicon_load, (mode, path, texts))
+                before = result['rss_before']
+                after = result['rss_after']
+                delta = {key: (after.get(key, 0) - before.get(key, 0)) / 1024.0 for key in ['VmRSS', 'RssAnon', 'RssFile']}
+                counts[mode] = result['matches']
+                print('{:<10}{:<10}{:>12.1f}{:>12.1f}{:>14.1f}{:>14.1f}{:>10}'.format(n_entries, mode, result['load_time'] * 1000,
+                      delta['VmRSS'], delta['RssAnon'], delta['RssFile'], result['matches']))
+
+            if counts['matcher'] != counts['store']:
+                print('-- Error: the PhraseMatcher and the lexicon store found a different number of matches.', file=sys.stderr)
+                return 1
+    return 0
+
+
+def build_pipeline(path):
+    """
+    Build the default annotator and write its pipeline to a directory.
+
+    Arguments:
+        - path: str; the path to the pipeline directory.
+    """
+    from online_activity_annotator import OnlineActivityAnnotator
+
+    OnlineActivityAnnotator().to_disk(path)
+
+
+def measure_startup(mode, path, texts):
+    """
+    Create an annotator in the current process and measure the startup time,
+    from the import of the annotator module to a ready pipeline, and the
+    mentions of a set of texts. Run in a new process for each measurement.
+
+    Arguments:
+        - mode: str; 'build' (OnlineActivityAnnotator()) or 'load'
+                (OnlineActivityAnnotator.from_disk()).
+        - path: str; the path to the pipeline directory.
+        - texts: list; the texts to annotate.
+
+    Return:
+        - result: dict; the import and startup times (s), the RSS after
+                  startup (see get_rss()) and the mentions of each text.
+    """
+    t0 = time.perf_counter()
+    from online_activity_annotator import OnlineActivityAnnotator
+    import_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    if mode == 'build':
+        oaa = OnlineActivityAnnotator()
+    else:
+        oaa = OnlineActivityAnnotator.from_disk(path)
+    startup_time = time.perf_counter() - t0
+    rss = get_rss()
+    mentions = [sorted((int(m['start']), int(m['end']), m['class']) for m in oaa.process_text(text, str(i))[str(i)].values())
+                for i, text in enumerate(texts)]
+    return {'import_time': import_time, 'startup_time': startup_time, 'rss': rss, 'mentions': mentions}
+
+
+def benchmark_startup(args):
+    """
+    Compare the startup time of an annotator built from the lexicon, grammar
+    and detokenization rule files and of one loaded from a pipeline written
+    with OnlineActivityAnnotator.to_disk(), and check that both produce
+    identical mentions. Each annotator is created in a new process.
+    """
+    context = multiprocessing.get_context('spawn')
+    texts = load_corpus(args.corpus)
+    print('-- Corpus:', len(texts), 'documents', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'pipeline')
+        with context.Pool(1) as pool:
+            pool.apply(build_pipeline, (path,))
+
+        results = {}
+        for mode in ['build', 'load']:
+            times = []
+            for _ in range(args.iterations):
+                with context.Pool(1) as pool:
+                    result = pool.apply(measure_startup, (mode, path, texts))
+                times.append(result['startup_time'])
+            results[mode] = (min(times), result)
+
+    print('{:<12}{:>14}{:>14}{:>12}'.format('MODE', 'IMPORT (ms)', 'STARTUP (ms)', 'RSS (MB)'))
+    for mode in ['build', 'load']:
+        startup_time, result = results[mode]
+        print('{:<12}{:>14.1f}{:>14.1f}{:>12.1f}'.format(mode, result['import_time'] * 1000, startup_time * 1000, result['rss']['VmRSS'] / 1024.0))
+    print('{:<12}{:>28.2f}'.format('speed-up', results['build'][0] / max(results['load'][0], 1e-9)))
+
+    diff = [i for i, (a, b) in enumerate(zip(results['build'][1]['mentions'], results['load'][1]['mentions'])) if a != b]
+    if len(diff) > 0:
+        print('-- Error: mentions differ for', len(diff), 'documents:', diff[:10], file=sys.stderr)
+        return 1
+    print('-- Mentions identical for all documents.', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online Activity Annotator benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    staging = subparsers.add_parser('staging', help='compare unstaged and staged token sequence rules.')
+    staging.add_argument('-c', '--corpus', type=str, default=None, help='a text file (one document per line) or a directory of .txt files.')
+    staging.add_argument('-n', '--iterations', type=int, default=3, help='the number of passes over the corpus.')
+    staging.set_defaults(func=benchmark_staging)
+
+    windowed = subparsers.add_parser('windowed', help='compare full and windowed tagging.')
+    windowed.add_argument('-c', '--corpus', type=str, default=None, help='a text file (one document per line) or a directory of .txt files.')
+    windowed.add_argument('-n', '--iterations', type=int, default=3, help='the number of passes over the corpus.')
+    windowed.set_defaults(func=benchmark_windowed)
+
+    batch = subparsers.add_parser('batch', help='compare the single-text and batch (nlp.pipe) APIs.')
+    batch.add_argument('-c', '--corpus', type=str, default=None, help='a text file (one document per line) or a directory of .txt files.')
+    batch.add_argument('-n', '--iterations', type=int, default=3, help='the number of passes over the corpus.')
+    batch.add_argument('-b', '--batch_size', type=int, default=1000, help='the number of texts per batch.')
+    batch.set_defaults(func=benchmark_batch)
+
+    lemma_lexicon = subparsers.add_parser('lemma_lexicon', help='compare lemma lexicon matchers on synthetic lexicons.')
+    lemma_lexicon.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='the lexicon sizes.')
+    lemma_lexicon.add_argument('-l', '--lemmas', type=int, default=20000, help='the size of the synthetic lemma vocabulary.')
+    lemma_lexicon.add_argument('-d', '--docs', type=int, default=200, help='the number of synthetic documents.')
+    lemma_lexicon.add_argument('--length', type=int, default=500, help='the number of tokens per document.')
+    lemma_lexicon.set_defaults(func=benchmark_lemma_lexicon)
+
+    lexicon_store = subparsers.add_parser('lexicon_store', help='compare the load time and memory use of PhraseMatcher lexicons and memory-mapped lexicon stores.')
+    lexicon_store.add_argument('-s', '--sizes', type=int, nargs='+', default=[10000, 100000, 500000], help='the lexicon sizes.')
+    lexicon_store.add_argument('-d', '--docs', type=int, default=100, help='the number of synthetic documents matched after loading.')
+    lexicon_store.set_defaults(func=benchmark_lexicon_store)
+
+    startup = subparsers.add_parser('startup', help='compare the startup time of a built and of a serialized (from_disk) pipeline.')
+    startup.add_argument('-c', '--corpus', type=str, default=None, help='a text file (one document per line) or a directory of .txt files.')
+    startup.add_argument('-n', '--iterations', type=int, default=3, help='the number of startups of each pipeline.')
+    startup.set_defaults(func=benchmark_startup)
+
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(0)
+
+    sys.exit(args.func(args))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    Corpus Stream
+
+    Streaming sources and sinks for annotating corpora that do not fit in
+    memory. A source is a generator of (text_id, text) pairs read lazily from a
+    JSON lines file, a CSV file or a directory tree of text files. A sink
+    writes the mentions of each text as soon as it has been annotated, so
+    memory use does not grow with the size of the corpus:
+
+        source = open_source('notes.jsonl', id_field='cn_doc_id', text_field='text_content')
+        with open_sink('mentions.csv') as sink:
+            oaa.process_stream(source, sink)
+
+    See OnlineActivityAnnotator.process_stream().
+"""
+
+import csv
+import json
+import os
+import sys
+
+# Columns of the CSV sink, one row per mention
+CSV_COLUMNS = ['id', 'start', 'end', 'class', 'text', 'rule_version']
+
+
+def read_jsonl(path, id_field='id', text_field='text'):
+    """
+    Read texts from a JSON lines file, one JSON object per line.
+
+    Arguments:
+        - path: str; the path to the file.
+        - id_field: str; the field of the text identifier.
+        - text_field: str; the field of the text.
+
+    Return:
+        - texts: generator; the (text_id, text) pairs.
+    """
+    with open(path, 'r', encoding='utf-8') as fin:
+        for n, line in enumerate(fin, 1):
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            yield str(record.get(id_field, n)), record.get(text_field, None) or ''
+
+
+def read_csv(path, id_field='id', text_field='text'):
+    """
+    Read texts from a CSV file with a header row.
+
+    Arguments:
+        - path: str; the path to the file.
+        - id_field: str; the column of the text identifier.
+        - text_field: str; the column of the text.
+
+    Return:
+        - texts: generator; the (text_id, text) pairs.
+    """
+    # clinical notes can be longer than the default field size limit
+    csv.field_size_limit(min(sys.maxsize, 2 ** 31 - 1))
+    with open(path, 'r', encoding='utf-8', newline='') as fin:
+        for n, row in enumerate(csv.DictReader(fin), 1):
+            yield str(row.get(id_field, n)), row.get(text_field, None) or ''
+
+
+def read_directory(path, extension='.txt', encoding='Latin-1'):
+    """
+    Read texts from the files of a directory tree, in sorted order.
+
+    Arguments:
+        - path: str; the path to the directory.
+        - extension: str; the extension of the text files.
+        - encoding: str; the encoding of the text files.
+
+    Return:
+        - texts: generator; the (text_id, text) pairs, where text_id is the
+                 path of the file relative to the directory.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if not f.endswith(extension):
+                continue
+            pin = os.path.join(dirpath, f)
+            with open(pin, 'r', encoding=encoding) as fin:
+                yield os.path.relpath(pin, path), fin.read()
+
+
+def open_source(path, id_field='id', text_field='text'):
+    """
+    Open a source of texts according to the type of the path.
+
+    Arguments:
+        - path: str; a directory, a JSON lines file (.jsonl) or a CSV file
+                (.csv).
+        - id_field: str; the field of the text identifier (JSON lines, CSV).
+        - text_field: str; the field of the text (JSON lines, CSV).
+
+    Return:
+        - texts: generator; the (text_id, text) pairs.
+    """
+    if os.path.isdir(path):
+        return read_directory(path)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ['.jsonl', '.json']:
+        return read_jsonl(path, id_field, text_field)
+    if ext == '.csv':
+        return read_csv(path, id_field, text_field)
+    raise ValueError('-- Error: unknown corpus format (directory, .jsonl or .csv): ' + path)
+
+
+class JsonlSink(object):
+    """
+    JSON Lines Sink
+
+    Writes the mentions of each text as one JSON object per line.
+    """
+
+    def __init__(self, path=None):
+        """
+        Create a new JsonlSink instance.
+
+        Arguments:
+            - path: str; the path to the output file (default: stdout).
+        """
+        self.fout = open(path, 'w', encoding='utf-8') if path is not None else sys.stdout
+        self.n_texts = 0
+        self.n_mentions = 0
+
+    def write(self, text_id, mentions):
+        """
+        Write the mentions of a text.
+
+        Arguments:
+            - text_id: str; the text identifier.
+            - mentions: dict; the mentions of the text (see
+                        OnlineActivityAnnotator.build_ehost_output()), in
+                        document order.
+        """
+        print(json.dumps({'id': text_id, 'mentions': list(mentions.values())}), file=self.fout)
+        self.n_texts += 1
+        self.n_mentions += len(mentions)
+
+    def close(self):
+        if self.fout is not sys.stdout:
+            self.fout.close()
+        else:
+            self.fout.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvSink(JsonlSink):
+    """
+    CSV Sink
+
+    Writes one row per mention (see CSV_COLUMNS). Texts without mentions have
+    no row.
+    """
+
+    def __init__(self, path=None):
+        """
+        Create a new CsvSink instance.
+
+        Arguments:
+            - path: str; the path to the output file (default: stdout).
+        """
+        self.fout = open(path, 'w', encoding='utf-8', newline='') if path is not None else sys.stdout
+        self.writer = csv.writer(self.fout)
+        self.writer.writerow(CSV_COLUMNS)
+        self.n_texts = 0
+        self.n_mentions = 0
+
+    def write(self, text_id, mentions):
+        for mention in mentions.values():
+            self.writer.writerow([text_id] + [mention.get(column, None) for column in CSV_COLUMNS[1:]])
+        self.n_texts += 1
+        self.n_mentions += len(mentions)
+
+
+def open_sink(path=None):
+    """
+    Open a sink according to the extension of the path.
+
+    Arguments:
+        - path: str; a CSV file (.csv) or a JSON lines file (anything else,
+                or stdout if None).
+
+    Return:
+        - sink: JsonlSink or CsvSink; the sink.
+    """
+    if path is not None and os.path.splitext(path)[1].lower() == '.csv':
+        return CsvSink(path)
+    return JsonlSink(path)
+
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of the current process.
+
+    Return:
+        - rss: float; the peak RSS in MB, or None if it is not available.
+    """
+    try:
+        with open('/proc/self/status', 'r') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    Doc Cache
+
+    Persistent store of tokenized and tagged documents. The output of the
+    language-level pipeline stages (tokenizer, tagger, lemma corrector, date
+    annotator) only changes when the text, the spaCy model or these stages
+    change, so it can be reused when only the lexicons or the token sequence
+    rules are edited.
+
+    Each document is stored as a DocBin in an SQLite database, keyed by a hash
+    of its text and a fingerprint of the pipeline stages that produced it.
+    The database is in WAL mode, so several worker processes can share it:
+    each worker commits every entry at once (commit_interval=1) to hold the
+    write lock as briefly as possible, and waits up to BUSY_TIMEOUT for it.
+    A cache entry that still cannot be read or written is skipped with a
+    warning, the document itself is still processed.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+
+from annotation_store import STORE_KEY, get_store
+from spacy.tokens import DocBin
+
+# Token attributes restored from the cache (the parser and entity recognizer
+# are not part of the pipeline, and spaCy cannot restore HEAD with SENT_START)
+CACHE_ATTRIBUTES = ['ORTH', 'LEMMA', 'NORM', 'TAG', 'POS', 'SENT_START']
+# Number of new entries written before a commit
+COMMIT_INTERVAL = 1000
+# Number of seconds to wait for another process to release the database
+BUSY_TIMEOUT = 60.0
+
+
+def get_text_hash(text):
+    """
+    Compute the hash of a document text.
+
+    Arguments:
+        - text: str; the document text.
+
+    Return:
+        - digest: str; the hexadecimal SHA-1 digest.
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class DocCache(object):
+    """
+    Doc Cache
+
+    SQLite store of tagged documents keyed by text hash and pipeline
+    fingerprint.
+    """
+
+    def __init__(self, path, fingerprint, commit_interval=COMMIT_INTERVAL):
+        """
+        Create a new DocCache instance.
+
+        Arguments:
+            - path: str; the path to the SQLite database (created if needed).
+            - fingerprint: str; a hash of the model and the pipeline stages
+                           whose output is cached (see
+                           OnlineActivityAnnotator.get_base_fingerprint()).
+            - commit_interval: int; the number of new entries written before
+                               a commit (1 when the database is shared by
+                               several processes).
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.commit_interval = commit_interval
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_pending = 0
+        self.n_errors = 0
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS docs (text_hash TEXT, fingerprint TEXT, doc BLOB, annotations TEXT, '
+                        'PRIMARY KEY (text_hash, fingerprint))')
+        self.db.commit()
+
+    def get(self, text, vocab):
+        """
+        Get the cached document for a text.
+
+        Arguments:
+            - text: str; the document text.
+            - vocab: spaCy Vocab; the vocabulary of the pipeline.
+
+        Return:
+            - doc: spaCy Doc; the cached document, or None if the text is not
+                   in the cache.
+        """
+        try:
+            row = self.db.execute('SELECT doc, annotations FROM docs WHERE text_hash = ? AND fingerprint = ?',
+                                  (get_text_hash(text), self.fingerprint)).fetchone()
+        except sqlite3.OperationalError as e:
+            print('-- Warning: unable to read the tagged document cache:', e, file=sys.stderr)
+            self.n_errors += 1
+            row = None
+        if row is None:
+            self.n_misses += 1
+            return None
+        try:
+            doc = list(DocBin().from_bytes(row[0]).get_docs(vocab))[0]
+            annotations = json.loads(row[1])
+            if len(annotations) > 0:
+                get_store(doc).from_dict(annotations)
+        except Exception as e:
+            print('-- Warning: unable to read cached document', file=sys.stderr)
+            print(e, file=sys.stderr)
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return doc
+
+    def put(self, text, doc):
+        """
+        Add a document to the cache.
+
+        Arguments:
+            - text: str; the document text.
+            - doc: spaCy Doc; the document processed by the cached stages.
+        """
+        doc_bin = DocBin(attrs=CACHE_ATTRIBUTES)
+        doc_bin.add(doc)
+        annotations = get_store(doc).to_dict() if STORE_KEY in doc.user_data else {}
+        try:
+            self.db.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)',
+                            (get_text_hash(text), self.fingerprint, doc_bin.to_bytes(), json.dumps(annotations)))
+            self.n_pending += 1
+            if self.n_pending >= self.commit_interval:
+                self.commit()
+        except sqlite3.OperationalError as e:
+            print('-- Warning: unable to write to the tagged document cache:', e, file=sys.stderr)
+            self.n_errors += 1
+
+    def commit(self):
+        """
+        Write all pending entries to the database. Entries that cannot be
+        written (e.g. the database stays locked by another process) are
+        dropped from the cache.
+        """
+        try:
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            print('-- Warning: unable to write', self.n_pending, 'entries to the tagged document cache:', e, file=sys.stderr)
+            self.n_errors += self.n_pending
+            self.db.rollback()
+        self.n_pending = 0
+
+    def purge(self):
+        """
+        Remove all entries that were produced with a different fingerprint,
+        e.g. after a model upgrade.
+
+        Return:
+            - n: int; the number of removed entries.
+        """
+        n = self.db.execute('DELETE FROM docs WHERE fingerprint != ?', (self.fingerprint,)).rowcount
+        self.db.commit()
+        return n
+
+    def close(self):
+        """
+        Commit all pending entries and close the database.
+        """
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
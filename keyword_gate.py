@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+    Keyword Gate
+
+    Fast-reject test that runs on the raw text of a note before tokenization
+    and tagging. Each rule that can add an annotation (a positive rule) is
+    reduced to a set of keywords, one of which must occur in the text for the
+    rule to match: the literal values of one of its required tokens, the
+    literal parts of a REGEX predicate, or the terms of the lexicon labels it
+    tests. All keywords are compiled into a single trie-shaped regular
+    expression, so a note is tested with one scan of its lower-cased text.
+
+    A note without any keyword cannot be annotated by the full pipeline and
+    can be skipped. Lemma keywords are reduced to a common stem of their
+    inflected forms (e.g. share -> shar for sharing); irregular forms that do
+    not share the stem are the only way for the gate to drop an annotated note,
+    which the recall audit (OnlineActivityAnnotator.audit_keyword_gate())
+    checks on a corpus.
+
+    The gate is off by default. Run the audit (--gate_audit) on a sample of
+    the corpus before enabling it (-g/--gate), and again whenever the
+    lexicons or rules change: an annotated note that the audit reports as
+    missed would be silently dropped by the gate.
+"""
+
+import re
+
+from token_sequence_annotator import get_rule_anchors
+from trace_sink import get_tracer
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Minimum length of a regex literal to be used as a keyword
+MIN_LITERAL_LENGTH = 1
+# Inflected forms of irregular lemmas that do not share their stem
+IRREGULAR_FORMS = {'be': ['is', 'am', 'are', 'was', 'were', 'been', "'s", "'m", "'re"],
+                   'have': ['has', 'had', "'ve", "'d"],
+                   'do': ['did', 'does', 'done'],
+                   'go': ['went', 'gone'],
+                   'get': ['got', 'gotten'],
+                   'make': ['made'],
+                   'take': ['took'],
+                   'see': ['saw', 'seen'],
+                   'buy': ['bought'],
+                   'find': ['found'],
+                   'spend': ['spent'],
+                   'send': ['sent'],
+                   'write': ['wrote', 'written'],
+                   'say': ['said'],
+                   'tell': ['told'],
+                   'keep': ['kept'],
+                   'leave': ['left'],
+                   'meet': ['met'],
+                   'pay': ['paid'],
+                   'man': ['men'],
+                   'woman': ['women'],
+                   'child': ['children'],
+                   'person': ['people']
+                   }
+
+
+def get_stem(lemma):
+    """
+    Get a prefix shared by the inflected forms of a lemma, e.g. game -> gam
+    (games, gaming), study -> stud (studies), man -> m (men).
+
+    Arguments:
+        - lemma: str; the lemma.
+
+    Return:
+        - stem: str; the lower-cased stem.
+    """
+    lemma = lemma.lower()
+    if lemma.endswith('man') and len(lemma) > 3:
+        return lemma[:-2]
+    if len(lemma) > 2 and lemma[-1] in 'eyf':
+        return lemma[:-1]
+    return lemma
+
+
+def get_lemma_keywords(lemma):
+    """
+    Get the keywords that one of the inflected forms of a lemma contains.
+
+    Arguments:
+        - lemma: str; the lemma.
+
+    Return:
+        - keywords: set; the stem and the irregular forms of the lemma.
+    """
+    keywords = set([get_stem(lemma)])
+    keywords.update(IRREGULAR_FORMS.get(lemma.lower(), []))
+    return keywords
+
+
+def get_term_keywords(terms, source_attribute):
+    """
+    Get the keywords of lexicon terms: the longest token of each term, which
+    must occur in any text the term matches.
+
+    Arguments:
+        - terms: list; the tokens (or lemmas) of each term.
+        - source_attribute: str; the token attribute the terms are matched on
+                            (e.g. LOWER).
+
+    Return:
+        - keywords: set; the keywords, or None if the terms are matched on an
+                    attribute that need not occur in the text (e.g. NORM).
+    """
+    if source_attribute not in ['ORTH', 'TEXT', 'LOWER', 'LEMMA']:
+        return None
+    keywords = set()
+    for tokens in terms:
+        if len(tokens) == 0:
+            continue
+        token = max(tokens, key=len)
+        if source_attribute == 'LEMMA':
+            keywords.update(get_lemma_keywords(token))
+        else:
+            keywords.add(token.lower())
+    return keywords
+
+
+def get_best_keywords(candidates):
+    """
+    Select the most selective of several keyword sets, each of which is a
+    necessary condition: the set whose shortest keyword is longest, and the
+    smallest set for equal lengths.
+
+    Arguments:
+        - candidates: list; the keyword sets.
+
+    Return:
+        - keywords: set; the selected keyword set, or None if there is none.
+    """
+    candidates = [c for c in candidates if c is not None and len(c) > 0 and '' not in c]
+    if len(candidates) == 0:
+        return None
+    return sorted(candidates, key=lambda c: (-min(len(k) for k in c), len(c)))[0]
+
+
+def _get_parsed_literals(items):
+    candidates = []
+    run = ''
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run += chr(av)
+            continue
+        if len(run) >= MIN_LITERAL_LENGTH:
+            candidates.append({run})
+        run = ''
+        if op is sre_parse.SUBPATTERN:
+            candidates.append(_get_parsed_literals(list(av[-1])))
+        elif op is sre_parse.BRANCH:
+            alternatives = [_get_parsed_literals(list(branch)) for branch in av[1]]
+            if all(alternatives):
+                candidates.append(set().union(*alternatives))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+            candidates.append(_get_parsed_literals(list(av[2])))
+    if len(run) >= MIN_LITERAL_LENGTH:
+        candidates.append({run})
+    return get_best_keywords(candidates)
+
+
+def get_regex_literals(regex):
+    """
+    Get the literal strings that a regular expression requires, i.e. a set of
+    strings one of which occurs in every match, e.g. {chat, communicat, talk}
+    for (chat|communicat|talk).*
+
+    Arguments:
+        - regex: str; the regular expression.
+
+    Return:
+        - literals: set; the lower-cased literals, or None if none is required.
+    """
+    try:
+        literals = _get_parsed_literals(list(sre_parse.parse(regex)))
+    except Exception:
+        return None
+    if literals is None:
+        return None
+    return set(literal.lower() for literal in literals)
+
+
+def get_rule_values(rules):
+    """
+    Get the custom attribute values that a set of rules annotates.
+
+    Arguments:
+        - rules: list; the compiled token sequence rules.
+
+    Return:
+        - values: set; the (custom attribute, value) pairs, e.g.
+                  ('MENTION', 'INTERNET').
+    """
+    return set((attr, value) for rule in rules for key in rule['avm'] for attr, value in rule['avm'][key].items() if value)
+
+
+def get_token_keywords(spec, label_keywords, rule_values=None):
+    """
+    Get the keyword sets of a required token specification.
+
+    Arguments:
+        - spec: dict; the token specification.
+        - label_keywords: dict; the keywords of each custom attribute value
+                          set by the lexicons, e.g. {('LA', 'GAMING'): {...}},
+                          or None for values that cannot be gated.
+        - rule_values: set; the custom attribute values annotated by the
+                       positive rules (see get_rule_values()).
+
+    Return:
+        - candidates: list; the keyword sets, each a necessary condition. The
+                      set {None} stands for a value that only a positive rule
+                      annotates.
+    """
+    if rule_values is None:
+        rule_values = set()
+    candidates = []
+    for attr in spec:
+        value = spec[attr]
+        if attr.upper() in ['ORTH', 'TEXT', 'LOWER', 'LEMMA'] and isinstance(value, dict) and 'REGEX' in value:
+            literals = get_regex_literals(value['REGEX'])
+            if literals is not None and attr.upper() == 'LEMMA':
+                literals = set().union(*[get_lemma_keywords(literal) for literal in literals])
+            candidates.append(literals)
+        elif attr == '_':
+            for ext_attr, ext_value in value.items():
+                if isinstance(ext_value, str):
+                    labels = [ext_value]
+                elif isinstance(ext_value, dict) and list(ext_value.keys()) == ['IN']:
+                    labels = ext_value['IN']
+                else:
+                    continue
+                keywords = set()
+                for label in labels:
+                    label_set = label_keywords.get((ext_attr, label), set())
+                    # a value that no lexicon sets is either annotated by a
+                    # positive rule, whose own keywords are in the gate, or
+                    # by another component (e.g. TIME), which is no condition
+                    if label_set is None or (len(label_set) == 0 and (ext_attr, label) not in rule_values):
+                        keywords = None
+                        break
+                    keywords.update(label_set)
+                if keywords is None:
+                    continue
+                candidates.append(keywords if len(keywords) > 0 else {None})
+    return candidates
+
+
+def get_rule_keywords(pattern, label_keywords, rule_values=None):
+    """
+    Get a set of keywords one of which must occur in a text for a rule
+    pattern to match.
+
+    Arguments:
+        - pattern: list; the token specifications of a rule.
+        - label_keywords: dict; the keywords of each custom attribute value
+                          set by the lexicons (see get_token_keywords()).
+        - rule_values: set; the custom attribute values annotated by the
+                       positive rules (see get_rule_values()).
+
+    Return:
+        - keywords: set; the keywords (an empty set if the rule can only match
+                    after another positive rule), or None if the rule
+                    cannot be gated.
+    """
+    candidates = []
+    for group in get_rule_anchors(pattern):
+        keywords = set()
+        for attr, value in group:
+            if attr == 'LEMMA':
+                keywords.update(get_lemma_keywords(value))
+            else:
+                keywords.add(value.lower())
+        candidates.append(keywords)
+    for spec in pattern:
+        if spec.get('OP', '+') != '+':
+            continue
+        candidates.extend(get_token_keywords(spec, label_keywords, rule_values))
+    keywords = get_best_keywords([c for c in candidates if c != {None}])
+    if keywords is None and {None} in candidates:
+        return set()
+    return keywords
+
+
+def build_trie_regex(keywords):
+    """
+    Compile keywords into a regular expression shaped like a trie, so that
+    keywords with a common prefix share a single branch.
+
+    Arguments:
+        - keywords: iterable; the keywords.
+
+    Return:
+        - regex: str; the regular expression.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def to_regex(node):
+        if '' in node:
+            # a complete keyword, longer keywords need not be tested
+            return ''
+        branches = [re.escape(char) + to_regex(node[char]) for char in sorted(node)]
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    return to_regex(trie)
+
+
+class KeywordGate(object):
+    """
+    Keyword Gate
+
+    Tests whether a text contains any of the keywords of the positive rules.
+    """
+
+    def __init__(self, keywords):
+        """
+        Create a new KeywordGate instance.
+
+        Arguments:
+            - keywords: iterable; the lower-cased keywords, or None to let all
+                        texts through.
+        """
+        self.keywords = None if keywords is None else sorted(set(keywords))
+        self.regex = None
+        if self.keywords is not None and len(self.keywords) > 0:
+            self.regex = re.compile(build_trie_regex(self.keywords))
+        self.n_passed = 0
+        self.n_rejected = 0
+
+    def has_keyword(self, text):
+        """
+        Check whether a text contains a keyword, without counting it.
+
+        Arguments:
+            - text: str; the raw text.
+
+        Return:
+            - found: bool; True if the text contains a keyword (always True
+                     for a gate without keywords).
+        """
+        if self.keywords is None:
+            return True
+        return self.regex is not None and self.regex.search(text.lower()) is not None
+
+    def is_candidate(self, text):
+        """
+        Check whether a text may contain an annotation.
+
+        Arguments:
+            - text: str; the raw text.
+
+        Return:
+            - candidate: bool; False if the text contains no keyword.
+        """
+        passed = self.has_keyword(text)
+        if passed:
+            self.n_passed += 1
+        else:
+            self.n_rejected += 1
+        return passed
+
+    def get_hits(self, text):
+        """
+        Get the keywords found in a text (for diagnostics).
+
+        Arguments:
+            - text: str; the raw text.
+
+        Return:
+            - hits: list; the keyword occurrences.
+        """
+        if self.regex is None:
+            return []
+        return self.regex.findall(text.lower())
+
+    def get_hit_offsets(self, text):
+        """
+        Get the character offsets of the keywords found in a text (see
+        WindowedTagger in online_activity_annotator).
+
+        Arguments:
+            - text: str; the raw text.
+
+        Return:
+            - offsets: list; the (start, end) offsets of the keyword occurrences.
+        """
+        if self.regex is None:
+            return []
+        return [match.span() for match in self.regex.finditer(text.lower())]
+
+
+def build_keyword_gate(rules, lexicons):
+    """
+    Build the keyword gate of a set of token sequence rules and lexicons.
+
+    Arguments:
+        - rules: list; the compiled token sequence rules (see
+                 token_sequence_annotator.compile_grammar()).
+        - lexicons: list; (target attribute, label, keywords) tuples for the
+                    lexicon terms (see get_term_keywords()).
+
+    Return:
+        - gate: KeywordGate; the gate. It lets all texts through if a
+                positive rule cannot be reduced to keywords.
+    """
+    label_keywords = {}
+    for attr, label, keywords in lexicons:
+        if keywords is None or label_keywords.get((attr, label), set()) is None:
+            label_keywords[(attr, label)] = None
+        else:
+            label_keywords.setdefault((attr, label), set()).update(keywords)
+
+    # rules that only remove annotations cannot make a note relevant
+    rules = [rule for rule in rules if len(get_rule_values([rule])) > 0]
+    rule_values = get_rule_values(rules)
+    gate_keywords = set()
+    for rule in rules:
+        keywords = get_rule_keywords(rule['pattern'], label_keywords, rule_values)
+        if keywords is None:
+            get_tracer().warning('keyword_gate', '-- Warning: rule {} cannot be reduced to keywords, keyword gate disabled.', rule['name'])
+            return KeywordGate(None)
+        gate_keywords.update(keywords)
+
+    return KeywordGate(gate_keywords)
@@ -13,12 +13,253 @@
 
 """
 
+import bisect
+import hashlib
+import numpy as np
 import spacy
 import sys
 
-from spacy.matcher import PhraseMatcher, Matcher
-from spacy.tokens import Span, Token
-from spacy.symbols import LEMMA, LOWER
+from annotation_store import BITSET_SUFFIX, get_label_mask, get_store, is_bitset, register_bitset, register_extension
+from functools import partial
+from rule_cache import file_digest, get_cache_path, load_cache, save_cache
+from spacy.attrs import intify_attr
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import Doc, Span
+from spacy.symbols import LEMMA, LOWER, NORM, ORTH, POS, PREFIX, SHAPE, SUFFIX, TAG, VERB
+from token_sequence_annotator import get_longest_spans
+from trace_sink import DEBUG, get_tracer
+from vocab_flags import get_vocab_flag
+
+# Version of the compiled lexicon cache format
+LEXICON_FORMAT = 1
+# Token attributes that are set by the tokenizer alone
+TOKENIZER_ATTRIBUTES = [ORTH, LOWER, NORM, SHAPE, PREFIX, SUFFIX]
+# Token attributes for which single-token terms are matched with lexeme flags
+FLAG_ATTRIBUTES = [ORTH, LOWER]
+
+
+def get_tokenizer_fingerprint(nlp):
+    """
+    Compute a fingerprint of the tokenizer rules of a pipeline, including the
+    special cases added by the detokenizer.
+    
+    Arguments:
+        - nlp: spaCy Language; a spaCy text processing pipeline instance.
+    
+    Return:
+        - fingerprint: str; the hexadecimal SHA-1 digest.
+    """
+    return hashlib.sha1(nlp.tokenizer.to_bytes(exclude=['vocab'])).hexdigest()
+
+
+def make_pattern_docs(nlp, terms, source_attribute):
+    """
+    Create the PhraseMatcher pattern documents for a list of terms. Only the
+    tokenizer is run if the match attribute is set by the tokenizer, else the
+    terms are processed by the full pipeline.
+    
+    Arguments:
+        - nlp: spaCy Language; a spaCy text processing pipeline instance.
+        - terms: list; the terms.
+        - source_attribute: spaCy symbol; the token attribute to match on.
+    
+    Return:
+        - docs: list; the pattern documents.
+    """
+    if intify_attr(source_attribute) in TOKENIZER_ATTRIBUTES:
+        return list(nlp.tokenizer.pipe(terms))
+    return [nlp(text) for text in terms]
+
+
+def is_lexicon_term(values, lower, text):
+    """
+    Lexeme flag getter: check whether a lexeme is one of a set of single-token
+    terms.
+    
+    Arguments:
+        - values: frozenset; the terms.
+        - lower: bool; compare the lower-cased lexeme text.
+        - text: str; the lexeme text.
+    
+    Return:
+        - flag: bool; True if the lexeme is one of the terms.
+    """
+    return (text.lower() if lower else text) in values
+
+
+def get_lexeme_flag_key(source_attribute, values):
+    """
+    Get the vocabulary flag key of a set of single-token terms (see
+    vocab_flags).
+    
+    Arguments:
+        - source_attribute: spaCy symbol; the token attribute to match on.
+        - values: iterable; the single-token terms.
+    
+    Return:
+        - key: tuple; the flag key.
+    """
+    return ('LEXEME', intify_attr(source_attribute), frozenset(values))
+
+
+def get_lexeme_flag(vocab, source_attribute, values):
+    """
+    Get a lexeme flag that is set for the lexemes of a set of single-token
+    terms, registering it in the vocabulary if needed (see vocab_flags). The
+    flag of an identical term set is reused, e.g. when the lexicons are
+    reloaded.
+    
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary of the pipeline.
+        - source_attribute: spaCy symbol; the token attribute to match on
+                            (ORTH or LOWER).
+        - values: iterable; the single-token terms.
+    
+    Return:
+        - flag_id: int; the flag ID, or None if no flag is available.
+    """
+    values = frozenset(values)
+    attr = intify_attr(source_attribute)
+    flag_id = get_vocab_flag(vocab, get_lexeme_flag_key(attr, values), partial(is_lexicon_term, values, attr == LOWER))
+    if flag_id is None:
+        get_tracer().warning('lexeme_flag', '-- Warning: no lexeme flag available, single-token terms are phrase matched')
+    return flag_id
+
+
+def make_lemma_pattern_docs(vocab, lemma_sequences):
+    """
+    Create the PhraseMatcher pattern documents for a list of lemma sequences
+    (lemmas separated by whitespace). The lemmas are set directly on the
+    tokens, so no tagging is needed.
+    
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary of the pipeline.
+        - lemma_sequences: list; the lemma sequences.
+    
+    Return:
+        - docs: list; the pattern documents, to be matched on LEMMA.
+    """
+    docs = []
+    for lemmas in lemma_sequences:
+        lemmas = lemmas.split()
+        doc = Doc(vocab, words=lemmas)
+        for token, lemma in zip(doc, lemmas):
+            token.lemma_ = lemma
+        doc.is_tagged = True
+        docs.append(doc)
+    return docs
+
+
+def add_lexical_annotations(doc, matches, attribute, label):
+    """
+    Add the label of each matched span to the target attribute of its tokens
+    (and to its bitset column, see annotation_store.register_bitset()) and
+    copy the tense of the last verb in the span to all of its tokens (for
+    DSH annotator). Annotations are written in bulk to the annotation store.
+    
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+        - matches: list; the matched spans.
+        - attribute: str; the custom attribute to add the label to.
+        - label: str; the label to add.
+    """
+    if len(matches) == 0:
+        return
+    store = get_store(doc)
+    labels = store.column(attribute)
+    tenses = store.column('tense')
+    label_code = store.encode(label)
+    no_tense_code = store.encode('_')
+    pos_tags = doc.to_array([POS, TAG])
+    bits = None
+    if is_bitset(attribute):
+        bits = store.column(attribute + BITSET_SUFFIX)
+        label_mask = np.uint64(get_label_mask(attribute, [label]))
+    for _, start, end in matches:
+        labels[start:end] = label_code
+        if bits is not None:
+            bits[start:end] |= label_mask
+        verbs = np.nonzero(pos_tags[start:end, 0] == VERB)[0]
+        if len(verbs) > 0:
+            tenses[start:end] = pos_tags[start + verbs[-1], 1]
+        else:
+            tenses[start:end] = no_tense_code
+
+
+def add_entities(doc, entities):
+    """
+    Add entity spans to a document. As before, a new span only displaces the
+    existing entities it overlaps with: it is added if it is longer than
+    them, and new spans that overlap no existing entity are not added, so
+    doc.ents is left untouched when it is empty. Overlaps are resolved in a
+    single sorted sweep: longer spans are kept first and, for spans of equal
+    length, existing entities and then the new spans in the given order take
+    precedence. doc.ents is only assigned once.
+    
+    Arguments:
+        - doc: spaCy Doc; a spaCy document instance.
+        - entities: list; the new entity spans.
+    """
+    existing = list(doc.ents)
+    if len(entities) == 0 or len(existing) == 0:
+        return
+    existing_starts = [ent.start for ent in existing]
+    existing_ends = [ent.end for ent in existing]
+    candidates = existing + list(entities)
+    n_existing = len(existing)
+    order = sorted(range(len(candidates)), key=lambda i: (candidates[i].start - candidates[i].end, i))
+    tracer = get_tracer()
+    starts = []
+    ends = []
+    kept = []
+    for i in order:
+        entity = candidates[i]
+        if i >= n_existing and not overlaps_span(existing_starts, existing_ends, entity):
+            continue
+        if overlaps_span(starts, ends, entity):
+            if i >= n_existing and tracer.enabled(DEBUG):
+                tracer.debug('entity_overlap', '-- Warning: overlapping entity not added: {} {} {}',
+                             entity.start, entity.end, entity)
+            continue
+        k = bisect.bisect_right(starts, entity.start)
+        starts.insert(k, entity.start)
+        ends.insert(k, entity.end)
+        kept.insert(k, entity)
+    doc.ents = kept
+
+
+def overlaps_span(starts, ends, span):
+    """
+    Check whether a span overlaps with any of a list of non-overlapping spans.
+    
+    Arguments:
+        - starts: list; the sorted start offsets of the spans.
+        - ends: list; the end offsets of the spans, in the same order.
+        - span: spaCy Span; the span to check.
+    
+    Return: bool; True if span overlaps with one of the spans, else False.
+    """
+    k = bisect.bisect_right(starts, span.start)
+    # the spans do not overlap, so only the neighbours need checking
+    return (k > 0 and ends[k - 1] > span.start) or (k < len(starts) and starts[k] < span.end)
+
+
+def get_longest_matches(matches):
+    """
+    Remove all shortest matching overlapping spans. Overlaps are resolved with
+    a sorted sweep (see token_sequence_annotator.get_longest_spans()), so the
+    result does not depend on the order of the matches.
+    
+    Arguments:
+        - matches: list; a list of matched entities.
+    
+    Return:
+        - matches: list; all longest matches only, sorted by start offset.
+    """
+    match_ids = {}
+    for match_id, start, end in matches:
+        match_ids.setdefault((start, end), match_id)
+    return [(match_ids[offset], offset[0], offset[1]) for offset in get_longest_spans(list(match_ids.keys()))]
 
 
 class LexicalAnnotatorSequence(object):
@@ -48,11 +289,17 @@ class LexicalAnnotatorSequence(object):
         self.source_attribute = source_attribute
         self.target_attribute = target_attribute
         self.annotation_rules = {}
+        self.patterns = {}
         self.merge = merge
 
-    def load_lexicon(self):
+    def load_lexicon(self, use_cache=True):
         """
-        Load the lexical rules from the input file.
+        Load the lexical rules from the input file and build the patterns.
+        
+        Arguments:
+            - use_cache: bool; reuse the tokenized patterns from the compiled
+                         lexicon cache if the lexicon file and the tokenizer
+                         have not changed.
         """
         n = 1
         with open(self.pin, 'r') as fin:
@@ -69,6 +316,39 @@ class LexicalAnnotatorSequence(object):
                 self.annotation_rules[label] = terms
                 n += 1
         fin.close()
+        self.load_patterns(use_cache=use_cache)
+
+    def load_patterns(self, use_cache=True):
+        """
+        Build the pattern documents of each label. Patterns that only depend
+        on the tokenizer are stored as words and spaces in the compiled
+        lexicon cache (see rule_cache), so they can be rebuilt without running
+        the tokenizer at the next start.
+        
+        Arguments:
+            - use_cache: bool; use the compiled lexicon cache.
+        """
+        self.patterns = {}
+        if intify_attr(self.source_attribute) not in TOKENIZER_ATTRIBUTES:
+            for label in self.annotation_rules:
+                self.patterns[label] = make_pattern_docs(self.nlp, self.annotation_rules[label], self.source_attribute)
+            return
+        
+        digest = file_digest(self.pin, LEXICON_FORMAT, get_tokenizer_fingerprint(self.nlp))
+        cache_path = get_cache_path(self.pin, digest, 'lexicon')
+        tokens = load_cache(cache_path) if use_cache else None
+        
+        if tokens is None:
+            tokens = {}
+            for label in self.annotation_rules:
+                docs = make_pattern_docs(self.nlp, self.annotation_rules[label], self.source_attribute)
+                tokens[label] = [([token.text for token in doc], [bool(token.whitespace_) for token in doc]) for doc in docs]
+                self.patterns[label] = docs
+            if use_cache:
+                save_cache(cache_path, tokens)
+        else:
+            for label in tokens:
+                self.patterns[label] = [Doc(self.nlp.vocab, words=words, spaces=spaces) for (words, spaces) in tokens[label]]
 
     def get_labels(self):
         """
@@ -97,174 +377,62 @@ class LexicalAnnotatorSequence(object):
             - self.nlp: spaCy Lang; the loaded spaCy pipeline object with added 
                         annotation rules.
         """
+        for name, component in self.make_components(self.nlp.pipe_names):
+            self.nlp.add_pipe(component, last=True)
+        
+        return self.nlp
+
+    def make_components(self, pipe_names):
+        """
+        Create one component per label, without adding them to the pipeline.
+        
+        Arguments:
+            - pipe_names: list; the names of the components in the pipeline,
+                          to avoid name clashes.
+        
+        Return:
+            - components: list; the (name, component) pairs.
+        """
+        pipe_names = list(pipe_names)
+        components = []
         for label in self.annotation_rules:
             terms = self.annotation_rules[label]
 
             # Avoid component name clashes
             name = 'lex_' + label
-            if name in self.nlp.pipe_names:
+            if name in pipe_names:
                 name += '_'
 
-            if name not in self.nlp.pipe_names:
-                component = LexicalAnnotator(self.nlp, terms, self.source_attribute, self.target_attribute, label, name, merge=self.merge)
-                self.nlp.add_pipe(component, last=True)
+            if name not in pipe_names:
+                component = LexicalAnnotator(self.nlp, terms, self.source_attribute, self.target_attribute, label, name, merge=self.merge, patterns=self.patterns.get(label, None))
+                components.append((name, component))
+                pipe_names.append(name)
             else:
                 print('-- ', name, 'exists already. Component not added.')
         
-        return self.nlp
-
-
-class LexicalAnnotator(object):
-    """
-    Initialises a single new component that annotates tokens accoring to a 
-    terminology list. Match is only performed on textual surface form.
-    """
-    
-    def __init__(self, nlp, terms, source_attribute, target_attribute, label, name, merge=False):
-        self.name = name
-        self.nlp = nlp
-        self.label = label  # get entity label ID
-        self.target_attribute = target_attribute
-        self.merge = merge
+        return components
 
-        patterns = [self.nlp(text) for text in terms] # using make_doc as nlp() causes UseWarning saying that it may be much slower for tokenizer-based attributes (ORTH, LOWER)
-        self.matcher = PhraseMatcher(self.nlp.vocab, attr=source_attribute)
-        self.matcher.add(label, None, *patterns)
-        Token.set_extension(target_attribute, default=False, force=True)
-
-    def __call__(self, doc):
-        matches = self.matcher(doc)
-        matches = self.get_longest_matches(matches)
-        spans = []
-        Token.set_extension('tense', default=False, force=True)
-        for _, start, end in matches:
-            entity = Span(doc, start, end, label=self.nlp.vocab.strings[self.label])
-            spans.append(entity)
-            # Copy tense attribute to entity (for DSH annotator)
-            tense = '_'
-            for token in entity:
-                token._.set(self.target_attribute, self.label)
-                if token.pos_ == 'VERB':
-                    tense = token.tag_
-            for token in entity:
-                token._.set('tense', tense)
-
-            # avoid adding entities twice, but CAREFUL make sure this doesn't stop several annotations being added to the same token sequence
-            if entity not in doc.ents:
-                # check for overlap
-                if self.check_entity_overlap(doc, entity):
-                    doc.ents = list(doc.ents) + [entity]
-                    
-
-        # Merge all entities
-        # TO DO spaCy stores ALL matches so we get 'deliberate' and 'self-harm' annotated separately - fix
-        if self.merge:
-            print('-- Merging spans...', file=sys.stderr)
-            for ent in doc.ents:
-                if ent.label_ == self.label:
-                    ent.merge(lemma=''.join([token.lemma_ + token.whitespace_ for token in ent]).strip())
-
-        return doc
-
-    def check_entity_overlap(self, doc, entity):
-        ent_offsets = [(ent.start, ent.end) for ent in doc.ents]
-        for (start, end) in ent_offsets:
-            # no overlap, no problem
-            if entity.start > end:
-                continue
-            if entity.end < start:
-                continue
-            # overlap - retain the new entity if it is longer
-            if (entity.end - entity.start) > (end - start):
-                #print('-- Replacing entity', ent.start, ent.end, ent, 'with', entity.end, entity.start, entity, file=sys.stderr)
-                new_ents = [ent for ent in doc.ents if ent.start != start and ent.end != end]
-                doc.ents = new_ents
-                return True
-            if (entity.end - entity.start) == (end - start):
-                print('-- Warning: exactly overlapping entities:', entity.end, entity.start, entity, '&', start, end, doc[start:end], file=sys.stderr)
-        return False
+    def add_to_component(self, component):
+        """
+        Add the lexicon to a combined lexical annotator instead of adding one
+        pipeline component per label. Each label is added under the name its
+        own component would have had.
         
-
-    def get_longest_matches(self, matches):
+        Arguments:
+            - component: CombinedLexicalAnnotator; the combined annotator.
         """
-        Remove all shortest matching overlapping spans.
-        :return: matches list of all longest matches only
-        """
-        offsets = [(match[1], match[2]) for match in matches]
-        overlaps = {}
-        for offset in offsets:
-            o = [(i[0], i[1]) for i in offsets if i[0] >= offset[0] and 
-                 i[0] <= offset[1] or i[1] >= offset[0] and 
-                 i[1] <= offset[1] if (i[0], i[1]) != offset and
-                 (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-            if len(o) > 0:
-                overlaps[offset] = o
-            
-        overlapping_spans = [[k] + v for (k, v) in overlaps.items()]
-        for os in overlapping_spans:
-            longest_span = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[0]
-            for match in matches:
-                start, end = match[1], match[2]
-                # if it's not the longest match then chuck it out
-                if (start, end) in os and (start != longest_span[0] or end != longest_span[1]):
-                    matches.remove(match)
-            
-        return matches
-
-
-class LemmaAnnotatorSequence(object):
-    """
-    Creates a set of new pipeline components that annotate tokens accoring to
-    a terminology list. Match is only performed on token lemma.
-    """
-    def __init__(self, nlp, pin, attribute, ignore_case=True, merge=False):
-        self.nlp = nlp
-        self.pin = pin
-        self.attribute = attribute
-        self.annotation_rules = {}
-        self.ignore_case = ignore_case
-        self.merge = merge
-
-    def load_lexicon(self):
-        n = 1
-        with open(self.pin, 'r') as fin:
-            for line in fin:
-                if line.startswith('#'):
-                    continue
-                try:
-                    term, label = line.split('\t')
-                except Exception as e:
-                    raise ValueError('-- Error: syntax error in rule file ' + self.pin + ' at line', n)
-                term = term.strip()
-                label = label.strip()
-                terms = self.annotation_rules.get(label, [])
-                terms.append(term)
-                self.annotation_rules[label] = terms
-                n += 1
-        fin.close()
-
-    def get_labels(self):
-        return self.annotation_rules.keys()
-
-    def get_annotation_rules(self):
-        return self.annotation_rules
-
-    def add_components(self):
         for label in self.annotation_rules:
-            lemma_sequences = self.annotation_rules[label]
+            terms = self.annotation_rules[label]
 
-            # Avoid component name clashes
-            name = 'lex_' + label
-            if name in self.nlp.pipe_names:
-                name += '_'
+            # Avoid key clashes, as for component names
+            key = 'lex_' + label
+            if key in component.keys:
+                key += '_'
 
-            if name not in self.nlp.pipe_names:
-                component = LemmaAnnotator(self.nlp, lemma_sequences, self.attribute, label, name, merge=self.merge)
-                self.nlp.add_pipe(component, last=True)
+            if key not in component.keys:
+                component.add_terms(key, terms, self.source_attribute, self.target_attribute, label, patterns=self.patterns.get(label, None))
             else:
-                print('-- ', name, 'exists already. Component not added.')
-        
-        return self.nlp
+                print('-- ', key, 'exists already. Lexicon not added.')
 
 
 class LexicalAnnotator(object):
@@ -275,7 +443,7 @@ class LexicalAnnotator(object):
     accoring to a word list. Match is only performed on textual surface form.
     """
     
-    def __init__(self, nlp, terms, source_attribute, target_attribute, label, name, merge=False):
+    def __init__(self, nlp, terms, source_attribute, target_attribute, label, name, merge=False, patterns=None):
         """
         Create a new LexicalAnnotator instance.
         
@@ -289,6 +457,8 @@ class LexicalAnnotator(object):
             - label: str; the label to add to the tokens' target attribute.
             - name: str; the name of the pipeline component.
             - merge: bool; merge annotated spans into a single span.
+            - patterns: list; the pattern documents of the terms, if already
+              built (see LexicalAnnotatorSequence.load_patterns()).
         """
         self.name = name
         self.nlp = nlp
@@ -296,101 +466,221 @@ class LexicalAnnotator(object):
         self.target_attribute = target_attribute
         self.merge = merge
 
-        patterns = [self.nlp(text) for text in terms] # using make_doc as nlp() causes UseWarning saying that it may be much slower for tokenizer-based attributes (ORTH, LOWER)
+        if patterns is None:
+            patterns = make_pattern_docs(self.nlp, terms, source_attribute)
         self.matcher = PhraseMatcher(self.nlp.vocab, attr=source_attribute)
         self.matcher.add(label, None, *patterns)
-        Token.set_extension(target_attribute, default=False, force=True)
+        register_bitset(target_attribute)
+        register_extension('tense')
 
     def __call__(self, doc):
         matches = self.matcher(doc)
         matches = self.get_longest_matches(matches)
-        spans = []
-        Token.set_extension('tense', default=False, force=True)
-        for _, start, end in matches:
-            entity = Span(doc, start, end, label=self.nlp.vocab.strings[self.label])
-            spans.append(entity)
-            # Copy tense attribute to entity (for DSH annotator)
-            tense = '_'
-            for token in entity:
-                token._.set(self.target_attribute, self.label)
-                if token.pos_ == 'VERB':
-                    tense = token.tag_
-            for token in entity:
-                token._.set('tense', tense)
-
-            # avoid adding entities twice, but CAREFUL make sure this doesn't stop several annotations being added to the same token sequence
-            if entity not in doc.ents:
-                # check for overlap
-                if self.check_entity_overlap(doc, entity):
-                    doc.ents = list(doc.ents) + [entity]
+        add_lexical_annotations(doc, matches, self.target_attribute, self.label)
+        label = self.nlp.vocab.strings[self.label]
+        add_entities(doc, [Span(doc, start, end, label=label) for _, start, end in matches])
 
         # Merge all entities
         # TO DO spaCy stores ALL matches so we get 'deliberate' and 'self-harm' annotated separately - fix
         if self.merge:
-            print('-- Merging spans...', file=sys.stderr)
+            get_tracer().debug('merge_spans', '-- Merging spans...', annotator=self.name)
             for ent in doc.ents:
                 if ent.label_ == self.label:
                     ent.merge(lemma=''.join([token.lemma_ + token.whitespace_ for token in ent]).strip())
+            get_store(doc)
 
         return doc
 
-    def check_entity_overlap(self, doc, entity):
+    def get_longest_matches(self, matches):
         """
-        Check the document for overlapping entities.
+        Remove all shortest matching overlapping spans (see get_longest_matches()).
+        """
+        return get_longest_matches(matches)
+
+
+class CombinedLexicalAnnotator(object):
+    """
+    Combined Lexical Annotator
+    
+    A single spaCy pipeline component that annotates tokens according to
+    several word lists and labels. All terms matched on the same token
+    attribute share one PhraseMatcher, so each document is scanned once per
+    source attribute instead of once per label. The lexicons are applied in
+    the order they were added, with the same token annotations as a sequence
+    of LexicalAnnotator components, and the entities of all labels are added
+    in a single step. Single-token terms are lexeme flags, read in one pass
+    over the tokens, so only multi-token terms are phrase matched. Very large
+    lexicons can be added as memory-mapped stores (see lexicon_store and
+    add_store()).
+    NOTE: spans are not merged, as merging would shift the offsets of the
+    matches of the following labels. Lexicons that merge spans must be added
+    with LexicalAnnotatorSequence.add_components().
+    """
+    
+    def __init__(self, nlp, name='lexical_annotator'):
+        """
+        Create a new CombinedLexicalAnnotator instance.
         
         Arguments:
-            - doc: spaCy Doc; a spaCy document instance.
-            - entity: spaCy Span; an entity span to check for overlap.
-        
-        Return: bool; True if entities are foudn that overlap with entity, else False
+            - nlp: spaCy Language; a spaCy text processing pipeline instance.
+            - name: str; the name of the pipeline component.
         """
-        ent_offsets = [(ent.start, ent.end) for ent in doc.ents]
-        for (start, end) in ent_offsets:
-            # no overlap, no problem
-            if entity.start > end:
-                continue
-            if entity.end < start:
+        self.name = name
+        self.nlp = nlp
+        self.vocab = nlp.vocab
+        self.matchers = {}
+        self.keys = []
+        self.key_ids = {}
+        self.target_attributes = {}
+        self.labels = {}
+        self.stores = []
+        self.flag_ids = []
+        self.flag_keys = []
+        self.flag_terms = []
+        register_extension('tense')
+
+    def __getstate__(self):
+        # the pipeline is not pickled, so terms can only be added before
+        state = dict(self.__dict__)
+        state.pop('nlp', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.nlp = None
+        # flags are registered per vocabulary, e.g. a vocabulary loaded from
+        # disk, and the terms of a key without a free flag are phrase matched
+        flags = zip(self.flag_ids, self.flag_keys, self.flag_terms)
+        self.flag_ids = []
+        self.flag_keys = []
+        self.flag_terms = []
+        for _, key, (attr, values) in flags:
+            flag_id = get_lexeme_flag(self.vocab, attr, values)
+            if flag_id is None:
+                self.add_phrase_patterns(key, attr, [Doc(self.vocab, words=[value]) for value in sorted(values)])
                 continue
-            # overlap - retain the new entity if it is longer
-            if (entity.end - entity.start) > (end - start):
-                #print('-- Replacing entity', ent.start, ent.end, ent, 'with', entity.end, entity.start, entity, file=sys.stderr)
-                new_ents = [ent for ent in doc.ents if ent.start != start and ent.end != end]
-                doc.ents = new_ents
-                return True
-            if (entity.end - entity.start) == (end - start):
-                print('-- Warning: exactly overlapping entities:', entity.end, entity.start, entity, '&', start, end, doc[start:end], file=sys.stderr)
-        return False
+            self.flag_ids.append(flag_id)
+            self.flag_keys.append(key)
+            self.flag_terms.append((attr, values))
+        for target_attribute in set(self.target_attributes.values()):
+            register_bitset(target_attribute)
+        register_extension('tense')
 
-    def get_longest_matches(self, matches):
+    def add_terms(self, key, terms, source_attribute, target_attribute, label, patterns=None):
         """
-        Remove all shortest matching overlapping spans.
+        Add the terms of a label.
+        
+        Arguments:
+            - key: str; the unique key of the terms (e.g. lex_INTERNET).
+            - terms: list; the terms to be annotated.
+            - source_attribute: spaCy symbol; the token attribute to match
+              on (e.g. LOWER).
+            - target_attribute: str; the custom attribute to add the label to.
+            - label: str; the label to add to the tokens' target attribute.
+            - patterns: list; the pattern documents of the terms, if already
+              built (see LexicalAnnotatorSequence.load_patterns()).
+        
+        Single-token terms matched on ORTH or LOWER are registered as a
+        lexeme flag (see get_lexeme_flag()), so they are read from the tokens'
+        lexemes instead of being phrase matched.
+        """
+        if patterns is None:
+            patterns = make_pattern_docs(self.nlp, terms, source_attribute)
+        if intify_attr(source_attribute) in FLAG_ATTRIBUTES:
+            lower = intify_attr(source_attribute) == LOWER
+            values = [doc[0].lower_ if lower else doc[0].orth_ for doc in patterns if len(doc) == 1]
+            flag_id = get_lexeme_flag(self.vocab, source_attribute, values) if len(values) > 0 else None
+            if flag_id is not None:
+                self.flag_ids.append(flag_id)
+                self.flag_keys.append(key)
+                self.flag_terms.append((intify_attr(source_attribute), frozenset(values)))
+                patterns = [doc for doc in patterns if len(doc) != 1]
+        if len(patterns) > 0:
+            self.add_phrase_patterns(key, source_attribute, patterns)
+        self.keys.append(key)
+        self.key_ids[self.vocab.strings.add(key)] = key
+        self.target_attributes[key] = target_attribute
+        self.labels[key] = label
+        register_bitset(target_attribute)
+
+    @property
+    def vocab_flag_keys(self):
+        """
+        The keys of the vocabulary flags of the single-token terms, which are
+        released when the lexicons are reloaded.
+        """
+        return set(get_lexeme_flag_key(attr, values) for attr, values in self.flag_terms)
+
+    def add_phrase_patterns(self, key, source_attribute, patterns):
+        """
+        Add the pattern documents of a key to the PhraseMatcher of its source
+        attribute.
         
         Arguments:
-            - matches: list; a list of matched entities.
+            - key: str; the unique key of the terms.
+            - source_attribute: spaCy symbol; the token attribute to match on.
+            - patterns: list; the pattern documents.
+        """
+        for attr, matcher in self.matchers.items():
+            if intify_attr(attr) == intify_attr(source_attribute):
+                break
+        else:
+            matcher = PhraseMatcher(self.vocab, attr=source_attribute)
+            self.matchers[source_attribute] = matcher
+        matcher.add(key, None, *patterns)
+
+    def add_store(self, store, target_attribute):
+        """
+        Add the labels of a compiled lexicon store (see lexicon_store). Each
+        label is added under the key its terms would have had.
         
-        Return:
-            - matches: list; all longest matches only.
-        """
-        offsets = [(match[1], match[2]) for match in matches]
-        overlaps = {}
-        for offset in offsets:
-            o = [(i[0], i[1]) for i in offsets if i[0] >= offset[0] and 
-                 i[0] <= offset[1] or i[1] >= offset[0] and 
-                 i[1] <= offset[1] if (i[0], i[1]) != offset and
-                 (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-            if len(o) > 0:
-                overlaps[offset] = o
-            
-        overlapping_spans = [[k] + v for (k, v) in overlaps.items()]
-        for os in overlapping_spans:
-            longest_span = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[0]
-            for match in matches:
-                start, end = match[1], match[2]
-                # if it's not the longest match then chuck it out
-                if (start, end) in os and (start != longest_span[0] or end != longest_span[1]):
-                    matches.remove(match)
-            
-        return matches
+        Arguments:
+            - store: LexiconStore; the memory-mapped lexicon.
+            - target_attribute: str; the custom attribute to add the labels to.
+        """
+        keys = []
+        for label in store.labels:
+            key = 'lex_' + label
+            while key in self.keys:
+                key += '_'
+            self.keys.append(key)
+            self.key_ids[self.vocab.strings.add(key)] = key
+            self.target_attributes[key] = target_attribute
+            self.labels[key] = label
+            keys.append(key)
+        self.stores.append((store, keys))
+        register_bitset(target_attribute)
+
+    def __call__(self, doc):
+        key_matches = {}
+        for matcher in self.matchers.values():
+            for match in matcher(doc):
+                key_matches.setdefault(self.key_ids[match[0]], []).append(match)
+        if len(self.flag_ids) > 0 and len(doc) > 0:
+            flags = doc.to_array(self.flag_ids).reshape((len(doc), len(self.flag_ids)))
+            for j, key in enumerate(self.flag_keys):
+                key_id = self.vocab.strings[key]
+                matches = [(key_id, i, i + 1) for i in np.nonzero(flags[:, j])[0].tolist()]
+                if len(matches) > 0:
+                    key_matches.setdefault(key, []).extend(matches)
+        for store, keys in self.stores:
+            for label_index, start, end in store.match(doc):
+                key = keys[label_index]
+                key_matches.setdefault(key, []).append((self.vocab.strings[key], start, end))
+        
+        entities = []
+        for key in self.keys:
+            matches = key_matches.get(key, None)
+            if matches is None:
+                continue
+            label = self.labels[key]
+            matches = get_longest_matches(matches)
+            add_lexical_annotations(doc, matches, self.target_attributes[key], label)
+            label = self.vocab.strings[label]
+            entities.extend([Span(doc, start, end, label=label) for _, start, end in matches])
+        add_entities(doc, entities)
+
+        return doc
 
 
 class LemmaAnnotatorSequence(object):
@@ -467,21 +757,63 @@ class LemmaAnnotatorSequence(object):
             - self.nlp: spaCy Lang; the loaded spaCy pipeline object with added 
                         annotation rules
         """
+        for name, component in self.make_components(self.nlp.pipe_names):
+            self.nlp.add_pipe(component, last=True)
+        
+        return self.nlp
+
+    def make_components(self, pipe_names):
+        """
+        Create one component per label, without adding them to the pipeline.
+        
+        Arguments:
+            - pipe_names: list; the names of the components in the pipeline,
+                          to avoid name clashes.
+        
+        Return:
+            - components: list; the (name, component) pairs.
+        """
+        pipe_names = list(pipe_names)
+        components = []
         for label in self.annotation_rules:
             lemma_sequences = self.annotation_rules[label]
 
             # Avoid component name clashes
             name = 'lex_' + label
-            if name in self.nlp.pipe_names:
+            if name in pipe_names:
                 name += '_'
 
-            if name not in self.nlp.pipe_names:
+            if name not in pipe_names:
                 component = LemmaAnnotator(self.nlp, lemma_sequences, self.attribute, label, name, merge=self.merge)
-                self.nlp.add_pipe(component, last=True)
+                components.append((name, component))
+                pipe_names.append(name)
             else:
                 print('-- ', name, 'exists already. Component not added.')
         
-        return self.nlp
+        return components
+
+    def add_to_component(self, component):
+        """
+        Add the lexicon to a combined lexical annotator instead of adding one
+        pipeline component per label (see
+        LexicalAnnotatorSequence.add_to_component()).
+        
+        Arguments:
+            - component: CombinedLexicalAnnotator; the combined annotator.
+        """
+        for label in self.annotation_rules:
+            lemma_sequences = self.annotation_rules[label]
+
+            # Avoid key clashes, as for component names
+            key = 'lex_' + label
+            if key in component.keys:
+                key += '_'
+
+            if key not in component.keys:
+                patterns = make_lemma_pattern_docs(self.nlp.vocab, lemma_sequences)
+                component.add_terms(key, lemma_sequences, LEMMA, self.attribute, label, patterns=patterns)
+            else:
+                print('-- ', key, 'exists already. Lexicon not added.')
 
 
 class LemmaAnnotator(object):
@@ -509,108 +841,39 @@ class LemmaAnnotator(object):
         self.nlp = nlp
         self.label = label
         self.attribute = attribute
-        self.matcher = Matcher(self.nlp.vocab)
         self.merge = merge
 
-        # Build patterns from sequences of lemmas read from the lexicon file
-        for lemmas in lemma_sequences:
-            pattern = []
-            for lemma in lemmas.split():
-                pattern.append({LEMMA: lemma})
-            self.matcher.add(label, None, pattern)
+        # Index the sequences of lemmas read from the lexicon file by their
+        # lemma IDs, so the matching cost does not grow with the lexicon size
+        self.matcher = PhraseMatcher(self.nlp.vocab, attr=LEMMA)
+        self.matcher.add(label, None, *make_lemma_pattern_docs(self.nlp.vocab, lemma_sequences))
 
-        Token.set_extension(attribute, default=False, force=True)
+        register_bitset(attribute)
+        register_extension('tense')
         
     def __call__(self, doc):
         matches = self.matcher(doc)
         matches = self.get_longest_matches(matches)
-        spans = []
-        Token.set_extension('tense', default=False, force=True)
-        for _, start, end in matches:
-            entity = Span(doc, start, end, label=self.nlp.vocab.strings[self.label])
-            spans.append(entity)
-            # Copy tense attribute to entity (for DSH annotator)
-            tense = '_'
-            for token in entity:
-                token._.set(self.attribute, self.label)
-                if token.pos_ == 'VERB':
-                    tense = token.tag_
-            for token in entity:
-                token._.set('tense', tense)
-
-            # avoid adding entities twice, but CAREFUL make sure this doesn't stop several annotations being added to the same token sequence
-            if entity not in doc.ents:
-                # check for overlap
-                if self.check_entity_overlap(doc, entity):
-                    doc.ents = list(doc.ents) + [entity]
+        add_lexical_annotations(doc, matches, self.attribute, self.label)
+        label = self.nlp.vocab.strings[self.label]
+        add_entities(doc, [Span(doc, start, end, label=label) for _, start, end in matches])
 
         # Merge all entities
         # TO DO spaCy stores ALL matches so we get 'deliberate' and 'self-harm' annotated separately - fix
         if self.merge:
-            print('-- Merging spans...', file=sys.stderr)
+            get_tracer().debug('merge_spans', '-- Merging spans...', annotator=self.name)
             for ent in doc.ents:
                 if ent.label_ == self.label:
                     ent.merge(lemma=''.join([token.lemma_ + token.whitespace_ for token in ent]).strip())
+            get_store(doc)
 
         return doc
 
-    def check_entity_overlap(self, doc, entity):
-        """
-        Check the document for overlapping entities.
-        
-        Arguments:
-            - doc: spaCy Doc; a spaCy document instance.
-            - entity: spaCy Span; an entity span to check for overlap.
-        
-        Return: bool; True if entities are foudn that overlap with entity, else False
-        """
-        ent_offsets = [(ent.start, ent.end) for ent in doc.ents]
-        for (start, end) in ent_offsets:
-            # no overlap, no problem
-            if entity.start > end:
-                continue
-            if entity.end < start:
-                continue
-            # overlap - retain the new entity if it is longer
-            if (entity.end - entity.start) > (end - start):
-                #print('-- Replacing entity', ent.start, ent.end, ent, 'with', entity.end, entity.start, entity, file=sys.stderr)
-                new_ents = [ent for ent in doc.ents if ent.start != start and ent.end != end]
-                doc.ents = new_ents
-                return True
-            if (entity.end - entity.start) == (end - start):
-                print('-- Warning: exactly overlapping entities:', entity.end, entity.start, entity, '&', start, end, doc[start:end], file=sys.stderr)
-        return False
-
     def get_longest_matches(self, matches):
         """
-        Remove all shortest matching overlapping spans.
-        
-        Arguments:
-            - matches: list; a list of matched entities.
-        
-        Return:
-            - matches: list; all longest matches only.
-        """
-        offsets = [(match[1], match[2]) for match in matches]
-        overlaps = {}
-        for offset in offsets:
-            o = [(i[0], i[1]) for i in offsets if i[0] >= offset[0] and 
-                 i[0] <= offset[1] or i[1] >= offset[0] and 
-                 i[1] <= offset[1] if (i[0], i[1]) != offset and
-                 (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-            if len(o) > 0:
-                overlaps[offset] = o
-            
-        overlapping_spans = [[k] + v for (k, v) in overlaps.items()]
-        for os in overlapping_spans:
-            longest_span = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[0]
-            for match in matches:
-                start, end = match[1], match[2]
-                # if it's not the longest match then chuck it out
-                if (start, end) in os and (start != longest_span[0] or end != longest_span[1]):
-                    matches.remove(match)
-            
-        return matches
+        Remove all shortest matching overlapping spans (see get_longest_matches()).
+        """
+        return get_longest_matches(matches)
 
 
 class TokenSequenceAnnotatorSequence(object):
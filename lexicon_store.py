@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+    Lexicon Store
+
+    Compiled, memory-mapped lexicons for very large terminologies (e.g. lists
+    of app, game or website names). Instead of holding the terms as Python
+    strings and PhraseMatcher patterns in every process, a lexicon is compiled
+    once into a directory of NumPy arrays next to the lexicon file (see
+    rule_cache):
+
+        - hashes.npy: the sorted 64-bit key of each term, a polynomial hash of
+                      the IDs of its tokens' match attribute (e.g. LOWER);
+        - labels.npy: the label index of each term;
+        - meta.json: the labels, the match attribute and the maximum term
+                     length;
+        - keywords.json: the longest token of the terms of each label, only
+                         read to build the keyword gate (see keyword_gate).
+
+    The arrays are memory-mapped read-only, so loading a store takes a few
+    milliseconds and all worker processes share the same pages. A document is
+    matched by hashing its n-grams (up to the maximum term length) and looking
+    them up in the sorted keys with a binary search. Token IDs are the hashes
+    of the spaCy StringStore, so the keys do not depend on the process. The
+    tokenizer fingerprint is part of the store digest, as the terms are
+    tokenized when the store is compiled. The stores compiled from earlier
+    versions of a lexicon are removed when a new one is compiled.
+"""
+
+import json
+import numpy as np
+import os
+import shutil
+import sys
+
+from lexical_annotator import TOKENIZER_ATTRIBUTES, get_tokenizer_fingerprint
+from rule_cache import file_digest, get_cache_path, remove_stale_cache
+from spacy.attrs import intify_attr
+
+# Version of the compiled lexicon store format
+STORE_FORMAT = 1
+# Multiplier of the polynomial term hash
+HASH_MULTIPLIER = np.uint64(0x100000001B3)
+# Number of terms tokenized at a time when compiling a store
+COMPILE_BATCH_SIZE = 10000
+
+
+def get_ngram_keys(ids, n):
+    """
+    Compute the key of each n-gram of a token ID sequence. The key includes n,
+    so that n-grams of different lengths have different keys.
+
+    Arguments:
+        - ids: numpy array; the token IDs (uint64).
+        - n: int; the n-gram length.
+
+    Return:
+        - keys: numpy array; the key of the n-gram starting at each position
+                (len(ids) - n + 1 keys).
+    """
+    keys = ids[:len(ids) - n + 1].copy()
+    for i in range(1, n):
+        keys *= HASH_MULTIPLIER
+        keys += ids[i:len(ids) - n + 1 + i]
+    keys *= HASH_MULTIPLIER
+    keys += np.uint64(n)
+    return keys
+
+
+def read_lexicon(path):
+    """
+    Read the terms and labels of a lexicon file, one tab-separated term and
+    label per line.
+
+    Arguments:
+        - path: str; the path to the lexicon file.
+
+    Return:
+        - entries: generator; the (term, label) pairs.
+    """
+    with open(path, 'r') as fin:
+        for n, line in enumerate(fin, 1):
+            try:
+                term, label = line.split('\t')
+            except Exception as e:
+                print('-- Warning: syntax error in rule file ' + path + ' at line', n, file=sys.stderr)
+                print(e, file=sys.stderr)
+                continue
+            yield term.strip(), label.strip()
+
+
+def get_store_digest(nlp, path, source_attribute):
+    """
+    Compute the digest of the compiled store of a lexicon.
+
+    Arguments:
+        - nlp: spaCy Language; a spaCy text processing pipeline instance.
+        - path: str; the path to the lexicon file.
+        - source_attribute: spaCy symbol; the token attribute to match on.
+
+    Return:
+        - digest: str; the hexadecimal SHA-1 digest.
+    """
+    return file_digest(path, STORE_FORMAT, intify_attr(source_attribute), get_tokenizer_fingerprint(nlp))
+
+
+def compile_lexicon(nlp, path, source_attribute, store_path):
+    """
+    Compile a lexicon file into a store. The store is written to a temporary
+    directory first and then renamed, so that concurrent processes never read
+    a partially written store.
+
+    Arguments:
+        - nlp: spaCy Language; a spaCy text processing pipeline instance.
+        - path: str; the path to the lexicon file.
+        - source_attribute: spaCy symbol; the token attribute to match on. It
+                            must be set by the tokenizer (e.g. LOWER).
+        - store_path: str; the path to the store directory.
+    """
+    attr = intify_attr(source_attribute)
+    labels = []
+    label_indices = {}
+    keys = []
+    label_ids = []
+    keywords = {}
+    max_length = 0
+
+    def compile_batch(batch):
+        nonlocal max_length
+        for (term, label), doc in zip(batch, nlp.tokenizer.pipe([term for term, _ in batch])):
+            if len(doc) == 0:
+                continue
+            if label not in label_indices:
+                label_indices[label] = len(labels)
+                labels.append(label)
+                keywords[label] = set()
+            ids = doc.to_array([attr]).astype('uint64').reshape(-1)
+            keys.append(get_ngram_keys(ids, len(doc))[0])
+            label_ids.append(label_indices[label])
+            keywords[label].add(max((token.text for token in doc), key=len).lower())
+            max_length = max(max_length, len(doc))
+
+    batch = []
+    for entry in read_lexicon(path):
+        batch.append(entry)
+        if len(batch) >= COMPILE_BATCH_SIZE:
+            compile_batch(batch)
+            batch = []
+    compile_batch(batch)
+
+    keys = np.array(keys, dtype='uint64')
+    label_ids = np.array(label_ids, dtype='uint32')
+    order = np.argsort(keys, kind='stable')
+
+    tmp_path = store_path + '.' + str(os.getpid()) + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'hashes.npy'), keys[order])
+    np.save(os.path.join(tmp_path, 'labels.npy'), label_ids[order])
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as fout:
+        json.dump({'format': STORE_FORMAT, 'labels': labels, 'attribute': attr, 'max_length': max_length}, fout)
+    with open(os.path.join(tmp_path, 'keywords.json'), 'w', encoding='utf-8') as fout:
+        json.dump({label: sorted(keywords[label]) for label in labels}, fout)
+    try:
+        os.replace(tmp_path, store_path)
+    except OSError:
+        # another process has written the same store
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class LexiconStore(object):
+    """
+    Lexicon Store
+
+    Read-only view on a compiled lexicon.
+    """
+
+    def __init__(self, store_path):
+        """
+        Open a compiled lexicon store.
+
+        Arguments:
+            - store_path: str; the path to the store directory (see
+                          compile_lexicon()).
+        """
+        self.path = store_path
+        with open(os.path.join(store_path, 'meta.json'), 'r', encoding='utf-8') as fin:
+            meta = json.load(fin)
+        if meta['format'] != STORE_FORMAT:
+            raise ValueError('-- Error: unsupported lexicon store format: ' + store_path)
+        self.labels = meta['labels']
+        self.attribute = meta['attribute']
+        self.max_length = meta['max_length']
+        self.hashes = np.load(os.path.join(store_path, 'hashes.npy'), mmap_mode='r')
+        self.label_ids = np.load(os.path.join(store_path, 'labels.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __getstate__(self):
+        # the arrays are mapped again rather than copied
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def match(self, doc):
+        """
+        Find the terms of the lexicon in a document.
+
+        Arguments:
+            - doc: spaCy Doc; a spaCy document instance.
+
+        Return:
+            - matches: list; (label index, start, end) tuples.
+        """
+        matches = []
+        if len(doc) == 0 or len(self.hashes) == 0:
+            return matches
+        ids = doc.to_array([self.attribute]).astype('uint64').reshape(-1)
+        for n in range(1, min(self.max_length, len(doc)) + 1):
+            keys = get_ngram_keys(ids, n)
+            lower = np.searchsorted(self.hashes, keys, side='left')
+            found = np.nonzero(lower < len(self.hashes))[0]
+            found = found[self.hashes[lower[found]] == keys[found]]
+            if len(found) == 0:
+                continue
+            upper = np.searchsorted(self.hashes, keys[found], side='right')
+            for start, first, last in zip(found.tolist(), lower[found].tolist(), upper.tolist()):
+                for j in range(first, last):
+                    matches.append((int(self.label_ids[j]), start, start + n))
+        return matches
+
+    def get_keywords(self):
+        """
+        Get the keywords of the terms of each label (see keyword_gate).
+
+        Return:
+            - keywords: dict; the keywords of each label.
+        """
+        with open(os.path.join(self.path, 'keywords.json'), 'r', encoding='utf-8') as fin:
+            return {label: set(keywords) for (label, keywords) in json.load(fin).items()}
+
+
+def load_lexicon_store(nlp, path, source_attribute, use_cache=True):
+    """
+    Open the compiled store of a lexicon, compiling it first if the lexicon
+    file or the tokenizer have changed.
+
+    Arguments:
+        - nlp: spaCy Language; a spaCy text processing pipeline instance.
+        - path: str; the path to the lexicon file.
+        - source_attribute: spaCy symbol; the token attribute to match on.
+        - use_cache: bool; reuse an existing store.
+
+    Return:
+        - store: LexiconStore; the lexicon store.
+    """
+    if intify_attr(source_attribute) not in TOKENIZER_ATTRIBUTES:
+        raise ValueError('-- Error: lexicon stores can only match on attributes set by the tokenizer: ' + path)
+    store_path = get_cache_path(path, get_store_digest(nlp, path, source_attribute), 'lexicon_store', ext='')
+    if not use_cache or not os.path.isdir(store_path):
+        if os.path.isdir(store_path):
+            shutil.rmtree(store_path, ignore_errors=True)
+        print('-- Compiling lexicon store:', path, file=sys.stderr)
+        compile_lexicon(nlp, path, source_attribute, store_path)
+        remove_stale_cache(store_path)
+    return LexiconStore(store_path)
@@ -15,24 +15,59 @@
 """
 
 import argparse
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
+import numpy as np
 import os
+import pickle
 import re
 import spacy
 import sys
+import threading
+import time
+import traceback
 import xml.etree.ElementTree as ET
 
+from annotation_store import get_store, get_token_attributes, get_token_starts, register_extension
+from corpus_stream import get_peak_rss, open_sink, open_source
 from datetime import datetime
+from doc_cache import DocCache
+from keyword_gate import build_keyword_gate, get_term_keywords
+from lexical_annotator import CombinedLexicalAnnotator
 from lexical_annotator import LexicalAnnotatorSequence
 from lexical_annotator import LemmaAnnotatorSequence
-from token_sequence_annotator import TokenSequenceAnnotator
+from lexicon_store import load_lexicon_store
+from token_sequence_annotator import TokenSequenceAnnotator, get_rule_length
+from trace_sink import DEBUG, get_tracer
+from vocab_flags import release_vocab_flags
 from detokenizer import Detokenizer
 from online_activity_file_sampler_with_cats import remove_unwanted_patterns
-from spacy.symbols import LEMMA, LOWER
+from rule_cache import file_digest
+from spacy.symbols import IS_SPACE, LEMMA, LOWER, ORTH
+from spacy.tokens import Doc
 from xml.dom.minidom import parseString
 from xml.parsers.expat import ExpatError
 
 from examples.test_examples import text
 
+# Version of the format of pipelines written by OnlineActivityAnnotator.to_disk()
+PIPELINE_FORMAT = 1
+# Number of tokens on each side of a token that the tagger uses to tag it
+# (the depth of the convolutional layers of en_core_web_sm)
+TAGGER_CONTEXT = 4
+# Tokens that end a sentence for windowed tagging (with whitespace tokens)
+SENTENCE_PUNCTUATION = ['.', '!', '?']
+# Maximum number of characters of a chunk of a very long text
+CHUNK_SIZE = 100000
+# Number of characters shared by consecutive chunks
+CHUNK_OVERLAP = 2000
+# Number of chunks annotated at a time
+CHUNK_BATCH_SIZE = 4
+
 
 class OnlineActivityAnnotator:
     """
@@ -42,17 +77,31 @@ class OnlineActivityAnnotator:
     social media) in clinical texts.
     """
     
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, profile=False, staged=False, doc_cache=None, gate=False, lexicons=None, windowed=False):
         """
         Create a new OnlineActivityAnnotator instance.
         
         Arguments:
-            - verbose: bool; print all messages.
+            - verbose: bool; trace all messages (sets the shared tracer to
+                       DEBUG, see trace_sink).
+            - profile: bool; record the cost and hit rate of each token
+                       sequence rule (see get_rule_profiler()).
+            - staged: bool; match token sequence rules at the earliest
+                      pipeline stage their attributes are available.
+            - doc_cache: str; the path to a tagged document cache (see
+                         open_doc_cache()).
+            - gate: bool; skip the pipeline for texts that contain none of
+                    the keywords of the rules (see build_keyword_gate()).
+                    Check its recall on the corpus first (see
+                    audit_keyword_gate()).
+            - lexicons: list; the paths to additional (large) lexicons that
+                        add LA labels, loaded as memory-mapped stores.
+            - windowed: bool; only tag the tokens around the keywords of the
+                        rules (see WindowedTagger).
         """
         print('Online Activity Annotator')
+        self.init_settings(verbose, profile, staged, doc_cache, gate, lexicons, windowed)
         self.nlp = spacy.load('en_core_web_sm', disable=['ner', 'parser'])
-        self.text = None
-        self.verbose = verbose
         
         # initialise
         # Load pronoun lemma corrector
@@ -65,19 +114,180 @@ class OnlineActivityAnnotator:
         self.load_detokenizer(os.path.join('..', 'dsh_annotator', 'resources', 'detokenization_rules.txt'))
         self.load_detokenizer(os.path.join('resources', 'detokenization_rules_smig.txt'))
 
+        # The output of the pipeline up to here only depends on the text
+        self.base_pipe_names = list(self.nlp.pipe_names)
+        if doc_cache is not None:
+            self.open_doc_cache(doc_cache)
+
         # Load lexical annotators
         self.load_lexicon('./resources/social_media_lex.txt', LOWER, 'LA')
         self.load_lexicon('./resources/internet_lex.txt', LOWER, 'LA')
         self.load_lexicon('./resources/online_gaming_lex.txt', LOWER, 'LA')
         self.load_lexicon('./resources/health_website_lex.txt', LOWER, 'LA')
+        for path in lexicons or []:
+            self.load_lexicon(path, LOWER, 'LA', mapped=True)
 
         # Load token sequence annotators
         self.load_token_sequence_annotator('level0')
 
+        # Record the rule version in each document
+        self.nlp.add_pipe(RuleVersionStamp(self.get_rule_version()), last=True)
+
+        if gate:
+            self.keyword_gate = self.build_keyword_gate()
+
+        if self.windowed:
+            self.enable_windowed_tagging()
+
         print('-- Pipeline:', file=sys.stderr)
         print('  -- ' + '\n  -- '.join(self.nlp.pipe_names), file=sys.stderr)
 
-    def load_lexicon(self, path, source_attribute, target_attribute, merge=False):
+    def init_settings(self, verbose, profile, staged, doc_cache, gate, lexicons, windowed=False):
+        """
+        Initialise the settings and state of the annotator, before the
+        pipeline is created (see __init__() for the arguments).
+        """
+        self.text = None
+        self.verbose = verbose
+        self.tracer = get_tracer()
+        if verbose:
+            self.tracer.set_level(DEBUG)
+        self.profile = profile
+        self.staged = staged
+        self.detokenization_rules = []
+        self.doc_cache = None
+        self.lexicons = []
+        self.lexical_pipe_names = []
+        self.token_sequence_annotators = []
+        self.reload_lock = threading.Lock()
+        self.watcher = None
+        self.keyword_gate = None
+        self.pool = None
+        # tagged documents are cached, so they must not depend on the rules
+        self.windowed = windowed and doc_cache is None
+        if windowed and doc_cache is not None:
+            print('-- Warning: windowed tagging is disabled with a tagged document cache.', file=sys.stderr)
+        # settings used to create the same annotator in worker processes
+        self.options = {'verbose': verbose, 'profile': profile, 'staged': staged, 'doc_cache': doc_cache,
+                        'gate': gate, 'lexicons': lexicons, 'windowed': windowed}
+
+    def to_disk(self, path):
+        """
+        Write the assembled pipeline to a directory, so that it can be loaded
+        without rebuilding it (see from_disk()):
+        
+            - nlp/: the spaCy pipeline (vocabulary, tokenizer with the
+                    detokenization special cases, tagger), written by spaCy;
+                    a windowed tagger is written as the tagger it wraps;
+            - components.pickle: the custom components (lexical annotators,
+                                 compiled token sequence rules...) and the
+                                 state of the annotator, with references to
+                                 the spaCy pipeline and its vocabulary (see
+                                 PipelinePickler);
+            - pipeline.json: the format, the component names, the rule
+                             version and the spaCy version.
+        
+        Arguments:
+            - path: str; the path to the output directory.
+        """
+        custom_names = [name for name, component in self.nlp.pipeline if not hasattr(component, 'to_disk')]
+        os.makedirs(path, exist_ok=True)
+        self.nlp.to_disk(os.path.join(path, 'nlp'), exclude=custom_names)
+        
+        lexicons = []
+        for lexicon in self.lexicons:
+            lexicon = dict(lexicon)
+            if callable(lexicon['keywords']):
+                lexicon['keywords'] = lexicon['keywords']()
+            lexicons.append(lexicon)
+        state = {'components': [(name, self.nlp.get_pipe(name)) for name in custom_names],
+                 'lexicons': lexicons,
+                 'token_sequence_annotators': self.token_sequence_annotators,
+                 'base_pipe_names': self.base_pipe_names,
+                 'lexical_pipe_names': self.lexical_pipe_names,
+                 'detokenization_rules': self.detokenization_rules,
+                 'options': self.options
+                 }
+        with open(os.path.join(path, 'components.pickle'), 'wb') as fout:
+            PipelinePickler(fout, self.nlp).dump(state)
+        
+        meta = {'format': PIPELINE_FORMAT,
+                'pipe_names': self.nlp.pipe_names,
+                'custom_names': custom_names,
+                'rule_version': self.get_rule_version(),
+                'spacy_version': spacy.__version__,
+                'created': datetime.now().isoformat()
+                }
+        with open(os.path.join(path, 'pipeline.json'), 'w', encoding='utf-8') as fout:
+            json.dump(meta, fout, indent=2)
+        print('-- Wrote pipeline:', path, file=sys.stderr)
+
+    @classmethod
+    def from_disk(cls, path, verbose=False, doc_cache=None, gate=False, windowed=False):
+        """
+        Load an annotator from a pipeline written by to_disk(). The spaCy
+        pipeline and the compiled components are read as they are: no
+        lexicon, grammar or detokenization rule is loaded. Lexicons and
+        grammars that have changed since the pipeline was written are
+        reloaded (see reload()).
+        
+        Arguments:
+            - path: str; the path to the pipeline directory.
+            - verbose: bool; trace all messages.
+            - doc_cache: str; the path to a tagged document cache.
+            - gate: bool; skip the pipeline for texts that contain none of
+                    the keywords of the rules.
+            - windowed: bool; only tag the tokens around the keywords of the
+                        rules (see WindowedTagger).
+        
+        Return:
+            - annotator: OnlineActivityAnnotator; the annotator.
+        """
+        with open(os.path.join(path, 'pipeline.json'), 'r', encoding='utf-8') as fin:
+            meta = json.load(fin)
+        if meta['format'] != PIPELINE_FORMAT:
+            raise ValueError('-- Error: unsupported pipeline format: ' + path)
+        if meta['spacy_version'] != spacy.__version__:
+            raise ValueError('-- Error: pipeline written with spaCy ' + meta['spacy_version'] + ', rebuild it with spaCy ' + spacy.__version__ + ': ' + path)
+        
+        print('Online Activity Annotator')
+        annotator = cls.__new__(cls)
+        nlp = spacy.load(os.path.join(path, 'nlp'), disable=meta['custom_names'])
+        with open(os.path.join(path, 'components.pickle'), 'rb') as fin:
+            state = PipelineUnpickler(fin, nlp).load()
+        options = state['options']
+        annotator.init_settings(verbose, options['profile'], options['staged'], doc_cache, gate, options['lexicons'], windowed)
+        annotator.options['pipeline'] = path
+        
+        components = dict(nlp.pipeline)
+        components.update(state['components'])
+        nlp.pipeline = [(name, components[name]) for name in meta['pipe_names']]
+        annotator.nlp = nlp
+        annotator.lexicons = state['lexicons']
+        annotator.token_sequence_annotators = state['token_sequence_annotators']
+        annotator.base_pipe_names = state['base_pipe_names']
+        annotator.lexical_pipe_names = state['lexical_pipe_names']
+        annotator.detokenization_rules = state['detokenization_rules']
+        
+        if doc_cache is not None:
+            annotator.open_doc_cache(doc_cache)
+        
+        # reload() checks the files and rebuilds the gate of changed rules
+        if annotator.reload():
+            print('-- Warning: the rules have changed since the pipeline was written, rebuild it:', path, file=sys.stderr)
+        
+        if gate:
+            annotator.keyword_gate = annotator.build_keyword_gate()
+        
+        if annotator.windowed:
+            annotator.enable_windowed_tagging()
+        
+        print('-- Pipeline:', file=sys.stderr)
+        print('  -- ' + '\n  -- '.join(annotator.nlp.pipe_names), file=sys.stderr)
+        
+        return annotator
+
+    def load_lexicon(self, path, source_attribute, target_attribute, merge=False, mapped=False):
         """
         Load a lexicon/terminology file for annotation.
         
@@ -88,13 +298,94 @@ class OnlineActivityAnnotator:
             - target_attribute: spaCy symbol; the token attribute to add the 
               lexical annotations to (e.g. TAG, or custom attribute INTERNET).
             - merge: bool; merge annotated spans into a single span.
+            - mapped: bool; compile the lexicon into a memory-mapped store
+                      shared by all processes (for very large lexicons, see
+                      lexicon_store).
+        
+        Lexicons without merging are added to a single combined lexical
+        annotator component (see CombinedLexicalAnnotator).
+        """
+        lexicon = {'path': path,
+                   'source_attribute': source_attribute,
+                   'target_attribute': target_attribute,
+                   'merge': merge,
+                   'mapped': mapped,
+                   'digest': file_digest(path)
+                   }
+        combined = None
+        if 'lexical_annotator' in self.nlp.pipe_names:
+            combined = self.nlp.get_pipe('lexical_annotator')
+        components, combined = self.make_lexicon_components(lexicon, self.nlp.pipe_names, combined)
+        for name, component in components:
+            self.nlp.add_pipe(component, last=True)
+            self.lexical_pipe_names.append(name)
+        self.lexicons.append(lexicon)
+
+    def make_lexicon_components(self, lexicon, pipe_names, combined=None):
+        """
+        Load a lexicon and create its components, without adding them to the
+        pipeline.
+        
+        Arguments:
+            - lexicon: dict; the lexicon settings (see load_lexicon()).
+            - pipe_names: list; the names of the components in the pipeline.
+            - combined: CombinedLexicalAnnotator; the combined lexical
+                        annotator to add the lexicon to (if not merging). If
+                        None, a new one is created.
+        
+        Return:
+            - components: list; the new (name, component) pairs.
+            - combined: CombinedLexicalAnnotator; the combined lexical annotator.
         """
-        if source_attribute == LEMMA:
-            lsa = LemmaAnnotatorSequence(self.nlp, path, target_attribute, merge=merge)
+        path = lexicon['path']
+        if lexicon.get('mapped', False):
+            store = load_lexicon_store(self.nlp, path, lexicon['source_attribute'])
+            # the keywords are only read if the keyword gate is built
+            lexicon['keywords'] = lambda: [(lexicon['target_attribute'], label, keywords) for (label, keywords) in store.get_keywords().items()]
+            components = []
+            if combined is None:
+                combined = CombinedLexicalAnnotator(self.nlp, name='lexical_annotator')
+                components.append((combined.name, combined))
+            combined.add_store(store, lexicon['target_attribute'])
+            return components, combined
+        if lexicon['source_attribute'] == LEMMA:
+            lsa = LemmaAnnotatorSequence(self.nlp, path, lexicon['target_attribute'], merge=lexicon['merge'])
         else:
-            lsa = LexicalAnnotatorSequence(self.nlp, path, source_attribute, target_attribute, merge=merge)
+            lsa = LexicalAnnotatorSequence(self.nlp, path, lexicon['source_attribute'], lexicon['target_attribute'], merge=lexicon['merge'])
         lsa.load_lexicon()
-        self.nlp = lsa.add_components()
+        lexicon['keywords'] = self.get_lexicon_keywords(lsa, lexicon)
+        components = []
+        if not lexicon['merge']:
+            if combined is None:
+                combined = CombinedLexicalAnnotator(self.nlp, name='lexical_annotator')
+                components.append((combined.name, combined))
+            lsa.add_to_component(combined)
+        else:
+            components = lsa.make_components(pipe_names)
+        return components, combined
+
+    def get_lexicon_keywords(self, lsa, lexicon):
+        """
+        Get the keywords of the terms of each label of a lexicon, for the
+        keyword gate (see build_keyword_gate()).
+        
+        Arguments:
+            - lsa: LexicalAnnotatorSequence or LemmaAnnotatorSequence; the
+                   loaded lexicon.
+            - lexicon: dict; the lexicon settings (see load_lexicon()).
+        
+        Return:
+            - keywords: list; (target attribute, label, keywords) tuples.
+        """
+        source_attribute = self.nlp.vocab.strings[lexicon['source_attribute']]
+        keywords = []
+        for label in lsa.get_labels():
+            if lexicon['source_attribute'] == LEMMA:
+                terms = [lemmas.split() for lemmas in lsa.annotation_rules[label]]
+            else:
+                terms = [[token.text for token in doc] for doc in lsa.patterns[label]]
+            keywords.append((lexicon['target_attribute'], label, get_term_keywords(terms, source_attribute)))
+        return keywords
 
     def load_pronoun_lemma_corrector(self):
         """
@@ -132,22 +423,354 @@ class OnlineActivityAnnotator:
             - path: str; the path to the file containing detokenization rules.
         """
         print('-- Detokenizer')
+        self.detokenization_rules.append(path)
         self.nlp = Detokenizer(self.nlp).load_detokenization_rules(path, verbose=self.verbose)
 
-    def load_token_sequence_annotator(self, name):
+    def load_token_sequence_annotator(self, name, path=None):
         """
         Load a token sequence annotator pipeline component.
         TODO allow for multiple annotators, cf. lemma and lexical annotators.
-        TODO add path argument to specify rule file.
         
         Arguments:
-            - name: str; the name of the token sequence annotator - this 
-                    *must* be the name (without the .py extension) of the file
-                    containing the token sequence rules.
+            - name: str; the name of the token sequence annotator.
+            - path: str; the path to the grammar file containing the token
+                    sequence rules. If None, the grammar file registered for
+                    the name is used (see token_sequence_annotator.RULE_FILES).
         """
-        tsa = TokenSequenceAnnotator(self.nlp, name, verbose=self.verbose)
+        tsa = TokenSequenceAnnotator(self.nlp, name, verbose=self.verbose, path=path, profile=self.profile, staged=self.staged)
         if tsa.name not in self.nlp.pipe_names:
+            self.nlp = tsa.add_stage_components(self.nlp)
             self.nlp.add_pipe(tsa)
+            self.token_sequence_annotators.append(name)
+
+    def get_rule_version(self, pipeline=None, lexicons=None):
+        """
+        Compute the version of the rule set, i.e. a hash of the lexicons and
+        token sequence grammars currently loaded.
+        
+        Arguments:
+            - pipeline: list; the (name, component) pairs of the pipeline to
+                        compute the version for (default: the current one).
+            - lexicons: list; the lexicon settings of the pipeline (default:
+                        the current ones, see load_lexicon()).
+        
+        Return:
+            - version: str; the rule set version.
+        """
+        components = dict(pipeline if pipeline is not None else self.nlp.pipeline)
+        sha = hashlib.sha1()
+        for lexicon in (lexicons if lexicons is not None else self.lexicons):
+            sha.update(lexicon['digest'].encode('utf-8'))
+        for name in self.token_sequence_annotators:
+            sha.update(components['token_sequence_annotator_' + name].digest.encode('utf-8'))
+        return sha.hexdigest()[:12]
+
+    def reload(self, force=False):
+        """
+        Reload the lexicons and token sequence grammars that have changed on
+        disk. The new components are built next to the running pipeline and
+        swapped in with a single assignment, so a document that is being
+        processed finishes with the old rules and the next document uses the
+        new ones. The tokenizer and tagger are not reloaded. The new digests
+        and rule version are only recorded once the new pipeline is in place,
+        so a failed reload is retried at the next call.
+        
+        Arguments:
+            - force: bool; reload all lexicons and grammars.
+        
+        Return:
+            - reloaded: bool; True if any rules were reloaded.
+        """
+        with self.reload_lock:
+            replacements = {}
+            
+            lexicons = self.lexicons
+            lexical_components = None
+            digests = [file_digest(lexicon['path']) for lexicon in self.lexicons]
+            if force or any(digest != lexicon['digest'] for lexicon, digest in zip(self.lexicons, digests)):
+                pipe_names = [name for name in self.nlp.pipe_names if name not in self.lexical_pipe_names]
+                lexicons = [dict(lexicon, digest=digest) for lexicon, digest in zip(self.lexicons, digests)]
+                lexical_components = []
+                combined = None
+                for lexicon in lexicons:
+                    names = pipe_names + [name for name, _ in lexical_components]
+                    components, combined = self.make_lexicon_components(lexicon, names, combined)
+                    lexical_components.extend(components)
+            
+            for name in self.token_sequence_annotators:
+                tsa = self.nlp.get_pipe('token_sequence_annotator_' + name)
+                if force or tsa.is_modified():
+                    new_tsa = TokenSequenceAnnotator(self.nlp, name, verbose=self.verbose, path=tsa.path, profile=self.profile, staged=self.staged)
+                    replacements[new_tsa.name] = new_tsa
+                    for stage_name, component in new_tsa.make_stage_components():
+                        replacements[stage_name] = component
+            
+            if lexical_components is None and len(replacements) == 0:
+                return False
+            
+            # build the new pipeline, then swap it in
+            pipeline = []
+            for name, component in self.nlp.pipeline:
+                if name in self.lexical_pipe_names and lexical_components is not None:
+                    if name == self.lexical_pipe_names[0]:
+                        pipeline.extend(lexical_components)
+                    continue
+                pipeline.append((name, replacements.get(name, component)))
+            
+            if self.windowed:
+                tagger = self.make_windowed_tagger(pipeline, lexicons)
+                pipeline = [(name, tagger if name == 'tagger' else component) for name, component in pipeline]
+            
+            version = self.get_rule_version(pipeline, lexicons)
+            keyword_gate = self.keyword_gate
+            if keyword_gate is not None:
+                keyword_gate = self.build_keyword_gate(pipeline, lexicons)
+            old_pipeline = self.nlp.pipeline
+            self.nlp.pipeline = [(name, RuleVersionStamp(version) if name == 'rule_version' else component) for name, component in pipeline]
+            # free the vocabulary flags of the old rules for the next reload
+            # (the documents being processed may still read them)
+            old_keys = set().union(*[getattr(component, 'vocab_flag_keys', set()) for _, component in old_pipeline])
+            new_keys = set().union(*[getattr(component, 'vocab_flag_keys', set()) for _, component in pipeline])
+            release_vocab_flags(self.nlp.vocab, old_keys - new_keys)
+            # record the new state only once the new pipeline is in place
+            self.lexicons = lexicons
+            if lexical_components is not None:
+                self.lexical_pipe_names = [name for name, _ in lexical_components]
+            self.keyword_gate = keyword_gate
+            print('-- Reloaded rules, version:', version, file=sys.stderr)
+            
+            return True
+
+    def watch(self, interval=2.0):
+        """
+        Watch the lexicon and grammar files and reload them when they change
+        (see reload()). The files are checked in a background thread.
+        
+        Arguments:
+            - interval: float; the number of seconds between checks.
+        """
+        if self.watcher is not None:
+            return
+        stop = threading.Event()
+        
+        def check():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except Exception as e:
+                    print('-- Warning: unable to reload rules', file=sys.stderr)
+                    print(e, file=sys.stderr)
+        
+        thread = threading.Thread(target=check, name='rule_watcher', daemon=True)
+        self.watcher = (thread, stop)
+        thread.start()
+
+    def stop_watching(self):
+        """
+        Stop watching the lexicon and grammar files.
+        """
+        if self.watcher is not None:
+            self.watcher[1].set()
+            self.watcher = None
+
+    def build_keyword_gate(self, pipeline=None, lexicons=None):
+        """
+        Build a keyword gate from the lexicons and the token sequence rules
+        (see keyword_gate). Texts that contain none of the keywords cannot be
+        annotated, so the pipeline is not run on them.
+        
+        Arguments:
+            - pipeline: list; the (name, component) pairs of the pipeline to
+                        build the gate for (default: the current one).
+            - lexicons: list; the lexicon settings of the pipeline (default:
+                        the current ones).
+        
+        Return:
+            - gate: KeywordGate; the keyword gate.
+        """
+        components = dict(pipeline if pipeline is not None else self.nlp.pipeline)
+        rules = []
+        for name in self.token_sequence_annotators:
+            rules.extend(components['token_sequence_annotator_' + name].rules)
+        lexicon_keywords = []
+        for lexicon in (lexicons if lexicons is not None else self.lexicons):
+            keywords = lexicon['keywords']
+            lexicon_keywords.extend(keywords() if callable(keywords) else keywords)
+        gate = build_keyword_gate(rules, lexicon_keywords)
+        if gate.keywords is not None:
+            print('-- Keyword gate:', len(gate.keywords), 'keywords.', file=sys.stderr)
+        return gate
+
+    def make_windowed_tagger(self, pipeline=None, lexicons=None):
+        """
+        Create a windowed tagger for the rules of a pipeline (see
+        WindowedTagger). The windows extend by the maximum match length of the
+        rules on each side of a keyword, plus the context the tagger uses
+        (TAGGER_CONTEXT). If a rule has repeated tokens (OP + or *), its
+        matches have no maximum length and the windows also extend to the
+        whole sentences of the keywords.
+        
+        Arguments:
+            - pipeline: list; the (name, component) pairs of the pipeline
+                        (default: the current one).
+            - lexicons: list; the lexicon settings of the pipeline (default:
+                        the current ones).
+        
+        Return:
+            - tagger: WindowedTagger; the windowed tagger, or the tagger of
+                      the pipeline if the rules cannot be reduced to keywords.
+        """
+        components = dict(pipeline if pipeline is not None else self.nlp.pipeline)
+        tagger = components['tagger']
+        if isinstance(tagger, WindowedTagger):
+            tagger = tagger.tagger
+        gate = self.build_keyword_gate(pipeline, lexicons)
+        if gate.keywords is None:
+            print('-- Warning: the rules cannot be reduced to keywords, all tokens are tagged.', file=sys.stderr)
+            return tagger
+        lengths = []
+        for name in self.token_sequence_annotators:
+            lengths.extend(get_rule_length(rule['pattern']) for rule in components['token_sequence_annotator_' + name].rules)
+        margin = max([0] + [length for length in lengths if length is not None]) + TAGGER_CONTEXT
+        return WindowedTagger(tagger, gate, margin, sentences=None in lengths)
+
+    def enable_windowed_tagging(self):
+        """
+        Replace the tagger of the pipeline with a windowed tagger (see
+        make_windowed_tagger()).
+        """
+        if 'tagger' in self.nlp.pipe_names:
+            self.nlp.replace_pipe('tagger', self.make_windowed_tagger())
+
+    def audit_keyword_gate(self, texts):
+        """
+        Check the recall of the keyword gate: run the full pipeline on every
+        text and report the annotated texts that the gate would have skipped.
+        
+        Arguments:
+            - texts: iterable; (text_id, text) pairs.
+        
+        Return:
+            - report: dict; the number of texts, of texts passed by the gate,
+                      of annotated texts, and the identifiers of the annotated
+                      texts rejected by the gate (misses).
+        """
+        gate = self.keyword_gate or self.build_keyword_gate()
+        report = {'texts': 0, 'passed': 0, 'annotated': 0, 'misses': []}
+        for text_id, text in texts:
+            self.tracer.begin_document(text_id)
+            passed = gate.has_keyword(text)
+            doc = self.run_pipeline(text, use_gate=False)
+            mentions = self.build_ehost_output(doc)
+            report['texts'] += 1
+            report['passed'] += int(passed)
+            if len(mentions) > 0:
+                report['annotated'] += 1
+                if not passed:
+                    report['misses'].append(text_id)
+                    self.tracer.warning('keyword_gate_miss', '-- Warning: keyword gate rejects annotated text: {} {}', text_id,
+                                        sorted(set(m['text'] for m in mentions.values())))
+        
+        print('-- Keyword gate audit:', report['texts'], 'texts,', report['passed'], 'passed,', report['annotated'], 'annotated,',
+              len(report['misses']), 'missed.', file=sys.stderr)
+        return report
+
+    def get_rule_profiler(self, name='level0'):
+        """
+        Get the rule profiler of a token sequence annotator.
+        
+        Arguments:
+            - name: str; the name of the token sequence annotator.
+        
+        Return:
+            - profiler: RuleProfiler; the profiler, or None if the annotator
+                        was created without profiling.
+        """
+        return self.nlp.get_pipe('token_sequence_annotator_' + name).profiler
+
+    def get_base_fingerprint(self):
+        """
+        Compute a fingerprint of the pipeline stages that precede the lexical
+        and token sequence annotators: the spaCy version and model, the
+        detokenization rules and the code of the custom components.
+        
+        Return:
+            - fingerprint: str; the hexadecimal SHA-1 digest.
+        """
+        sha = hashlib.sha1()
+        meta = self.nlp.meta
+        sha.update((spacy.__version__ + ' ' + meta.get('lang', '') + '_' + meta.get('name', '') + ' ' + meta.get('version', '')).encode('utf-8'))
+        for path in self.detokenization_rules:
+            sha.update(file_digest(path).encode('utf-8'))
+        for name in self.base_pipe_names:
+            sha.update(name.encode('utf-8'))
+            component = self.nlp.get_pipe(name)
+            if component.__class__ in [LemmaCorrector, DateTokenAnnotator]:
+                sha.update(inspect.getsource(component.__class__).encode('utf-8'))
+        return sha.hexdigest()
+
+    def open_doc_cache(self, path):
+        """
+        Open a cache of tagged documents. Documents processed by the pipeline
+        stages that precede the lexical and token sequence annotators are
+        stored in the cache, keyed by their text and the fingerprint of these
+        stages (see get_base_fingerprint()), so that a change to the lexicons
+        or the token sequence rules only re-runs the annotation layers.
+        
+        Arguments:
+            - path: str; the path to the cache database.
+        """
+        if self.doc_cache is not None:
+            self.doc_cache.close()
+        self.doc_cache = DocCache(path, self.get_base_fingerprint())
+
+    def close_doc_cache(self):
+        """
+        Write all pending entries and close the tagged document cache.
+        """
+        if self.doc_cache is not None:
+            print('-- Tagged document cache:', self.doc_cache.n_hits, 'hits,', self.doc_cache.n_misses, 'misses,',
+                  self.doc_cache.n_errors, 'errors.', file=sys.stderr)
+            self.doc_cache.close()
+            self.doc_cache = None
+
+    def run_pipeline(self, text, use_gate=True):
+        """
+        Run the pipeline on a text, reusing the tagged document from the cache
+        if possible. If the keyword gate is enabled and the text contains
+        none of its keywords, the text is only tokenized.
+        
+        Arguments:
+            - text: str; the text to annotate.
+            - use_gate: bool; apply the keyword gate (if enabled).
+        
+        Return:
+            - doc: spaCy Doc; the annotated Doc object.
+        """
+        # use the same pipeline throughout, even if the rules are reloaded
+        pipeline = self.nlp.pipeline
+        
+        gate = self.keyword_gate
+        if use_gate and gate is not None and not gate.is_candidate(text):
+            self.tracer.debug('keyword_gate', '-- Keyword gate: no keyword, pipeline skipped.')
+            return dict(pipeline)['rule_version'](self.nlp.make_doc(text))
+        
+        if self.doc_cache is None:
+            return self.nlp(text)
+        
+        doc = self.doc_cache.get(text, self.nlp.vocab)
+        if doc is None:
+            doc = self.nlp.make_doc(text)
+            for name, proc in pipeline:
+                if name in self.base_pipe_names:
+                    doc = proc(doc)
+            self.doc_cache.put(text, doc)
+        
+        for name, proc in pipeline:
+            if name not in self.base_pipe_names:
+                doc = proc(doc)
+        
+        return doc
 
     def get_text(self):
         """
@@ -169,7 +792,7 @@ class OnlineActivityAnnotator:
             - doc: spaCy Doc; the annotated Doc object.
         """
         self.text = text
-        return self.nlp(text)
+        return self.run_pipeline(text)
 
     def annotate_file(self, path, clean_text):
         """
@@ -179,7 +802,8 @@ class OnlineActivityAnnotator:
             - path: str; the path to a text file to annotate.
         
         Return:
-            - doc: spacy Doc; the annotated Doc object.
+            - doc: spacy Doc; the annotated Doc object, or None if the text is
+                   longer than nlp.max_length (see annotate_long_text()).
         """
         # TODO check for file in input
         # TODO check encoding
@@ -187,13 +811,80 @@ class OnlineActivityAnnotator:
         self.text = f.read()
         self.text = remove_unwanted_patterns(self.text, verbose=False)
         
-        if len(self.text) >= 1000000:
-            print('-- Unable to process very long text text:', path)
+        if len(self.text) >= self.nlp.max_length:
+            # too long for a single document, see annotate_long_text()
             return None
         
-        doc = self.nlp(self.text)
+        doc = self.run_pipeline(self.text)
         
         return doc
+
+    def annotate_mentions(self, text):
+        """
+        Annotate a text string and build its mentions, splitting texts that
+        are longer than nlp.max_length into chunks (see annotate_long_text()).
+        
+        Arguments:
+            - text: str; the text to annotate.
+        
+        Return:
+            - mentions: dict; the annotated mentions (see build_ehost_output()).
+            - rule_version: str; the version of the rule set.
+        """
+        if len(text) >= self.nlp.max_length:
+            return self.annotate_long_text(text)
+        doc = self.run_pipeline(text)
+        doc = self.merge_spans(doc)
+        
+        self.trace_spans(doc)
+        
+        return self.build_ehost_output(doc), doc._.rule_version
+
+    def annotate_long_text(self, text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+        """
+        Annotate a text that is too long to be processed as a single document.
+        The text is split into overlapping chunks at paragraph or line breaks
+        (see split_text()), which are annotated a few at a time with
+        run_pipeline_batch(). Each chunk keeps the mentions that start in the
+        part of the text it owns, and their offsets are shifted back onto the
+        original text. Chunks overlap by about overlap characters and own up to
+        the middle of the overlap, so a mention that crosses the end of a chunk
+        is taken from the next chunk, where it is complete and has its left
+        context.
+        
+        Arguments:
+            - text: str; the text to annotate.
+            - chunk_size: int; the maximum number of characters of a chunk.
+            - overlap: int; the number of characters shared by consecutive
+                       chunks.
+        
+        Return:
+            - mentions: dict; the annotated mentions (see build_ehost_output()),
+                        with offsets into text.
+            - rule_version: str; the version of the rule set.
+        """
+        chunk_size = min(chunk_size, self.nlp.max_length - 1)
+        self.tracer.info('long_text', '-- Splitting very long text into chunks: {} characters', len(text))
+        mentions = {}
+        rule_version = None
+        chunks = split_text(text, chunk_size, overlap)
+        while True:
+            batch = list(itertools.islice(chunks, CHUNK_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            docs = self.run_pipeline_batch([text[start:end] for start, end, _, _ in batch], batch_size=CHUNK_BATCH_SIZE)
+            for (start, end, own_start, own_end), doc in zip(batch, docs):
+                doc = self.merge_spans(doc)
+                self.trace_spans(doc)
+                rule_version = doc._.rule_version
+                for mention in self.build_ehost_output(doc).values():
+                    if not own_start <= start + int(mention['start']) < own_end:
+                        continue
+                    mention['start'] = str(start + int(mention['start']))
+                    mention['end'] = str(start + int(mention['end']))
+                    mentions['EHOST_Instance_' + str(len(mentions) + 1)] = mention
+        
+        return mentions, rule_version
     
     def merge_spans(self, doc):
         """
@@ -216,7 +907,7 @@ class OnlineActivityAnnotator:
                     mtype = token._.MENTION
                     i += 1
                     if i == len(doc):
-                        print('-- Warning: index is equal to document length:', i, token, len(doc), file=sys.stderr)
+                        self.tracer.debug('mention_end', '-- Warning: index is equal to document length: {} {} {}', i, token, len(doc))
                         break
                     token = doc[i]
                 end = i
@@ -228,6 +919,7 @@ class OnlineActivityAnnotator:
                 #print('Merging tokens:', start, end, doc[start:end], file=sys.stderr)
                 attrs = {'LEMMA': ' '.join([token.lemma_ for token in doc[start:end]]).replace('# ', '#')}
                 retokenizer.merge(doc[start:end], attrs=attrs)
+        get_store(doc)
 
         return doc
 
@@ -238,16 +930,35 @@ class OnlineActivityAnnotator:
         Arguments:
             - doc: spaCy Doc; the current Doc object
         """
+        print(self.format_spans(doc), file=sys.stderr)
+
+    def trace_spans(self, doc):
+        """
+        Write all spans in CoNLL-style token annotations to the tracer. The
+        table is only built if debug records are traced for this document.
+
+        Arguments:
+            - doc: spaCy Doc; the current Doc object
+        """
+        if self.tracer.enabled(DEBUG):
+            self.tracer.debug('spans', self.format_spans(doc))
+
+    def format_spans(self, doc):
+        """
+        Format all spans as CoNLL-style token annotations.
+
+        Arguments:
+            - doc: spaCy Doc; the current Doc object
+
+        Return:
+            - s: str; the token annotation table.
+        """
         s = '\n'
         s += 'PIPELINE:\n-- ' + '\n-- '.join(self.nlp.pipe_names)
         s += '\n\n'
         s += '{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}'.format('INDEX', 'WORD', 'LEMMA', 'LOWER', 'POS1', 'POS2', 'HEAD', 'DEP')
 
-        cext = set()        
-        for a in doc.user_data:
-            cext.add(a[1])
-
-        cext = sorted(cext)
+        cext = get_token_attributes(doc)
 
         for a in cext:
             s += '{:<10}'.format(a)
@@ -259,14 +970,13 @@ class OnlineActivityAnnotator:
         for a in cext:
             s += '{:<10}'.format('-' * len(a))
 
-        print(s, file=sys.stderr)
-        
         for token in doc:
-            s = '{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}'.format(token.i, token.text, token.lemma_, token.lower_, token.tag_, token.pos_, token.head.i, token.dep_)
+            s += '\n{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}{:<10}'.format(token.i, token.text, token.lemma_, token.lower_, token.tag_, token.pos_, token.head.i, token.dep_)
             for a in cext:
                 val = token._.get(a)
                 s += '{:10}'.format(val or '_')
-            print(s, file=sys.stderr)
+
+        return s
 
     def build_ehost_output(self, doc):
         """
@@ -296,12 +1006,13 @@ class OnlineActivityAnnotator:
                                         'comment': comment,
                                         'end': str(end),
                                         'start': str(start),
-                                        'text': text
+                                        'text': text,
+                                        'rule_version': doc._.rule_version
                                         }
 
         return mentions
     
-    def write_ehost_output(self, pin, annotations, verbose=False):
+    def write_ehost_output(self, pin, annotations, verbose=False, rule_version=None):
         """
         Write an annotated eHOST XML file to disk.
         
@@ -309,6 +1020,8 @@ class OnlineActivityAnnotator:
             - pin: str; the input file path (must be in eHOST directory structure).
             - annotations: dict; the dictionary of detected annotations.
             - verbose: bool; print all messages.
+            - rule_version: str; the version of the rule set that produced
+                            the annotations (recorded as an XML comment).
         
         Return:
             - root: Element; the root node of the new XML ElementTree object.
@@ -317,6 +1030,8 @@ class OnlineActivityAnnotator:
 
         root = ET.Element('annotations')
         root.attrib['textSource'] = os.path.basename(os.path.splitext(pin.replace('.knowtator.xml', ''))[0] + '.txt')
+        if rule_version is not None:
+            root.append(ET.Comment(' rule version: ' + rule_version + ' '))
 
         n = 1
         m = 1000
@@ -395,7 +1110,7 @@ class OnlineActivityAnnotator:
 
         return root
 
-    def process(self, path, clean_text=True, write_output=True):
+    def process(self, path, clean_text=True, write_output=True, sink=None):
         """
         Process a single document or directory structure.
         
@@ -404,66 +1119,144 @@ class OnlineActivityAnnotator:
                 structure must be that used by the eHOST annotation tool.
             - clean_text: bool; clean text prior to processing by removing unwanted patterns.
             - write_output: bool; save the annotated output to file.
+            - sink: JsonlSink; write the mentions of each file of a directory to
+                    this sink instead of keeping them in memory (see
+                    corpus_stream).
         
         Return:
-            - global_mentions: dict; a dictionary containing all annotated mentions.
+            - global_mentions: dict; a dictionary containing all annotated mentions
+                               (empty for a directory written to a sink).
         """
         global_mentions = {}
 
         if os.path.isdir(path):
             print('-- Processing directory...', file=sys.stderr)
             files = os.listdir(path)
+            tasks = [(os.path.join(path, f), f + '.knowtator.xml', clean_text, write_output) for f in files]
+            if self.pool is not None:
+                results = self.pool.imap(process_file_task, tasks, chunksize=WORKER_CHUNK_SIZE)
+            else:
+                results = (self.try_process_file(*task) + (None,) for task in tasks)
             
-            for f in files:
-                pin = os.path.join(path, f)
-                if self.verbose:
-                    print('-- Processing file:', pin, file=sys.stderr)
-                # Annotate and print results
-                doc = self.annotate_file(pin, clean_text)
-                doc = self.merge_spans(doc)
-                
-                if self.verbose:
-                    self.print_spans(doc)
-                
-                mentions = self.build_ehost_output(doc)
-                global_mentions[f + '.knowtator.xml'] = mentions
-                                
-                if write_output:
-                    self.write_ehost_output(pin, mentions, verbose=self.verbose)
+            # results are returned in file order
+            n_errors = 0
+            worker_rss = {}
+            for key, mentions, error, rss in results:
+                if rss is not None and rss[1] is not None:
+                    worker_rss[rss[0]] = rss[1]
+                if error is not None:
+                    print('-- Warning: unable to process file:', key, file=sys.stderr)
+                    print(error, file=sys.stderr)
+                    n_errors += 1
+                    continue
+                if sink is not None:
+                    sink.write(key, mentions)
+                else:
+                    global_mentions[key] = mentions
+            if n_errors > 0:
+                print('-- Warning:', n_errors, 'of', len(tasks), 'files could not be processed.', file=sys.stderr)
+            peak_rss = get_peak_rss()
+            if peak_rss is not None:
+                print('-- Peak RSS:', round(peak_rss, 1), 'MB', file=sys.stderr)
+            if len(worker_rss) > 0:
+                # the workers run at the same time, so their peaks add up
+                print('-- Peak RSS of the workers:', round(sum(worker_rss.values()), 1), 'MB in total,',
+                      round(max(worker_rss.values()), 1), 'MB per worker at most', file=sys.stderr)
                 
         elif os.path.isfile(path):
             print('-- Processing file:', path, file=sys.stderr)
-            doc = self.annotate_file(path, clean_text)
-            doc = self.merge_spans(doc)
-            
-            if self.verbose:
-                self.print_spans(doc)
-            
-            mentions = self.build_ehost_output(doc)
             key = os.path.basename(path)
-            global_mentions[key] = mentions
-
-            if write_output:
-                self.write_ehost_output(path, mentions, verbose=self.verbose)
+            global_mentions[key] = self.process_file(path, key, clean_text, write_output)
 
         else:
             print('-- Processing text string:', path, file=sys.stderr)
             path = remove_unwanted_patterns(path, verbose=False)
-            doc = self.nlp(path)
-            doc = self.merge_spans(doc)
-
-            if self.verbose:
-                self.print_spans(doc)
-
-            mentions = self.build_ehost_output(doc)
+            self.tracer.begin_document()
+            mentions, rule_version = self.annotate_mentions(path)
             key = os.path.basename(path)
             global_mentions[key] = mentions
 
             if write_output:
-                self.write_ehost_output('test.txt', mentions, verbose=self.verbose)
+                self.write_ehost_output('test.txt', mentions, verbose=self.verbose, rule_version=rule_version)
+        
+        if self.doc_cache is not None:
+            self.doc_cache.commit()
         
         return global_mentions
 
+    def process_file(self, path, key, clean_text=True, write_output=True):
+        """
+        Process a single text file.
+        
+        Arguments:
+            - path: str; the path to the text file.
+            - key: str; the identifier of the file in the trace records.
+            - clean_text: bool; clean text prior to processing by removing unwanted patterns.
+            - write_output: bool; save the annotated output to file.
+        
+        Return:
+            - mentions: dict; a dictionary containing the annotated mentions
+                        of the file.
+        """
+        self.tracer.begin_document(key)
+        self.tracer.debug('process_file', '-- Processing file: {}', path)
+        # Annotate and print results
+        doc = self.annotate_file(path, clean_text)
+        if doc is None:
+            mentions, rule_version = self.annotate_long_text(self.text)
+        else:
+            doc = self.merge_spans(doc)
+            
+            self.trace_spans(doc)
+            
+            mentions = self.build_ehost_output(doc)
+            rule_version = doc._.rule_version
+        
+        if write_output:
+            self.write_ehost_output(path, mentions, verbose=self.verbose, rule_version=rule_version)
+        
+        return mentions
+
+    def try_process_file(self, path, key, clean_text=True, write_output=True):
+        """
+        Process a single text file, isolating errors so that a failure does
+        not stop the processing of the other files.
+        
+        Arguments: see process_file().
+        
+        Return:
+            - key: str; the identifier of the file.
+            - mentions: dict; the annotated mentions, or None on error.
+            - error: str; the error traceback, or None.
+        """
+        try:
+            return key, self.process_file(path, key, clean_text, write_output), None
+        except Exception:
+            return key, None, traceback.format_exc()
+
+    def start_workers(self, n_workers):
+        """
+        Start a pool of worker processes for process(). Each worker loads its
+        own pipeline once, with the settings of this annotator, and the files
+        of a directory are spread across the workers. Workers are started with
+        the 'spawn' method, so they do not inherit the state of this process.
+        
+        Arguments:
+            - n_workers: int; the number of worker processes.
+        """
+        self.stop_workers()
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(n_workers, initializer=init_worker, initargs=(self.options,))
+
+    def stop_workers(self):
+        """
+        Stop the worker processes started by start_workers().
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def process_text(self, text, text_id, clean_text=False, write_output=False, verbose=False):
         """
         Process a text string.
@@ -478,27 +1271,440 @@ class OnlineActivityAnnotator:
             - global_mentions: dict; a dictionary containing all annotated mentions.
         """
         self.verbose = verbose
-        if self.verbose:
-            print('-- Processing text string:', text, file=sys.stderr)
+        if verbose:
+            self.tracer.set_level(DEBUG)
+        self.tracer.begin_document(text_id)
+        self.tracer.debug('process_text', '-- Processing text string: {}', text)
         
         global_mentions = {}
         if clean_text:
             text = remove_unwanted_patterns(text, verbose=verbose)
-        doc = self.nlp(text)
-        doc = self.merge_spans(doc)
-        
-        if self.verbose:
-            self.print_spans(doc)
-
-        mentions = self.build_ehost_output(doc)
+        mentions, rule_version = self.annotate_mentions(text)
         
         global_mentions[text_id] = mentions
 
         if write_output:
-            self.write_ehost_output('test.txt', mentions, verbose=self.verbose)
+            self.write_ehost_output('test.txt', mentions, verbose=self.verbose, rule_version=rule_version)
         
         return global_mentions
 
+    def process_texts(self, texts, batch_size=1000, clean_text=False):
+        """
+        Process a stream of text strings in batches. The texts are read and
+        annotated one batch at a time and the results are yielded in input
+        order, so the whole stream is never held in memory.
+        
+        Arguments:
+            - texts: iterable; (text_id, text) pairs.
+            - batch_size: int; the number of texts per batch.
+            - clean_text: bool; clean text prior to processing by removing unwanted patterns.
+        
+        Return:
+            - results: generator; (text_id, mentions) pairs, where mentions is
+                       a dictionary containing the annotated mentions of the
+                       text (see build_ehost_output()).
+        """
+        texts = iter(texts)
+        while True:
+            batch = list(itertools.islice(texts, batch_size))
+            if len(batch) == 0:
+                break
+            batch_texts = [text for _, text in batch]
+            if clean_text:
+                batch_texts = [remove_unwanted_patterns(text, verbose=False) for text in batch_texts]
+            docs = self.run_pipeline_batch(batch_texts, batch_size=batch_size)
+            for (text_id, _), text, doc in zip(batch, batch_texts, docs):
+                self.tracer.begin_document(text_id)
+                if doc is None:
+                    yield text_id, self.annotate_long_text(text)[0]
+                    continue
+                doc = self.merge_spans(doc)
+                self.trace_spans(doc)
+                yield text_id, self.build_ehost_output(doc)
+        
+        if self.doc_cache is not None:
+            self.doc_cache.commit()
+
+    def process_stream(self, texts, sink, batch_size=1000, clean_text=False):
+        """
+        Annotate a stream of texts and write the mentions of each text to a
+        sink as soon as its batch is annotated. Only one batch of texts is in
+        memory at a time, so memory use does not depend on the size of the
+        corpus. The peak resident set size of the run is reported at the end.
+        
+        Arguments:
+            - texts: iterable; (text_id, text) pairs (see corpus_stream.open_source()).
+            - sink: JsonlSink; the sink (see corpus_stream.open_sink()).
+            - batch_size: int; the number of texts per batch.
+            - clean_text: bool; clean text prior to processing by removing unwanted patterns.
+        
+        Return:
+            - stats: dict; the number of texts and mentions, the run time in
+                     seconds and the peak RSS in MB.
+        """
+        print('-- Processing stream...', file=sys.stderr)
+        t0 = time.time()
+        n_texts = 0
+        n_mentions = 0
+        for text_id, mentions in self.process_texts(texts, batch_size=batch_size, clean_text=clean_text):
+            sink.write(text_id, mentions)
+            n_texts += 1
+            n_mentions += len(mentions)
+            if n_texts % batch_size == 0:
+                self.tracer.debug('process_stream', '-- Processed {} texts', n_texts)
+        
+        stats = {'texts': n_texts, 'mentions': n_mentions, 'time': time.time() - t0, 'peak_rss': get_peak_rss()}
+        print('-- Processed', n_texts, 'texts,', n_mentions, 'mentions in', round(stats['time'], 2), 's', file=sys.stderr)
+        if stats['peak_rss'] is not None:
+            print('-- Peak RSS:', round(stats['peak_rss'], 1), 'MB', file=sys.stderr)
+        
+        return stats
+
+    def run_pipeline_batch(self, texts, batch_size=1000):
+        """
+        Run the pipeline on a batch of texts with nlp.pipe(), so that
+        components that support it (e.g. the tagger) process the texts in
+        batches. Texts rejected by the keyword gate are only tokenized and
+        tagged documents are reused from the cache (see run_pipeline()).
+        
+        Arguments:
+            - texts: list; the texts to annotate.
+            - batch_size: int; the number of texts passed to the components
+                          at a time.
+        
+        Return:
+            - docs: list; the annotated Doc objects, or None for texts that
+                    are longer than nlp.max_length.
+        """
+        # use the same pipeline throughout, even if the rules are reloaded
+        pipeline = self.nlp.pipeline
+        docs = [None] * len(texts)
+        
+        indices = []
+        for i, text in enumerate(texts):
+            if len(text) >= self.nlp.max_length:
+                # see annotate_long_text()
+                continue
+            elif self.keyword_gate is not None and not self.keyword_gate.is_candidate(text):
+                docs[i] = dict(pipeline)['rule_version'](self.nlp.make_doc(text))
+            else:
+                indices.append(i)
+        
+        if self.doc_cache is None:
+            for i, doc in zip(indices, self.nlp.pipe([texts[i] for i in indices], batch_size=batch_size)):
+                docs[i] = doc
+            return docs
+        
+        misses = []
+        for i in indices:
+            docs[i] = self.doc_cache.get(texts[i], self.nlp.vocab)
+            if docs[i] is None:
+                misses.append(i)
+        
+        base_docs = [self.nlp.make_doc(texts[i]) for i in misses]
+        base_docs = pipe_components([(name, proc) for name, proc in pipeline if name in self.base_pipe_names], base_docs, batch_size)
+        for i, doc in zip(misses, base_docs):
+            self.doc_cache.put(texts[i], doc)
+            docs[i] = doc
+        
+        annotated = pipe_components([(name, proc) for name, proc in pipeline if name not in self.base_pipe_names], [docs[i] for i in indices], batch_size)
+        for i, doc in zip(indices, annotated):
+            docs[i] = doc
+        
+        return docs
+
+
+# Number of files sent to a worker process at a time
+WORKER_CHUNK_SIZE = 4
+
+# Annotator of a worker process (see OnlineActivityAnnotator.start_workers())
+WORKER_ANNOTATOR = None
+
+
+def init_worker(options):
+    """
+    Load the pipeline of a worker process.
+    
+    Arguments:
+        - options: dict; the settings of the annotator.
+    """
+    global WORKER_ANNOTATOR
+    if options.get('pipeline', None) is not None:
+        WORKER_ANNOTATOR = OnlineActivityAnnotator.from_disk(options['pipeline'], verbose=options['verbose'],
+                                                             doc_cache=options['doc_cache'], gate=options['gate'],
+                                                             windowed=options['windowed'])
+    else:
+        WORKER_ANNOTATOR = OnlineActivityAnnotator(**options)
+    if WORKER_ANNOTATOR.doc_cache is not None:
+        # the workers share the cache database, so each entry is committed at
+        # once to release the write lock for the other workers
+        WORKER_ANNOTATOR.doc_cache.commit_interval = 1
+    # write the pending cache entries when the worker exits
+    multiprocessing.util.Finalize(WORKER_ANNOTATOR, WORKER_ANNOTATOR.close_doc_cache, exitpriority=10)
+
+
+def process_file_task(task):
+    """
+    Process a file in a worker process.
+    
+    Arguments:
+        - task: tuple; the arguments of OnlineActivityAnnotator.process_file().
+    
+    Return: see OnlineActivityAnnotator.try_process_file(), followed by:
+        - worker_rss: tuple; the process ID and the peak RSS (in MB) of the
+                      worker.
+    """
+    return WORKER_ANNOTATOR.try_process_file(*task) + ((os.getpid(), get_peak_rss()),)
+
+
+def find_break(text, lower, upper):
+    """
+    Find the last paragraph break in a range of a text, or else the last line
+    break, or else the last space.
+    
+    Arguments:
+        - text: str; the text.
+        - lower: int; the start of the range.
+        - upper: int; the end of the range.
+    
+    Return:
+        - offset: int; the offset following the break, or upper if there is
+                  none.
+    """
+    for sep in ['\n\n', '\n', ' ']:
+        i = text.rfind(sep, lower, upper)
+        if i >= 0:
+            return i + len(sep)
+    return upper
+
+
+def split_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Split a text into overlapping chunks that end at a paragraph or line
+    break. Each chunk owns a part of the text: the owned parts do not overlap
+    and cover the whole text, the boundary between two chunks being the middle
+    of their overlap.
+    
+    Arguments:
+        - text: str; the text.
+        - chunk_size: int; the maximum number of characters of a chunk.
+        - overlap: int; the number of characters shared by consecutive chunks.
+    
+    Return:
+        - chunks: generator; (start, end, own_start, own_end) offsets of each
+                  chunk and of the part of the text it owns.
+    """
+    if chunk_size <= 4 * overlap:
+        raise ValueError('-- Error: the chunk size must be more than 4 times the overlap.')
+    start = 0
+    own_start = 0
+    while len(text) - start > chunk_size:
+        end = find_break(text, start + chunk_size // 2, start + chunk_size)
+        next_start = find_break(text, end - 2 * overlap, end - overlap)
+        own_end = (next_start + end) // 2
+        yield start, end, own_start, own_end
+        start = next_start
+        own_start = own_end
+    yield start, len(text), own_start, len(text)
+
+
+class PipelinePickler(pickle.Pickler):
+    """
+    Pipeline Pickler
+    
+    Pickles pipeline components with references to the spaCy pipeline and its
+    vocabulary instead of copies, so that the unpickled components share the
+    pipeline they are loaded into (see PipelineUnpickler).
+    """
+    
+    def __init__(self, file, nlp):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.nlp = nlp
+    
+    def persistent_id(self, obj):
+        if obj is self.nlp:
+            return 'nlp'
+        if obj is self.nlp.vocab:
+            return 'vocab'
+        return None
+
+
+class PipelineUnpickler(pickle.Unpickler):
+    """
+    Pipeline Unpickler
+    
+    Unpickles pipeline components pickled by PipelinePickler into a pipeline.
+    """
+    
+    def __init__(self, file, nlp):
+        super().__init__(file)
+        self.nlp = nlp
+    
+    def persistent_load(self, pid):
+        if pid == 'nlp':
+            return self.nlp
+        if pid == 'vocab':
+            return self.nlp.vocab
+        raise pickle.UnpicklingError('-- Error: unknown persistent ID: ' + str(pid))
+
+
+def pipe_components(pipeline, docs, batch_size=1000):
+    """
+    Apply pipeline components to a list of documents, in batches for the
+    components that have a pipe() method.
+    
+    Arguments:
+        - pipeline: list; the (name, component) pairs to apply.
+        - docs: list; the documents.
+        - batch_size: int; the number of documents passed to pipe() at a time.
+    
+    Return:
+        - docs: list; the processed documents.
+    """
+    for name, proc in pipeline:
+        if hasattr(proc, 'pipe'):
+            docs = list(proc.pipe(docs, batch_size=batch_size))
+        else:
+            docs = [proc(doc) for doc in docs]
+    return docs
+
+
+class WindowedTagger(object):
+    """
+    Windowed Tagger
+    
+    Runs the tagger only on windows of tokens around the keywords of the
+    lexicons and rules (see keyword_gate), which are found in the text of the
+    tokenized document. Each window is copied into a document of its own and
+    the windows of a batch of documents are tagged together. The tags (and
+    the lemmas and parts of speech derived from them) are copied back to the
+    document, except for the TAGGER_CONTEXT tokens at each inner end of a
+    window, whose tags may differ from those of the whole document.
+    
+    The window margin must cover the maximum match length of the rules, so
+    that every token a rule can match around a keyword is tagged as in the
+    whole document. Rules with repeated tokens have no maximum length, so the
+    windows then extend to the whole sentences of the keywords (sentences end
+    at sentence punctuation and whitespace tokens, e.g. line breaks) before
+    the margin is added.
+    
+    Tokens outside the windows are not tagged and have no lemma: no rule can
+    match them, and the DateTokenAnnotator matches on the token text. The
+    matchers require doc.is_tagged, so it is set, and the tagged windows are
+    recorded in doc._.tagged_windows (None for a document tagged as a whole).
+    """
+    
+    def __init__(self, tagger, gate, margin, sentences=False):
+        """
+        Create a new WindowedTagger instance.
+        
+        Arguments:
+            - tagger: spaCy Tagger; the tagger of the pipeline.
+            - gate: KeywordGate; the keywords to tag around.
+            - margin: int; the number of tokens tagged on each side of a
+                      keyword (or its sentence), including TAGGER_CONTEXT.
+            - sentences: bool; extend the windows to the whole sentences of
+                         the keywords.
+        """
+        self.name = 'tagger'
+        self.tagger = tagger
+        self.gate = gate
+        self.margin = margin
+        self.sentences = sentences
+        self.n_tokens = 0
+        self.n_tagged = 0
+        Doc.set_extension('tagged_windows', default=None, force=True)
+
+    def get_sentence_ends(self, doc):
+        """
+        Get the sentence boundaries of a document, without a parser: a
+        sentence ends after sentence punctuation or a whitespace token.
+        
+        Arguments:
+            - doc: spaCy Doc; the tokenized document.
+        
+        Return:
+            - ends: numpy array; the index of the last token of each sentence
+                    but the last.
+        """
+        values = doc.to_array([ORTH, IS_SPACE]).reshape((len(doc), 2))
+        punctuation = np.array([doc.vocab.strings[orth] for orth in SENTENCE_PUNCTUATION], dtype='uint64')
+        return np.nonzero(np.isin(values[:, 0], punctuation) | (values[:, 1] != 0))[0]
+
+    def get_windows(self, doc):
+        """
+        Get the windows of tokens around the keywords of a document.
+        
+        Arguments:
+            - doc: spaCy Doc; the tokenized document.
+        
+        Return:
+            - windows: list; the (start, end) token offsets of the windows, in
+                       order and without overlaps.
+        """
+        offsets = self.gate.get_hit_offsets(doc.text)
+        if len(offsets) == 0 or len(doc) == 0:
+            return []
+        starts = get_token_starts(doc)
+        ends = self.get_sentence_ends(doc) if self.sentences else None
+        windows = []
+        for start, end in offsets:
+            first = int(np.searchsorted(starts, start, side='right')) - 1
+            last = int(np.searchsorted(starts, end - 1, side='right'))
+            if ends is not None:
+                k = int(np.searchsorted(ends, first))
+                first = int(ends[k - 1]) + 1 if k > 0 else 0
+                k = int(np.searchsorted(ends, last - 1))
+                last = int(ends[k]) + 1 if k < len(ends) else len(doc)
+            lower = max(0, first - self.margin)
+            upper = min(len(doc), last + self.margin)
+            if len(windows) > 0 and lower <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], upper))
+            else:
+                windows.append((lower, upper))
+        return windows
+
+    def pipe(self, docs, batch_size=128):
+        docs = iter(docs)
+        while True:
+            batch = list(itertools.islice(docs, batch_size))
+            if len(batch) == 0:
+                break
+            windows = [self.get_windows(doc) for doc in batch]
+            window_docs = [doc[start:end].as_doc() for doc, doc_windows in zip(batch, windows) for start, end in doc_windows]
+            tagged = iter(self.tagger.pipe(window_docs, batch_size=batch_size))
+            for doc, doc_windows in zip(batch, windows):
+                for start, end in doc_windows:
+                    window_doc = next(tagged)
+                    lower = start + TAGGER_CONTEXT if start > 0 else start
+                    upper = end - TAGGER_CONTEXT if end < len(doc) else end
+                    for i in range(lower, upper):
+                        doc[i].tag_ = window_doc[i - start].tag_
+                    self.n_tagged += end - start
+                self.n_tokens += len(doc)
+                if doc_windows != [(0, len(doc))]:
+                    doc._.tagged_windows = doc_windows
+                doc.is_tagged = True
+                yield doc
+
+    def __call__(self, doc):
+        return next(self.pipe([doc]))
+
+    # the tagger model is serialized by spaCy (see OnlineActivityAnnotator.to_disk())
+    def to_disk(self, path, **kwargs):
+        return self.tagger.to_disk(path, **kwargs)
+
+    def from_disk(self, path, **kwargs):
+        self.tagger.from_disk(path, **kwargs)
+        return self
+
+    def to_bytes(self, **kwargs):
+        return self.tagger.to_bytes(**kwargs)
+
+    def from_bytes(self, bytes_data, **kwargs):
+        self.tagger.from_bytes(bytes_data, **kwargs)
+        return self
+
 
 class LemmaCorrector(object):
     """
@@ -522,11 +1728,41 @@ class LemmaCorrector(object):
         return doc
 
 
+class RuleVersionStamp(object):
+    """
+    Rule Version Stamp
+    
+    Record the version of the rule set that annotated a document in
+    doc._.rule_version (see OnlineActivityAnnotator.reload()).
+    """
+
+    def __init__(self, version):
+        """
+        Create a new RuleVersionStamp instance.
+        
+        Arguments:
+            - version: str; the rule set version.
+        """
+        self.name = 'rule_version'
+        self.version = version
+        Doc.set_extension('rule_version', default=None, force=True)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        Doc.set_extension('rule_version', default=None, force=True)
+
+    def __call__(self, doc):
+        doc._.rule_version = self.version
+        return doc
+
+
 class DateTokenAnnotator(object):
     """
     Date Token Annotator
     
-    Annotate specific and easily matched date patterns.
+    Annotate specific and easily matched date patterns. Dates are matched on
+    the token text, which is also their lemma, so that tokens outside the
+    windows of a WindowedTagger are annotated as well.
     """
 
     def __init__(self):
@@ -534,6 +1770,11 @@ class DateTokenAnnotator(object):
         Create a new DateTokenAnnotator instance.
         """
         self.name = 'date_token_annotator'
+        register_extension('TIME')
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        register_extension('TIME')
 
     def __call__(self, doc):
         # Date pattern regexes
@@ -543,9 +1784,10 @@ class DateTokenAnnotator(object):
         ddmmyy_dot = '(0?[1-9]|[12][0-9]|3[01])\.(0[1-9]|1[012])\.([0-9][0-9])'
         ddmmyyyy_dot = '(0?[1-9]|[12][0-9]|3[01])\.(0[1-9]|1[012])\.(19[0-9][0-9]|20[0-9])'
         date = '(' + yyyy + '|' + ddmmyy + '|' + ddmmyyyy + '|' + ddmmyy_dot + '|' + ddmmyyyy_dot + ')'
-        for token in doc:
-            if re.search(date, token.lemma_) is not None:
-                token._.TIME = 'TIME'
+        indices = [token.i for token in doc if re.search(date, token.text) is not None]
+        if len(indices) > 0:
+            store = get_store(doc)
+            store.set_codes('TIME', indices, store.encode('TIME'))
         return doc
 
 
@@ -565,8 +1807,27 @@ if __name__ == '__main__':
     group.add_argument('-f', '--input_file', type=str, nargs=1, help='the path to a text file to process.', required=False)
     group.add_argument('-t', '--text', type=str, nargs=1, help='a text string to process.', required=False)
     group.add_argument('-e', '--examples', action='store_true', help='run on test examples (no output to file).', required=False)
+    group.add_argument('-i', '--input_stream', type=str, nargs=1, help='stream the texts of a directory tree, a JSON lines file (.jsonl) or a CSV file (.csv) and write their mentions to -o/--output.', required=False)
     parser.add_argument('-w', '--write_output', action='store_true', help='write output to file.', required=False)
+    parser.add_argument('-o', '--output', type=str, nargs=1, help='write the mentions of -i/--input_stream or -d/--input_dir to this file (.csv, or JSON lines otherwise; default: stdout for -i).', required=False)
+    parser.add_argument('--id_field', type=str, default='id', help='the field of the text identifier in a JSON lines or CSV stream.', required=False)
+    parser.add_argument('--text_field', type=str, default='text', help='the field of the text in a JSON lines or CSV stream.', required=False)
+    parser.add_argument('--batch_size', type=int, default=1000, help='the number of texts annotated at a time in a stream.', required=False)
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose mode.', required=False)
+    parser.add_argument('-p', '--profile', type=str, nargs=1, help='profile the token sequence rules and write the report (JSON) to this path.', required=False)
+    parser.add_argument('--trace', type=str, nargs=1, help='write trace records (JSON lines) to this path instead of stderr.', required=False)
+    parser.add_argument('--trace_level', type=str, default='WARNING', help='the minimum trace level (DEBUG, INFO, WARNING, ERROR).', required=False)
+    parser.add_argument('--trace_sample', type=float, default=1.0, help='the proportion of documents to trace at DEBUG and INFO level.', required=False)
+    parser.add_argument('-c', '--doc_cache', type=str, nargs=1, help='the path to a cache of tagged documents, reused when only lexicons or rules change.', required=False)
+    parser.add_argument('--watch', type=float, nargs=1, help='reload changed lexicons and grammars, checking every N seconds.', required=False)
+    parser.add_argument('-s', '--staged', action='store_true', help='match token sequence rules at the earliest pipeline stage possible.', required=False)
+    parser.add_argument('-n', '--workers', type=int, default=1, help='the number of worker processes for a directory (-d).', required=False)
+    parser.add_argument('-l', '--lexicon', type=str, nargs='+', help='additional lexicon files (term<TAB>label) compiled into memory-mapped stores.', required=False)
+    parser.add_argument('--windowed', action='store_true', help='only tag the tokens around the keywords of the lexicons and rules.', required=False)
+    parser.add_argument('-b', '--build', type=str, nargs=1, help='build the pipeline (lexicons, rules, detokenization rules) and write it to this directory.', required=False)
+    parser.add_argument('--pipeline', type=str, nargs=1, help='load a pipeline written with -b/--build instead of building it.', required=False)
+    parser.add_argument('-g', '--gate', action='store_true', help='skip texts that contain no keyword of the lexicons and rules. Run --gate_audit on the corpus before enabling it.', required=False)
+    parser.add_argument('--gate_audit', type=str, nargs=1, help='check that the keyword gate keeps every annotated text of a directory of text files, or a file with one text per line.', required=False)
     
     if len(sys.argv) <= 1:
         parser.print_help()
@@ -574,12 +1835,31 @@ if __name__ == '__main__':
     
     args = parser.parse_args()
 
-    oaa = OnlineActivityAnnotator(verbose=args.verbose)
+    get_tracer().configure(path=args.trace[0] if args.trace is not None else None,
+                           level=args.trace_level, sample_rate=args.trace_sample)
+    if args.pipeline is not None:
+        oaa = OnlineActivityAnnotator.from_disk(args.pipeline[0], verbose=args.verbose,
+                                                doc_cache=args.doc_cache[0] if args.doc_cache is not None else None,
+                                                gate=args.gate or args.gate_audit is not None, windowed=args.windowed)
+    else:
+        oaa = OnlineActivityAnnotator(verbose=args.verbose, profile=args.profile is not None, staged=args.staged,
+                                      doc_cache=args.doc_cache[0] if args.doc_cache is not None else None,
+                                      gate=args.gate or args.gate_audit is not None, lexicons=args.lexicon,
+                                      windowed=args.windowed)
+    if args.build is not None:
+        oaa.to_disk(args.build[0])
+    if args.watch is not None:
+        oaa.watch(interval=args.watch[0])
+    if args.workers > 1:
+        oaa.start_workers(args.workers)
     
     if args.text is not None:
         oa_annotations = oaa.process_text(args.text[0], 'text_001', write_output=args.write_output, verbose=args.verbose)
     elif args.input_dir is not None:
-        if os.path.isdir(args.input_dir[0]):
+        if os.path.isdir(args.input_dir[0]) and args.output is not None:
+            with open_sink(args.output[0]) as sink:
+                oaa.process(args.input_dir[0], write_output=args.write_output, sink=sink)
+        elif os.path.isdir(args.input_dir[0]):
             oa_annotations = oaa.process(args.input_dir[0], write_output=args.write_output)
         else:
             print('-- Error: argument -d/--input_dir must be an existing directory.\n')
@@ -593,3 +1873,40 @@ if __name__ == '__main__':
     elif args.examples:
         print('-- Running examples...', file=sys.stderr)
         oa_annotations = oaa.process_text(text, 'text_001', write_output=False, verbose=True)
+    elif args.input_stream is not None:
+        if os.path.exists(args.input_stream[0]):
+            source = open_source(args.input_stream[0], id_field=args.id_field, text_field=args.text_field)
+            with open_sink(args.output[0] if args.output is not None else None) as sink:
+                oaa.process_stream(source, sink, batch_size=args.batch_size, clean_text=True)
+        else:
+            print('-- Error: argument -i/--input_stream must be an existing directory, JSON lines or CSV file.\n')
+            parser.print_help()
+
+    audit = None
+    if args.gate_audit is not None:
+        path = args.gate_audit[0]
+        if os.path.isdir(path):
+            texts = []
+            for f in sorted(os.listdir(path)):
+                with open(os.path.join(path, f), 'r', encoding='Latin-1') as fin:
+                    texts.append((f, remove_unwanted_patterns(fin.read(), verbose=False)))
+        else:
+            with open(path, 'r', encoding='utf-8') as fin:
+                texts = [(str(i), line.rstrip('\n')) for (i, line) in enumerate(fin, 1) if line.strip() != '']
+        audit = oaa.audit_keyword_gate(texts)
+
+    tagger = oaa.nlp.get_pipe('tagger') if 'tagger' in oaa.nlp.pipe_names else None
+    if isinstance(tagger, WindowedTagger) and tagger.n_tokens > 0:
+        print('-- Windowed tagging:', tagger.n_tagged, 'of', tagger.n_tokens, 'tokens tagged.', file=sys.stderr)
+
+    oaa.stop_workers()
+    oaa.stop_watching()
+    oaa.close_doc_cache()
+
+    if args.profile is not None:
+        profiler = oaa.get_rule_profiler()
+        profiler.to_json(args.profile[0])
+        print(profiler.to_table(), file=sys.stderr)
+
+    if audit is not None and len(audit['misses']) > 0:
+        sys.exit(1)
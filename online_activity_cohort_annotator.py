@@ -12,6 +12,7 @@ import sys
 
 sys.path.append('T:/Andre Bittar/workspace/utils')
 
+from corpus_stream import open_sink, open_source
 from online_activity_annotator import OnlineActivityAnnotator
 from ehost_annotation_reader import convert_file_annotations
 from pprint import pprint
@@ -118,11 +119,18 @@ def evaluate_sys(results, sys_results):
     print(report_string)
 
 
-def batch_process(main_dir):
+def batch_process(main_dir, workers=1):
     """
     Runs on actual files and outputs new XML.
+    
+    Arguments:
+        - main_dir: str; the directory of project directories.
+        - workers: int; the number of worker processes (see
+                   OnlineActivityAnnotator.start_workers()).
     """
     oaa = OnlineActivityAnnotator(verbose=False)
+    if workers > 1:
+        oaa.start_workers(workers)
     
     #main_dir = 'Z:/Andre Bittar/Projects/KA_Self-harm/data/text'
     
@@ -138,6 +146,8 @@ def batch_process(main_dir):
          print(i, '/', n, pin)
          i += 1
 
+    oaa.stop_workers()
+
     t1 = time()
     
     print(t1 - t0)
@@ -177,9 +187,37 @@ def process(pin):
     return df
 
 
+def stream_process(pin, pout, batch_size=1000):
+    """
+    Runs on an export of the text of each file (JSON lines or CSV, with
+    cn_doc_id and text_content fields) without loading it into memory.
+    Writes the mentions of each document to a CSV (one row per mention) or
+    JSON lines file; documents with a relevant mention are those that have
+    a row in the CSV file.
+    
+    Arguments:
+        - pin: str; the path to the JSON lines (.jsonl) or CSV (.csv) file.
+        - pout: str; the path to the output file.
+        - batch_size: int; the number of documents annotated at a time.
+    
+    Return:
+        - stats: dict; the statistics of the run (see
+                 OnlineActivityAnnotator.process_stream()).
+    """
+    oaa = OnlineActivityAnnotator(verbose=False)
+    source = open_source(pin, id_field='cn_doc_id', text_field='text_content')
+    with open_sink(pout) as sink:
+        stats = oaa.process_stream(source, sink, batch_size=batch_size, clean_text=False)
+    
+    print('-- Wrote file:', pout)
+    
+    return stats
+
+
 if __name__ == '__main__':
     print('-- Run one of the two functions...', file=sys.stderr)
     #test()
     #df_processed = process('Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text.pickle', check_temporality=True)
+    #stream_process('Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text.jsonl', 'Z:/Andre Bittar/Projects/KA_Self-harm/data/all_text_oa.csv')
     #batch_process('T:/Andre Bittar/Projects/KA_Self-harm/Adjudication/system_train_dev_patient/files')
     
\ No newline at end of file
@@ -5,7 +5,6 @@ from spacy.tokens import Token
 #################################
 
 Token.set_extension('MENTION', default=False, force=True)
-Token.set_extension('TIME', default=False, force=True) # this shouldn't be here but it is called in the main class for dates
 
 #################################
 # Token sequence rules, Level 0 #
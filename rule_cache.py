@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    Rule Cache
+
+    Helper functions to store compiled annotation resources (token sequence
+    grammars, lexicons) on disk. Compiled files are written to a __pycache__
+    directory next to their source file and are keyed by a hash of the source
+    file, so an edited resource is never served from a stale cache. The files
+    compiled from earlier versions of a source file are removed when a new
+    one is written.
+"""
+
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import sys
+
+CACHE_DIR = '__pycache__'
+# Name of a compiled cache file: <source name>.<digest>.<kind><ext>
+CACHE_NAME = re.compile(r'^(.*)\.[0-9a-f]{16}\.(.*)$')
+
+
+def file_digest(path, *extra):
+    """
+    Compute a hash of a file's contents.
+
+    Arguments:
+        - path: str; the path to the file.
+        - extra: str; additional values to include in the hash (e.g. a
+                 format version or a tokenizer fingerprint).
+
+    Return:
+        - digest: str; the hexadecimal SHA-1 digest.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        sha.update(fin.read())
+    for value in extra:
+        sha.update(str(value).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def get_cache_path(path, digest, kind, ext='.pickle'):
+    """
+    Get the path of the compiled cache file for a source file.
+
+    Arguments:
+        - path: str; the path to the source file.
+        - digest: str; the hash of the source file.
+        - kind: str; the type of compiled resource (e.g. grammar, lexicon).
+        - ext: str; the file extension ('' for a directory).
+
+    Return:
+        - cache_path: str; the path to the compiled cache file.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    name = os.path.splitext(basename)[0] + '.' + digest[:16] + '.' + kind + ext
+    return os.path.join(dirname, CACHE_DIR, name)
+
+
+def remove_stale_cache(cache_path):
+    """
+    Remove the compiled cache files of the same kind that were written for
+    earlier versions of the source file of a cache file.
+
+    Arguments:
+        - cache_path: str; the path to the current compiled cache file (see
+                      get_cache_path()).
+    """
+    dirname, name = os.path.split(cache_path)
+    match = CACHE_NAME.match(name)
+    if match is None or not os.path.isdir(dirname):
+        return
+    for other in os.listdir(dirname):
+        other_match = CACHE_NAME.match(other)
+        if other == name or other_match is None or other_match.groups() != match.groups():
+            continue
+        other_path = os.path.join(dirname, other)
+        try:
+            if os.path.isdir(other_path):
+                shutil.rmtree(other_path)
+            else:
+                os.remove(other_path)
+        except OSError as e:
+            # another process may have removed it first
+            if os.path.exists(other_path):
+                print('-- Warning: unable to remove stale cache file', other_path, file=sys.stderr)
+                print(e, file=sys.stderr)
+
+
+def load_cache(cache_path):
+    """
+    Load a compiled resource from the cache.
+
+    Arguments:
+        - cache_path: str; the path to the compiled cache file.
+
+    Return:
+        - data: object; the compiled resource, or None if the cache file does
+                not exist or cannot be read.
+    """
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, 'rb') as fin:
+            return pickle.load(fin)
+    except Exception as e:
+        print('-- Warning: unable to read cache file', cache_path, file=sys.stderr)
+        print(e, file=sys.stderr)
+        return None
+
+
+def save_cache(cache_path, data):
+    """
+    Save a compiled resource to the cache. The file is written to a temporary
+    path first and then renamed, so that concurrent processes never read a
+    partially written file. The cache files of earlier versions of the source
+    file are removed (see remove_stale_cache()).
+
+    Arguments:
+        - cache_path: str; the path to the compiled cache file.
+        - data: object; the compiled resource (must be picklable).
+    """
+    tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, 'wb') as fout:
+            pickle.dump(data, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+        remove_stale_cache(cache_path)
+    except OSError as e:
+        print('-- Warning: unable to write cache file', cache_path, file=sys.stderr)
+        print(e, file=sys.stderr)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    Shared fixtures of the tests.
+
+    The annotator modules are flat top-level modules, so the repository root
+    is added to the import path. Pipelines are built from en_core_web_sm if it
+    is installed, and from a blank English pipeline (lookup lemmas, no tagger)
+    otherwise.
+"""
+
+import ast
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pytest
+import spacy
+
+from annotation_store import get_store
+from lexical_annotator import CombinedLexicalAnnotator, LexicalAnnotatorSequence
+from spacy.symbols import LOWER
+from token_sequence_annotator import TokenSequenceAnnotator
+
+RESOURCE_DIR = os.path.join(ROOT, 'resources')
+
+# Lexicons of the online activity annotator, in pipeline order
+LEXICONS = ['social_media_lex.txt', 'internet_lex.txt', 'online_gaming_lex.txt', 'health_website_lex.txt']
+
+
+def load_nlp():
+    """
+    Load the spaCy pipeline the annotators are added to.
+
+    Return:
+        - nlp: spaCy Language; en_core_web_sm, or a blank English pipeline.
+    """
+    try:
+        return spacy.load('en_core_web_sm', disable=['ner', 'parser'])
+    except OSError:
+        nlp = spacy.blank('en')
+        nlp.add_pipe(set_lookup_lemmas, name='lookup_lemmatizer')
+        return nlp
+
+
+def set_lookup_lemmas(doc):
+    # lookup lemmas of a blank pipeline are only computed when read, so they
+    # are stored on the tokens for the matchers (there are no POS tags)
+    for token in doc:
+        token.lemma_ = token.lemma_
+    doc.is_tagged = True
+    return doc
+
+
+def add_lexicons(nlp, use_cache=False):
+    """
+    Add the LA lexicons to a pipeline in a combined lexical annotator.
+
+    Arguments:
+        - nlp: spaCy Language; the spaCy pipeline.
+        - use_cache: bool; use the compiled lexicon cache.
+
+    Return:
+        - combined: CombinedLexicalAnnotator; the lexical annotator.
+    """
+    combined = CombinedLexicalAnnotator(nlp, name='lexical_annotator')
+    for name in LEXICONS:
+        lsa = LexicalAnnotatorSequence(nlp, os.path.join(RESOURCE_DIR, name), LOWER, 'LA')
+        lsa.load_lexicon(use_cache=use_cache)
+        lsa.add_to_component(combined)
+    nlp.add_pipe(combined, last=True)
+    return combined
+
+
+def make_pipeline(**kwargs):
+    """
+    Build a pipeline with the LA lexicons and the level0 token sequence rules.
+
+    Arguments:
+        - kwargs: dict; the TokenSequenceAnnotator settings.
+
+    Return:
+        - nlp: spaCy Language; the spaCy pipeline.
+    """
+    nlp = load_nlp()
+    add_lexicons(nlp)
+    tsa = TokenSequenceAnnotator(nlp, 'level0', verbose=False, use_cache=False, **kwargs)
+    nlp = tsa.add_stage_components(nlp)
+    nlp.add_pipe(tsa, last=True)
+    return nlp
+
+
+def get_annotations(doc):
+    """
+    Get the tokens and all custom annotations of a document.
+
+    Return:
+        - annotations: tuple; the token texts and the annotation columns.
+    """
+    return [token.text for token in doc], get_store(doc).to_dict()
+
+
+def read_example_texts():
+    """
+    Read all the example texts assigned in examples/test_examples.py.
+
+    Return:
+        - texts: list; the example texts.
+    """
+    with open(os.path.join(ROOT, 'examples', 'test_examples.py'), 'r', encoding='utf-8') as fin:
+        tree = ast.parse(fin.read())
+    return [node.value.value for node in tree.body
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)]
+
+
+@pytest.fixture(scope='session')
+def example_texts():
+    return read_example_texts()
+
+
+@pytest.fixture(scope='session')
+def shared_nlp():
+    return make_pipeline(shared_matcher=True)
+
+
+@pytest.fixture(scope='session')
+def rule_nlp():
+    return make_pipeline(shared_matcher=False)
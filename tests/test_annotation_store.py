@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pickle
+import spacy
+
+from annotation_store import STORE_KEY, get_bitset_predicate, get_store, register_bitset, register_extension
+from lexical_annotator import add_lexical_annotations
+from spacy.tokens import Doc, DocBin
+
+
+def make_doc(text):
+    register_bitset('LA')
+    register_extension('MENTION')
+    return spacy.blank('en')(text)
+
+
+def test_lexicon_labels_accumulate():
+    doc = make_doc('she uses health web sites')
+    add_lexical_annotations(doc, [(0, 2, 5)], 'LA', 'INTERNET')
+    add_lexical_annotations(doc, [(0, 2, 4)], 'LA', 'HEALTH_WEB')
+    internet = get_bitset_predicate('LA', ['INTERNET'])
+    health_web = get_bitset_predicate('LA', ['HEALTH_WEB'])
+    assert [token._.get(internet) for token in doc] == [False, False, True, True, True]
+    assert [token._.get(health_web) for token in doc] == [False, False, True, True, False]
+    assert doc[2]._.LA == 'HEALTH_WEB'
+    assert doc[2]._.LA_SET == 'INTERNET|HEALTH_WEB'
+
+
+def test_rule_label_replaces_lexicon_labels():
+    doc = make_doc('she uses health web sites')
+    add_lexical_annotations(doc, [(0, 2, 5)], 'LA', 'INTERNET')
+    add_lexical_annotations(doc, [(0, 2, 4)], 'LA', 'HEALTH_WEB')
+    get_store(doc).set('LA', 2, 4, 'GAMING')
+    assert doc[2]._.LA_SET == 'GAMING'
+    assert not doc[2]._.get(get_bitset_predicate('LA', ['INTERNET']))
+    assert doc[2]._.get(get_bitset_predicate('LA', ['HEALTH_WEB'], negate=True))
+    get_store(doc).set_codes('LA', [4], 0)
+    assert doc[4]._.LA is False
+    assert doc[4]._.LA_SET is False
+
+
+def test_rules_read_labels_of_earlier_rules(shared_nlp):
+    # ONLINE_GAMING relabels 'online' GAMING, so INTERNET_SEQUENCE must not
+    # match it on its lexicon label INTERNET
+    doc = shared_nlp('she plays online games')
+    assert [token._.MENTION for token in doc[2:]] == ['ONLINE_GAMING', 'ONLINE_GAMING']
+    assert [token._.LA for token in doc[2:]] == ['GAMING', 'GAMING']
+    assert [token._.LA_SET for token in doc[2:]] == ['GAMING', 'GAMING']
+
+
+def test_annotations_are_serialized_with_the_doc():
+    doc = make_doc('she uses health web sites')
+    add_lexical_annotations(doc, [(0, 2, 5)], 'LA', 'INTERNET')
+    add_lexical_annotations(doc, [(0, 2, 4)], 'LA', 'HEALTH_WEB')
+    expected = get_store(doc).to_dict()
+    copy = Doc(doc.vocab).from_bytes(doc.to_bytes())
+    assert get_store(copy).to_dict() == expected
+    doc_bin = DocBin(store_user_data=True)
+    doc_bin.add(doc)
+    copy = list(DocBin(store_user_data=True).from_bytes(doc_bin.to_bytes()).get_docs(doc.vocab))[0]
+    assert [token._.LA_SET for token in copy] == [False, False, 'INTERNET|HEALTH_WEB', 'INTERNET|HEALTH_WEB', 'INTERNET']
+    assert pickle.loads(pickle.dumps(doc))[4]._.LA == 'INTERNET'
+
+
+def test_bits_are_mapped_to_the_labels_of_the_process():
+    doc = make_doc('she uses health web sites')
+    add_lexical_annotations(doc, [(0, 2, 5)], 'LA', 'INTERNET')
+    copy = Doc(doc.vocab).from_bytes(doc.to_bytes())
+    # another process assigned the bits of the labels in another order
+    data = copy.user_data[STORE_KEY]
+    data['labels'] = {'LA': ['OTHER', 'INTERNET']}
+    data['columns']['LA_SET'] = data['columns']['LA_SET'] * 0 + np.uint64(2) * (data['columns']['LA'] != 0)
+    assert copy[4]._.LA_SET == 'INTERNET'
+    assert copy[4]._.get(get_bitset_predicate('LA', ['INTERNET']))
+    assert not copy[1]._.get(get_bitset_predicate('LA', ['INTERNET']))
+
+
+def test_annotations_are_realigned_after_retokenization():
+    doc = make_doc('she uses health web sites daily')
+    add_lexical_annotations(doc, [(0, 2, 5)], 'LA', 'INTERNET')
+    get_store(doc).set('MENTION', 0, 1, 'PERSON')
+    with doc.retokenize() as retokenizer:
+        retokenizer.merge(doc[2:5])
+    with doc.retokenize() as retokenizer:
+        retokenizer.split(doc[0], ['s', 'he'], heads=[(doc[0], 1), doc[1]])
+    get_store(doc)
+    assert [token.text for token in doc] == ['s', 'he', 'uses', 'health web sites', 'daily']
+    assert [token._.LA for token in doc] == [False, False, False, 'INTERNET', False]
+    assert [token._.LA_SET for token in doc] == [False, False, False, 'INTERNET', False]
+    assert [token._.MENTION for token in doc] == ['PERSON', False, False, False, False]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import os
+import pytest
+import types
+
+from corpus_stream import open_sink, open_source
+
+TEXTS = [('n1', 'She plays minecraft.'), ('n2', 'A "quoted", multi-line\nnote'), ('n3', 'x' * 200000)]
+MENTIONS = {'EHOST_Instance_1': {'annotator': 'SYSTEM', 'class': 'ONLINE_GAMING', 'comment': None, 'end': '19',
+                                 'start': '10', 'text': 'minecraft', 'rule_version': 'v1'}}
+
+
+def test_jsonl_source(tmp_path):
+    path = str(tmp_path / 'notes.jsonl')
+    with open(path, 'w', encoding='utf-8') as fout:
+        for text_id, text in TEXTS:
+            fout.write(json.dumps({'doc_id': text_id, 'body': text}) + '\n')
+        fout.write('\n' + json.dumps({'body': None}) + '\n')
+    source = open_source(path, id_field='doc_id', text_field='body')
+    assert isinstance(source, types.GeneratorType)
+    # records without an identifier are numbered by line
+    assert list(source) == TEXTS + [('5', '')]
+
+
+def test_csv_source(tmp_path):
+    path = str(tmp_path / 'notes.csv')
+    with open(path, 'w', encoding='utf-8', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(['id', 'text'])
+        writer.writerows(TEXTS)
+    assert list(open_source(path)) == TEXTS
+
+
+def test_directory_source(tmp_path):
+    for text_id, text in TEXTS:
+        (tmp_path / 'corpus' / text_id).mkdir(parents=True)
+        (tmp_path / 'corpus' / text_id / 'note.txt').write_text(text, encoding='Latin-1')
+    (tmp_path / 'corpus' / 'n1' / 'note.xml').write_text('<xml/>')
+    assert list(open_source(str(tmp_path / 'corpus'))) == [(os.path.join(text_id, 'note.txt'), text) for text_id, text in TEXTS]
+    with pytest.raises(ValueError):
+        open_source(str(tmp_path / 'notes.txt'))
+
+
+def test_sinks(tmp_path):
+    path = str(tmp_path / 'mentions.csv')
+    with open_sink(path) as sink:
+        sink.write('n1', MENTIONS)
+        sink.write('n2', {})
+    assert (sink.n_texts, sink.n_mentions) == (2, 1)
+    with open(path, 'r', encoding='utf-8', newline='') as fin:
+        assert list(csv.reader(fin)) == [['id', 'start', 'end', 'class', 'text', 'rule_version'],
+                                         ['n1', '10', '19', 'ONLINE_GAMING', 'minecraft', 'v1']]
+    path = str(tmp_path / 'mentions.jsonl')
+    with open_sink(path) as sink:
+        sink.write('n1', MENTIONS)
+        sink.write('n2', {})
+    with open(path, 'r', encoding='utf-8') as fin:
+        assert [json.loads(line) for line in fin] == [{'id': 'n1', 'mentions': list(MENTIONS.values())},
+                                                      {'id': 'n2', 'mentions': []}]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import pytest
+import spacy
+
+from doc_cache import DocCache
+
+N_WORKERS = 4
+N_DOCS = 50
+
+
+def put_docs(path, worker):
+    nlp = spacy.blank('en')
+    cache = DocCache(path, 'fingerprint', commit_interval=1)
+    for n in range(N_DOCS):
+        text = 'worker {} document {}'.format(worker, n)
+        cache.put(text, nlp(text))
+    cache.close()
+    return cache.n_errors
+
+
+def test_workers_share_the_cache(tmp_path):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('fork start method not available')
+    path = str(tmp_path / 'docs.sqlite')
+    context = multiprocessing.get_context('fork')
+    with context.Pool(N_WORKERS) as pool:
+        errors = pool.starmap(put_docs, [(path, worker) for worker in range(N_WORKERS)])
+    assert errors == [0] * N_WORKERS
+
+    nlp = spacy.blank('en')
+    cache = DocCache(path, 'fingerprint')
+    for worker in range(N_WORKERS):
+        for n in range(N_DOCS):
+            text = 'worker {} document {}'.format(worker, n)
+            assert cache.get(text, nlp.vocab).text == text
+    assert cache.n_hits == N_WORKERS * N_DOCS
+    cache.close()
+
+
+def test_cache_reads_entries_pending_elsewhere(tmp_path):
+    path = str(tmp_path / 'docs.sqlite')
+    nlp = spacy.blank('en')
+    writer = DocCache(path, 'fingerprint')
+    writer.put('a pending document', nlp('a pending document'))
+    reader = DocCache(path, 'fingerprint')
+    # an open write transaction does not block the readers
+    assert reader.get('a pending document', nlp.vocab) is None
+    writer.commit()
+    assert reader.get('a pending document', nlp.vocab).text == 'a pending document'
+    writer.close()
+    reader.close()
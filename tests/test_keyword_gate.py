@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import pytest
+
+from conftest import LEXICONS, RESOURCE_DIR, load_nlp
+from keyword_gate import build_keyword_gate, build_trie_regex, get_regex_literals, get_rule_keywords, get_term_keywords
+from lexical_annotator import LexicalAnnotatorSequence
+from spacy.symbols import LOWER
+
+
+def get_lexicon_keywords(nlp):
+    """
+    Get the keywords of the LA lexicons, as in
+    OnlineActivityAnnotator.get_lexicon_keywords().
+    """
+    keywords = []
+    for name in LEXICONS:
+        lsa = LexicalAnnotatorSequence(nlp, os.path.join(RESOURCE_DIR, name), LOWER, 'LA')
+        lsa.load_lexicon(use_cache=False)
+        for label in lsa.get_labels():
+            terms = [[token.text for token in doc] for doc in lsa.patterns[label]]
+            keywords.append(('LA', label, get_term_keywords(terms, 'LOWER')))
+    return keywords
+
+
+@pytest.fixture(scope='module')
+def gate(shared_nlp):
+    rules = shared_nlp.get_pipe('token_sequence_annotator_level0').rules
+    return build_keyword_gate(rules, get_lexicon_keywords(load_nlp()))
+
+
+@pytest.mark.parametrize('regex, literals', [
+    ('(chat|communicat|talk).*', {'chat', 'communicat', 'talk'}),
+    ('^e-?(communicat).*', {'communicat'}),
+    ('.+temporary.*', {'temporary'}),
+    ('^#[A-Za-z]+[^ ]+$', {'#'}),
+    ('(?<=^|(?<=[^a-zA-Z0-9-\\.]))@([A-Za-z0-9_]+)', {'@'}),
+    ('(Face|Snap)(book|chat)?', {'face', 'snap'}),
+    ('[a-z]+', None),
+    ('(', None)
+])
+def test_regex_literals(regex, literals):
+    assert get_regex_literals(regex) == literals
+
+
+def test_rule_keywords(shared_nlp):
+    rules = dict((rule['name'], rule) for rule in shared_nlp.get_pipe('token_sequence_annotator_level0').rules)
+    label_keywords = {('LA', 'GAMING'): {'minecraft', 'xbox'}, ('LA', 'INTERNET'): None}
+    assert get_rule_keywords(rules['CHAT_ONLINE']['pattern'], label_keywords) == {'onlin', 'on-lin'}
+    assert get_rule_keywords(rules['PC_GAMING']['pattern'], label_keywords) == {'gam', 'gamer', 'gaming'}
+    assert get_rule_keywords(rules['SURF_THE_WEB']['pattern'], label_keywords) == {'internet', 'inter-net', 'web'}
+    assert get_rule_keywords(rules['GAMING_SEQUENCE']['pattern'], label_keywords) == {'minecraft', 'xbox'}
+    # a label that cannot be reduced to keywords
+    assert get_rule_keywords(rules['INTERNET_SEQUENCE']['pattern'], label_keywords) is None
+    # a label that no lexicon sets does not drop the other keywords
+    assert get_rule_keywords(rules['WEB_HEALTH_WEB']['pattern'], label_keywords) == {'website'}
+    assert get_rule_keywords(rules['WEB_HEALTH_WEB']['pattern'], label_keywords, {('LA', 'HEALTH_WEB')}) == {'website'}
+    # a label that only another positive rule annotates
+    pattern = [{'_': {'MENTION': 'INTERNET'}}, {'_': {'LA': 'GAMING'}, 'OP': '?'}]
+    assert get_rule_keywords(pattern, label_keywords, {('MENTION', 'INTERNET')}) == set()
+    # a label annotated by another component (e.g. TIME) cannot be gated
+    assert get_rule_keywords(pattern, label_keywords) is None
+    assert get_rule_keywords([{'_': {'TIME': 'PAST'}}, {'_': {'LA': 'GAMING'}}], label_keywords) == {'minecraft', 'xbox'}
+
+
+def test_trie_regex_finds_the_keywords(gate):
+    keywords = gate.keywords
+    assert len(keywords) > 100
+    regex = re.compile(build_trie_regex(keywords))
+    texts = keywords + [keyword[:-1] for keyword in keywords] + ['x' + keyword + 'x' for keyword in keywords]
+    for text in texts:
+        assert (regex.search(text) is not None) == any(keyword in text for keyword in keywords), text
+
+
+def test_gate_keeps_annotated_texts(gate, shared_nlp, example_texts):
+    texts = list(example_texts)
+    for name in LEXICONS:
+        with open(os.path.join(RESOURCE_DIR, name), 'r', encoding='utf-8') as fin:
+            texts.extend(['she uses ' + line.split('\t')[0] + ' a lot' for line in fin.read().splitlines() if '\t' in line])
+    n_annotated = 0
+    for text in texts:
+        if any(token._.MENTION for token in shared_nlp(text)):
+            n_annotated += 1
+            assert gate.has_keyword(text), text
+    assert n_annotated > 200
+    assert not gate.has_keyword('The patient was seen in clinic today.')
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import os
+import spacy
+
+from conftest import LEXICONS, RESOURCE_DIR, add_lexicons, get_annotations, load_nlp
+from lexical_annotator import CombinedLexicalAnnotator, LemmaAnnotator, LexicalAnnotatorSequence, add_entities, get_lexeme_flag
+from rule_cache import CACHE_DIR
+from spacy.matcher import Matcher
+from spacy.symbols import LOWER, ORTH
+from spacy.tokens import Span
+from vocab_flags import VOCAB_FLAGS
+
+
+def test_lexicon_matches_do_not_fill_empty_ents():
+    nlp = load_nlp()
+    add_lexicons(nlp)
+    doc = nlp('she posts on facebook and plays minecraft online')
+    assert doc[3]._.LA is not False
+    assert doc.ents == ()
+
+
+def test_longer_spans_replace_overlapping_entities():
+    nlp = spacy.blank('en')
+    doc = nlp('she uses health web sites and twitter daily')
+    label = nlp.vocab.strings.add('ORG')
+    doc.ents = [Span(doc, 3, 4, label=label), Span(doc, 6, 7, label=label)]
+    label = nlp.vocab.strings.add('LA')
+    add_entities(doc, [Span(doc, 2, 5, label=label), Span(doc, 0, 1, label=label), Span(doc, 6, 7, label=label)])
+    # 'she' overlaps no entity and 'twitter' is not longer than the existing one
+    assert [(ent.start, ent.end, ent.label_) for ent in doc.ents] == [(2, 5, 'LA'), (6, 7, 'ORG')]
+
+
+def test_new_lexicon_cache_replaces_the_old_one(tmp_path):
+    path = str(tmp_path / 'online_gaming_lex.txt')
+    with open(os.path.join(RESOURCE_DIR, 'online_gaming_lex.txt'), 'r', encoding='utf-8') as fin:
+        lines = fin.read().splitlines()
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    nlp = load_nlp()
+    LexicalAnnotatorSequence(nlp, path, LOWER, 'LA').load_lexicon(use_cache=True)
+    old_names = os.listdir(str(tmp_path / CACHE_DIR))
+    assert len(old_names) == 1 and old_names[0].endswith('.lexicon.pickle')
+
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(lines + ['roblox\tGAMING']) + '\n')
+    lsa = LexicalAnnotatorSequence(nlp, path, LOWER, 'LA')
+    lsa.load_lexicon(use_cache=True)
+    names = os.listdir(str(tmp_path / CACHE_DIR))
+    assert len(names) == 1 and names != old_names
+    assert ['roblox'] in [[token.text for token in doc] for doc in lsa.patterns['GAMING']]
+
+
+def get_lexicon_texts(example_texts):
+    texts = list(example_texts)
+    for name in LEXICONS:
+        with open(os.path.join(RESOURCE_DIR, name), 'r', encoding='utf-8') as fin:
+            terms = [line.split('\t')[0] for line in fin.read().splitlines() if '\t' in line]
+        texts.extend(['she uses ' + term + ' every day' for term in terms])
+        texts.append('On ' + ', '.join(term.upper() for term in terms) + '.')
+    return texts
+
+
+def test_combined_annotator_matches_label_components(example_texts):
+    combined_nlp = load_nlp()
+    add_lexicons(combined_nlp)
+    label_nlp = load_nlp()
+    for name in LEXICONS:
+        lsa = LexicalAnnotatorSequence(label_nlp, os.path.join(RESOURCE_DIR, name), LOWER, 'LA')
+        lsa.load_lexicon(use_cache=False)
+        lsa.add_components()
+    assert len(label_nlp.pipe_names) > len(combined_nlp.pipe_names)
+    for text in get_lexicon_texts(example_texts):
+        assert get_annotations(combined_nlp(text)) == get_annotations(label_nlp(text)), text
+
+
+def test_lexeme_flags():
+    nlp = spacy.blank('en')
+    lower_flag = get_lexeme_flag(nlp.vocab, LOWER, ['minecraft', 'roblox'])
+    orth_flag = get_lexeme_flag(nlp.vocab, ORTH, ['Minecraft'])
+    assert get_lexeme_flag(nlp.vocab, LOWER, ['roblox', 'minecraft']) == lower_flag
+    assert orth_flag != lower_flag
+    # the words are only added to the vocabulary after the flags
+    doc = nlp('MineCraft or Minecraft or roblox or minecrafts')
+    assert [token.check_flag(lower_flag) for token in doc] == [True, False, True, False, True, False, False]
+    assert [token.check_flag(orth_flag) for token in doc] == [False, False, True, False, False, False, False]
+
+
+def test_lexeme_flags_are_not_reused_across_vocabularies():
+    nlp = spacy.blank('en')
+    flag_id = get_lexeme_flag(nlp.vocab, LOWER, ['minecraft', 'roblox'])
+    # a new vocabulary given the id of a dead one
+    new_nlp = spacy.blank('en')
+    VOCAB_FLAGS[id(new_nlp.vocab)] = dict(VOCAB_FLAGS[id(nlp.vocab)])
+    new_flag_id = get_lexeme_flag(new_nlp.vocab, LOWER, ['minecraft', 'roblox'])
+    assert [token.check_flag(new_flag_id) for token in new_nlp('Roblox or chess')] == [True, False, False]
+    assert get_lexeme_flag(new_nlp.vocab, LOWER, ['roblox', 'minecraft']) == new_flag_id
+
+
+def test_combined_annotator_with_one_flag():
+    nlp = spacy.blank('en')
+    combined = CombinedLexicalAnnotator(nlp)
+    combined.add_terms('lex_GAMING', ['minecraft', 'roblox', 'video game'], LOWER, 'LA', 'GAMING')
+    assert len(combined.flag_ids) == 1
+    doc = combined(nlp('Roblox and a video game, not chess'))
+    assert [token.text for token in doc if token._.LA == 'GAMING'] == ['Roblox', 'video', 'game']
+
+
+def test_unpickled_combined_annotator_without_free_flags(example_texts):
+    nlp = load_nlp()
+    combined = add_lexicons(nlp)
+    assert len(combined.flag_ids) > 0
+    texts = get_lexicon_texts(example_texts)
+    annotations = [get_annotations(nlp(text)) for text in texts]
+    # the components are unpickled into a vocabulary without free flags
+    VOCAB_FLAGS.pop(id(nlp.vocab))
+    while True:
+        try:
+            nlp.vocab.add_flag(lambda string: False)
+        except ValueError:
+            break
+    state = combined.__getstate__()
+    restored = CombinedLexicalAnnotator.__new__(CombinedLexicalAnnotator)
+    restored.__setstate__(state)
+    assert restored.flag_ids == [] and restored.flag_keys == []
+    nlp.replace_pipe('lexical_annotator', restored)
+    assert [get_annotations(nlp(text)) for text in texts] == annotations
+
+
+def test_lemma_annotator_matches_lemma_patterns():
+    nlp = load_nlp()
+    lemma_sequences = ['play game', 'video game', 'chat', 'be online']
+    annotator = LemmaAnnotator(nlp, lemma_sequences, 'LA', 'GAMING', 'lex_GAMING')
+    matcher = Matcher(nlp.vocab)
+    for lemmas in lemma_sequences:
+        matcher.add('GAMING', None, [{'LEMMA': lemma} for lemma in lemmas.split()])
+    texts = ['He played games and video games, then chatted.', 'She was online, is online and plays a game.',
+             'Chats about playing games']
+    for doc in nlp.pipe(texts):
+        assert sorted(annotator.matcher(doc)) == sorted(matcher(doc)), doc.text
+    doc = annotator(nlp('He played games and chatted.'))
+    assert [token.text for token in doc if token._.LA == 'GAMING'] == ['played', 'games', 'chatted']
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+
+from conftest import LEXICONS, RESOURCE_DIR, load_nlp
+from lexicon_store import load_lexicon_store, read_lexicon
+from rule_cache import CACHE_DIR
+from spacy.matcher import PhraseMatcher
+from spacy.symbols import LOWER
+
+
+def write_lexicon(path, lines):
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(lines) + '\n')
+
+
+def read_lexicon_lines(name):
+    with open(os.path.join(RESOURCE_DIR, name), 'r', encoding='utf-8') as fin:
+        return [line for line in fin.read().splitlines() if '\t' in line]
+
+
+def test_new_store_replaces_the_old_one(tmp_path):
+    path = str(tmp_path / 'games_lex.txt')
+    lines = read_lexicon_lines('online_gaming_lex.txt')
+    write_lexicon(path, lines)
+    nlp = load_nlp()
+    load_lexicon_store(nlp, path, LOWER)
+    old_names = os.listdir(str(tmp_path / CACHE_DIR))
+    assert len(old_names) == 1 and old_names[0].endswith('.lexicon_store')
+
+    write_lexicon(path, lines + ['roblox\tGAMING'])
+    store = load_lexicon_store(nlp, path, LOWER)
+    names = os.listdir(str(tmp_path / CACHE_DIR))
+    assert len(names) == 1 and names != old_names
+    assert [(store.labels[label], start, end) for (label, start, end) in store.match(nlp('she plays roblox'))] == [('GAMING', 2, 3)]
+
+
+@pytest.mark.parametrize('name', LEXICONS)
+def test_store_matches_phrase_matcher(tmp_path, name, example_texts):
+    nlp = load_nlp()
+    path = str(tmp_path / name)
+    write_lexicon(path, read_lexicon_lines(name))
+    store = load_lexicon_store(nlp, path, LOWER)
+    matcher = PhraseMatcher(nlp.vocab, attr=LOWER)
+    terms = {}
+    for term, label in read_lexicon(path):
+        terms.setdefault(label, []).append(term)
+    for label in terms:
+        matcher.add(label, None, *[nlp.make_doc(term) for term in terms[label]])
+    texts = example_texts + ['she uses ' + term.upper() + ' every day' for label in terms for term in terms[label]]
+    n_matches = 0
+    for doc in nlp.pipe(texts):
+        expected = sorted((nlp.vocab.strings[match_id], start, end) for match_id, start, end in matcher(doc))
+        assert sorted((store.labels[label], start, end) for label, start, end in store.match(doc)) == expected, doc.text
+        n_matches += len(expected)
+    assert n_matches > len(terms)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+import shutil
+
+from conftest import RESOURCE_DIR, load_nlp
+from spacy.symbols import LOWER
+
+oaa_module = pytest.importorskip('online_activity_annotator')
+
+
+def make_annotator(lexicon_path):
+    """
+    Build an annotator with a single lexicon and the level0 rules on the test
+    pipeline (see conftest.load_nlp()).
+    """
+    oaa = oaa_module.OnlineActivityAnnotator.__new__(oaa_module.OnlineActivityAnnotator)
+    oaa.init_settings(False, False, False, None, False, None)
+    oaa.nlp = load_nlp()
+    oaa.base_pipe_names = list(oaa.nlp.pipe_names)
+    oaa.load_lexicon(lexicon_path, LOWER, 'LA')
+    oaa.load_token_sequence_annotator('level0')
+    oaa.nlp.add_pipe(oaa_module.RuleVersionStamp(oaa.get_rule_version()), last=True)
+    return oaa
+
+
+def test_failed_reload_is_retried(tmp_path, monkeypatch):
+    path = str(tmp_path / 'online_gaming_lex.txt')
+    shutil.copy(os.path.join(RESOURCE_DIR, 'online_gaming_lex.txt'), path)
+    oaa = make_annotator(path)
+    digest = oaa.lexicons[0]['digest']
+    version = oaa.get_rule_version()
+    assert oaa.nlp('she plays roblox')._.rule_version == version
+
+    with open(path, 'r') as fin:
+        lines = fin.read().splitlines()
+    with open(path, 'w') as fout:
+        fout.write('\n'.join(lines + ['roblox\tGAMING']) + '\n')
+
+    def fail(*args, **kwargs):
+        raise IOError('lexicon unavailable')
+
+    monkeypatch.setattr(oaa, 'make_lexicon_components', fail)
+    with pytest.raises(IOError):
+        oaa.reload()
+    assert oaa.lexicons[0]['digest'] == digest
+    assert oaa.get_rule_version() == version
+    monkeypatch.undo()
+
+    assert oaa.reload()
+    assert oaa.lexicons[0]['digest'] != digest
+    doc = oaa.nlp('she plays roblox')
+    assert doc._.rule_version == oaa.get_rule_version() != version
+    assert doc[2]._.LA == 'GAMING'
+    assert not oaa.reload()
+
+
+def test_edited_lexicon_reloads_reuse_flags(tmp_path):
+    path = str(tmp_path / 'online_gaming_lex.txt')
+    shutil.copy(os.path.join(RESOURCE_DIR, 'online_gaming_lex.txt'), path)
+    with open(path, 'r') as fin:
+        lines = fin.read().splitlines()
+    oaa = make_annotator(path)
+    n_flags = []
+    # each edit changes the single-token terms of the GAMING key
+    for n in range(60):
+        with open(path, 'w') as fout:
+            fout.write('\n'.join(lines + ['gamex{}\tGAMING'.format(n)]) + '\n')
+        assert oaa.reload()
+        doc = oaa.nlp('she plays gamex{} and gamex{}'.format(n, n - 1))
+        assert doc[2]._.LA == 'GAMING'
+        assert doc[4]._.LA is False
+        n_flags.append(len(oaa.nlp.vocab.lex_attr_getters))
+    assert len(set(n_flags[1:])) == 1
+
+
+def check_chunks(text, chunks, chunk_size, breaks=True):
+    assert chunks[0][0] == chunks[0][2] == 0
+    assert chunks[-1][1] == chunks[-1][3] == len(text)
+    for (start, end, own_start, own_end) in chunks:
+        assert end - start <= chunk_size
+        assert start <= own_start < own_end <= end
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # the chunks overlap and their owned parts are contiguous
+        assert chunk[0] < previous[1]
+        assert chunk[2] == previous[3]
+        assert not breaks or text[previous[1] - 1].isspace()
+
+
+def test_split_text():
+    text = ' '.join('line {} of the note'.format(n) + ('\n\n' if n % 7 == 0 else '\n') for n in range(500))
+    chunks = list(oaa_module.split_text(text, 1000, 100))
+    assert len(chunks) > 10
+    check_chunks(text, chunks, 1000)
+    # paragraph breaks are preferred
+    assert all(text[end - 2:end] == '\n\n' for (_, end, _, _) in chunks[:-1])
+    # a text without any break is cut at the chunk size
+    chunks = list(oaa_module.split_text('x' * 2500, 1000, 100))
+    check_chunks('x' * 2500, chunks, 1000, breaks=False)
+    assert list(oaa_module.split_text('a short note', 1000, 100)) == [(0, 12, 0, 12)]
+    with pytest.raises(ValueError):
+        next(oaa_module.split_text('a short note', 400, 100))
+
+
+def test_long_text_mentions_match_the_whole_text(example_texts):
+    oaa = make_annotator(os.path.join(RESOURCE_DIR, 'online_gaming_lex.txt'))
+    text = '\n'.join(example_texts * 3)
+    mentions, _ = oaa.annotate_long_text(text, chunk_size=len(text) + 1, overlap=200)
+    expected = sorted((m['start'], m['end'], m['class'], m['text']) for m in mentions.values())
+    assert len(expected) > 10
+    mentions, _ = oaa.annotate_long_text(text, chunk_size=2000, overlap=200)
+    assert sorted((m['start'], m['end'], m['class'], m['text']) for m in mentions.values()) == expected
+    for m in mentions.values():
+        assert text[int(m['start']):int(m['end'])] == m['text']
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.results = []
+
+    def write(self, text_id, mentions):
+        self.results.append((text_id, mentions))
+
+
+def test_batches_match_single_texts(example_texts):
+    oaa = make_annotator(os.path.join(RESOURCE_DIR, 'online_gaming_lex.txt'))
+    expected = [(str(n), oaa.annotate_mentions(text)[0]) for n, text in enumerate(example_texts)]
+    assert sum(len(mentions) for _, mentions in expected) > 0
+    sink = ListSink()
+    # batches of a size that does not divide the number of texts
+    stats = oaa.process_stream(((str(n), text) for n, text in enumerate(example_texts)), sink, batch_size=4)
+    assert sink.results == expected
+    assert stats['texts'] == len(example_texts)
+    assert stats['mentions'] == sum(len(mentions) for _, mentions in expected)
+
+
+def test_pipeline_round_trip(tmp_path, example_texts):
+    oaa = make_annotator(os.path.join(RESOURCE_DIR, 'online_gaming_lex.txt'))
+    path = str(tmp_path / 'pipeline')
+    oaa.to_disk(path)
+    loaded = oaa_module.OnlineActivityAnnotator.from_disk(path)
+    assert loaded.nlp.pipe_names == oaa.nlp.pipe_names
+    assert loaded.get_rule_version() == oaa.get_rule_version()
+    for text in example_texts:
+        assert loaded.annotate_mentions(text) == oaa.annotate_mentions(text), text
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from conftest import RESOURCE_DIR
+from rule_cache import CACHE_DIR, save_cache
+from token_sequence_annotator import load_grammar
+
+
+def list_cache(path):
+    return sorted(os.listdir(os.path.join(os.path.dirname(path), CACHE_DIR)))
+
+
+def test_new_grammar_cache_replaces_the_old_one(tmp_path):
+    with open(os.path.join(RESOURCE_DIR, 'token_sequence_rules_test.py'), 'r', encoding='utf-8') as fin:
+        source = fin.read()
+    path = str(tmp_path / 'rules.py')
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write(source)
+    load_grammar(path)
+    old_names = list_cache(path)
+    assert len(old_names) == 1 and old_names[0].endswith('.grammar.pickle')
+    # caches of other sources and kinds are kept
+    save_cache(os.path.join(str(tmp_path), CACHE_DIR, 'rules.0123456789abcdef.lexicon.pickle'), {})
+    save_cache(os.path.join(str(tmp_path), CACHE_DIR, 'other.0123456789abcdef.grammar.pickle'), {})
+
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write(source + '\n# edited\n')
+    load_grammar(path)
+    names = list_cache(path)
+    assert len(names) == 3 and old_names[0] not in names
+    assert 'rules.0123456789abcdef.lexicon.pickle' in names
+    assert 'other.0123456789abcdef.grammar.pickle' in names
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+import random
+import spacy
+
+from annotation_store import register_bitset
+from conftest import get_annotations, load_nlp, make_pipeline
+from lexical_annotator import add_lexical_annotations, get_longest_matches
+from spacy.matcher import Matcher
+from token_sequence_annotator import TokenSequenceAnnotator, compile_pattern, get_longest_spans, get_regex_flag
+from vocab_flags import VOCAB_FLAGS
+
+
+def test_shared_matcher_matches_rule_by_rule(example_texts, shared_nlp, rule_nlp):
+    assert len(example_texts) > 20
+    for text in example_texts:
+        assert get_annotations(shared_nlp(text)) == get_annotations(rule_nlp(text)), text
+
+
+def test_staged_matching_matches_rule_by_rule(example_texts, rule_nlp):
+    staged_nlp = make_pipeline(staged=True)
+    assert 'token_sequence_annotator_level0_surface' in staged_nlp.pipe_names
+    tsa = staged_nlp.get_pipe('token_sequence_annotator_level0')
+    assert len(tsa.stage_rules['tagged']) > 0
+    for text in example_texts + ['she plays online games']:
+        assert get_annotations(staged_nlp(text)) == get_annotations(rule_nlp(text)), text
+
+
+def test_rule_groups(shared_nlp):
+    tsa = shared_nlp.get_pipe('token_sequence_annotator_level0')
+    keys = tsa.rule_keys
+    groups = tsa.get_rule_groups(list(range(len(keys))))
+    assert [i for group in groups for i in group] == list(range(len(keys)))
+    group_of = dict((keys[i], n) for n, group in enumerate(groups) for i in group)
+    assert group_of['INTERNET_SEQUENCE'] > group_of['ONLINE_GAMING']
+    assert group_of['GAMING_SEQUENCE'] > group_of['PC_GAMING']
+    for group in groups:
+        written = set()
+        for i in group:
+            assert tsa.rule_reads[i].isdisjoint(written)
+            written.update(tsa.rule_writes[i])
+
+
+DEPENDENT_RULES = """
+RULES = [
+    {
+        'name': 'GAME_NAME',
+        'pattern': [{'LOWER': 'minecraft'}],
+        'avm': {'ALL': {'GAME': 'MINECRAFT'}},
+        'merge': False
+    },
+    {
+        'name': 'GAME_SERVER',
+        'pattern': [{'_': {'GAME': 'MINECRAFT'}}, {'LOWER': 'server'}],
+        'avm': {'ALL': {'MENTION': 'ONLINE_GAMING'}},
+        'merge': False
+    }
+]
+"""
+
+
+@pytest.mark.parametrize('shared_matcher', [True, False])
+def test_prefilter_keeps_rules_required_by_earlier_rules(tmp_path, shared_matcher):
+    path = tmp_path / 'dependent_rules.py'
+    path.write_text(DEPENDENT_RULES)
+    nlp = load_nlp()
+    tsa = TokenSequenceAnnotator(nlp, 'dependent', verbose=False, path=str(path), use_cache=False, shared_matcher=shared_matcher)
+    nlp.add_pipe(tsa, last=True)
+    doc = nlp('he plays on a minecraft server')
+    assert doc._.skipped_rules == 0
+    assert [token._.MENTION for token in doc[4:]] == ['ONLINE_GAMING', 'ONLINE_GAMING']
+    doc = nlp('he plays on a server')
+    assert doc._.skipped_rules == 2
+
+
+def get_longest_spans_by_scan(offsets):
+    # quadratic reference: same order, every kept span is checked
+    kept = []
+    for (start, end) in sorted(set(offsets), key=lambda x: (x[0] - x[1], x[0])):
+        if all(end <= s or start >= e for (s, e) in kept):
+            kept.append((start, end))
+    return sorted(kept)
+
+
+def test_longest_spans():
+    assert get_longest_spans([]) == []
+    # nested, overlapping, adjacent and duplicate spans
+    assert get_longest_spans([(2, 4), (0, 3), (3, 4), (4, 6), (0, 3), (5, 9)]) == [(0, 3), (3, 4), (5, 9)]
+    # the earliest of two overlapping spans of equal length is kept
+    assert get_longest_spans([(3, 5), (2, 4), (4, 6)]) == [(2, 4), (4, 6)]
+    rng = random.Random(0)
+    for _ in range(200):
+        offsets = [(start, start + rng.randint(1, 5)) for start in [rng.randint(0, 30) for _ in range(rng.randint(1, 20))]]
+        assert get_longest_spans(offsets) == get_longest_spans_by_scan(offsets), offsets
+        assert get_longest_spans(list(reversed(offsets))) == get_longest_spans(offsets)
+
+
+def test_longest_lexical_matches():
+    matches = [(1, 2, 4), (2, 0, 3), (3, 3, 4), (4, 4, 6), (5, 0, 3)]
+    assert get_longest_matches(matches) == [(2, 0, 3), (3, 3, 4), (4, 4, 6)]
+    # the first match of duplicate spans is kept
+    assert get_longest_matches(list(reversed(matches))) == [(5, 0, 3), (3, 3, 4), (4, 4, 6)]
+
+
+MERGED_RULES = """
+RULES = [
+    {
+        'name': 'ONLINE_GAME',
+        'pattern': [{'LOWER': 'online'}, {'LOWER': 'game'}],
+        'avm': {'ALL': {'MENTION': 'ONLINE_GAMING'}},
+        'merge': True
+    },
+    {
+        'name': 'NEW_ONLINE_GAME',
+        'pattern': [{'LOWER': 'new'}, {'LOWER': 'online'}, {'LOWER': 'game'}],
+        'avm': {'ALL': {'MENTION': 'ONLINE_GAMING'}},
+        'merge': True
+    }
+]
+"""
+
+
+@pytest.mark.parametrize('shared_matcher', [True, False])
+def test_longest_matches_are_merged(tmp_path, shared_matcher):
+    path = tmp_path / 'merged_rules.py'
+    path.write_text(MERGED_RULES)
+    nlp = load_nlp()
+    nlp.add_pipe(TokenSequenceAnnotator(nlp, 'merged', verbose=False, path=str(path), use_cache=False, shared_matcher=shared_matcher), last=True)
+    doc = nlp('a new online game and an online game')
+    assert [token.text for token in doc] == ['a', 'new online game', 'and', 'an', 'online game']
+    assert [token._.MENTION for token in doc] == [False, 'ONLINE_GAMING', False, False, 'ONLINE_GAMING']
+
+
+LABEL_RULES = """
+RULES = [
+    {
+        'name': 'ANY_INTERNET',
+        'pattern': [{'_': {'LA': 'INTERNET'}, 'OP': '+'}],
+        'avm': {'ALL': {'MENTION': 'INTERNET'}},
+        'merge': False
+    },
+    {
+        'name': 'NOT_WEB_SITE',
+        'pattern': [{'_': {'LA': {'NOT_IN': ['HEALTH_WEB', 'INTERNET']}}}, {'LOWER': 'sites'}],
+        'avm': {'ALL': {'TYPE': 'OTHER'}},
+        'merge': False
+    },
+    {
+        'name': 'GAME_OR_HEALTH',
+        'pattern': [{'_': {'LA': {'IN': ['GAMING', 'HEALTH_WEB']}}}],
+        'avm': {'ALL': {'TYPE': 'TOPIC'}},
+        'merge': False
+    }
+]
+"""
+
+
+def test_label_predicates_test_all_labels(tmp_path):
+    path = tmp_path / 'label_rules.py'
+    path.write_text(LABEL_RULES)
+    # LA is registered as a bitset attribute by the lexicons
+    register_bitset('LA')
+    nlp = spacy.blank('en')
+    tsa = TokenSequenceAnnotator(nlp, 'labels', verbose=False, path=str(path), use_cache=False)
+    assert all('LA' not in spec.get('_', {}) for pattern in tsa.patterns for spec in pattern)
+    doc = nlp('she uses health web sites and other sites')
+    add_lexical_annotations(doc, [(0, 2, 5)], 'LA', 'INTERNET')
+    add_lexical_annotations(doc, [(0, 2, 4)], 'LA', 'HEALTH_WEB')
+    doc = tsa(doc)
+    # 'health' and 'web' match INTERNET although their last label is HEALTH_WEB
+    assert [token._.MENTION for token in doc] == [False, False] + ['INTERNET'] * 3 + [False] * 3
+    assert [token._.TYPE for token in doc] == [False, False, 'TOPIC', 'TOPIC', False, False, 'OTHER', 'OTHER']
+
+
+def test_compiled_regex_predicates_match_spacy_regex(shared_nlp, example_texts):
+    tsa = shared_nlp.get_pipe('token_sequence_annotator_level0')
+    nlp = load_nlp()
+    regex_matcher = Matcher(nlp.vocab)
+    compiled_matcher = Matcher(nlp.vocab)
+    n_rules = 0
+    for n, rule in enumerate(tsa.rules):
+        if 'REGEX' not in str(rule['pattern']):
+            continue
+        n_rules += 1
+        regex_matcher.add(str(n), None, rule['pattern'])
+        compiled_matcher.add(str(n), None, compile_pattern(nlp.vocab, rule['pattern']))
+    assert n_rules > 5
+    texts = example_texts + ['#Mentalhealth and @NHS_Trust, e-communication and chatting online, talked on line',
+                             'an instant message about TEMPORARY INTERNET files']
+    n_matches = 0
+    # the second pass reads the memoized results
+    for text in texts + texts:
+        doc = nlp(text)
+        matches = sorted(regex_matcher(doc))
+        assert sorted(compiled_matcher(doc)) == matches, text
+        n_matches += len(matches)
+    assert n_matches > 0
+
+
+def test_regex_flags_are_not_reused_across_vocabularies():
+    pattern = [{'LOWER': {'REGEX': '^inter?net$'}}]
+    nlp = spacy.blank('en')
+    flag_id = get_regex_flag(nlp.vocab, 'LOWER', '^inter?net$')
+    # a new vocabulary given the id of a dead one
+    new_nlp = spacy.blank('en')
+    VOCAB_FLAGS[id(new_nlp.vocab)] = dict(VOCAB_FLAGS[id(nlp.vocab)])
+    new_flag_id = get_regex_flag(new_nlp.vocab, 'LOWER', '^inter?net$')
+    assert new_nlp.vocab['Internet'].check_flag(new_flag_id)
+    assert not new_nlp.vocab['intranet'].check_flag(new_flag_id)
+    assert get_regex_flag(new_nlp.vocab, 'LOWER', '^inter?net$') == new_flag_id
+    matcher = Matcher(new_nlp.vocab)
+    matcher.add('INTERNET', None, compile_pattern(new_nlp.vocab, pattern))
+    assert len(matcher(new_nlp('the Internet'))) == 1
+
+
+def test_regex_predicates_without_free_flag():
+    pattern = [{'LOWER': {'REGEX': '^inter?net$'}}]
+    nlp = spacy.blank('en')
+    while True:
+        try:
+            nlp.vocab.add_flag(lambda string: False)
+        except ValueError:
+            break
+    assert compile_pattern(nlp.vocab, pattern) == pattern
+    matcher = Matcher(nlp.vocab)
+    matcher.add('INTERNET', None, compile_pattern(nlp.vocab, pattern))
+    assert len(matcher(nlp('the Internet'))) == 1
+
+
+def test_profiled_matching_matches_shared_matcher(example_texts, shared_nlp, tmp_path):
+    profiled_nlp = make_pipeline(profile=True)
+    tsa = profiled_nlp.get_pipe('token_sequence_annotator_level0')
+    for text in example_texts:
+        assert get_annotations(profiled_nlp(text)) == get_annotations(shared_nlp(text)), text
+    profiler = tsa.profiler
+    assert profiler.n_docs == len(example_texts)
+    report = profiler.get_report()
+    assert len(report) == len(tsa.rules)
+    assert all(stats['calls'] + stats['skipped'] == len(example_texts) for stats in report)
+    assert all(stats['docs_matched'] <= stats['calls'] and stats['matches'] <= stats['tokens'] for stats in report)
+    assert sum(stats['matches'] for stats in report) > 0
+    assert json.loads(profiler.to_json(str(tmp_path / 'profile.json')))['documents'] == len(example_texts)
+    assert len(profiler.to_table().splitlines()) == len(report) + 4
+    profiler.reset()
+    assert profiler.n_docs == 0 and all(stats['calls'] == 0 for stats in profiler.get_report())
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+
+from trace_sink import DEBUG, INFO, WARNING, FileSink, StreamSink, Tracer
+
+
+def fail():
+    raise AssertionError('field evaluated for a dropped record')
+
+
+def test_records_below_the_level_are_not_formatted():
+    stream = io.StringIO()
+    tracer = Tracer(StreamSink(stream), level='INFO')
+    assert not tracer.enabled(DEBUG) and tracer.enabled(INFO)
+    tracer.debug('match', '-- Match: {}', object(), cost=fail)
+    tracer.info('match', '-- Match: {} {}', 'rule', 3, cost=lambda: 1.5)
+    tracer.warning('overlap', n=2)
+    assert stream.getvalue().splitlines() == ['-- Match: rule 3', '-- Warning: overlap n=2']
+    # a verbose component lowers the level, but never raises it
+    tracer.set_level(DEBUG)
+    tracer.set_level(WARNING)
+    assert tracer.level == DEBUG
+
+
+def test_sampled_out_documents_keep_warnings():
+    stream = io.StringIO()
+    tracer = Tracer(StreamSink(stream), level=DEBUG, sample_rate=0.0)
+    tracer.begin_document('n1')
+    tracer.debug('match', 'not sampled', cost=fail)
+    tracer.warning('keyword_gate_miss', 'kept')
+    assert stream.getvalue().splitlines() == ['kept']
+
+
+def test_file_sink_buffers_records(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    tracer = Tracer(level=INFO)
+    tracer.configure(path=path, buffer_size=2)
+    tracer.begin_document('n1')
+    tracer.info('long_text', n=1)
+    assert open(path, 'r', encoding='utf-8').read() == ''
+    tracer.info('long_text', n=2)
+    tracer.info('long_text', n=3)
+    tracer.sink.close()
+    records = [json.loads(line) for line in open(path, 'r', encoding='utf-8')]
+    assert [(r['level'], r['event'], r['doc'], r['n']) for r in records] == [('INFO', 'long_text', 'n1', n) for n in [1, 2, 3]]
+    assert isinstance(tracer.sink, FileSink)
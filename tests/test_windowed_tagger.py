@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import spacy
+
+from conftest import ROOT, read_example_texts
+from keyword_gate import KeywordGate
+
+oaa_module = pytest.importorskip('online_activity_annotator')
+
+
+def test_windows_around_keywords():
+    doc = spacy.blank('en')('one two three four five six seven minecraft eight nine ten eleven twelve')
+    tagger = oaa_module.WindowedTagger(None, KeywordGate(['minecraft']), 2)
+    assert tagger.get_windows(doc) == [(5, 10)]
+
+
+def test_windows_extend_to_sentences():
+    doc = spacy.blank('en')('He is quiet. He plays a lot of minecraft with his friends online. He sleeps.')
+    tagger = oaa_module.WindowedTagger(None, KeywordGate(['minecraft']), 1, sentences=True)
+    # the sentence 'He plays ... online.' plus one token on each side
+    assert tagger.get_windows(doc) == [(3, 16)]
+    tagger = oaa_module.WindowedTagger(None, KeywordGate(['minecraft']), 1, sentences=False)
+    assert tagger.get_windows(doc) == [(8, 11)]
+
+
+class TextTagger(object):
+    """
+    Stub tagger that tags each token with its upper-cased text.
+    """
+
+    def __init__(self):
+        self.n_docs = 0
+
+    def pipe(self, docs, batch_size=128):
+        for doc in docs:
+            self.n_docs += 1
+            for token in doc:
+                token.tag_ = token.text.upper()
+            yield doc
+
+
+def test_windowed_tagging_copies_tags_back():
+    nlp = spacy.blank('en')
+    words = ['w{}'.format(i) for i in range(30)]
+    texts = [' '.join(words[:15] + ['minecraft'] + words[16:]),
+             ' '.join(['w0', 'minecraft'] + words[2:]),
+             ' '.join(words),
+             'minecraft w1 w2']
+    text_tagger = TextTagger()
+    tagger = oaa_module.WindowedTagger(text_tagger, KeywordGate(['minecraft']), 6)
+    docs = list(tagger.pipe([nlp(text) for text in texts], batch_size=2))
+    assert text_tagger.n_docs == 3
+    # windows (9, 22) and (0, 8), less the context at their inner ends
+    tagged = [[token.i for token in doc if token.tag_ != ''] for doc in docs]
+    assert tagged == [list(range(13, 18)), list(range(0, 4)), [], [0, 1, 2]]
+    for doc in docs:
+        assert all(token.tag_ == token.text.upper() for token in doc if token.tag_ != '')
+        assert doc.is_tagged
+    assert [doc._.tagged_windows for doc in docs] == [[(9, 22)], [(0, 8)], [], None]
+    assert tagger.n_tokens == 30 + 30 + 30 + 3
+    assert tagger.n_tagged == 13 + 8 + 3
+
+
+def test_dates_do_not_need_tags():
+    doc = spacy.blank('en')('Seen on 03/04/2013 and in 2014')
+    doc = oaa_module.DateTokenAnnotator()(doc)
+    assert [token.i for token in doc if token._.TIME] == [2, 5]
+
+
+def test_windowed_tagging_gives_same_mentions(monkeypatch):
+    pytest.importorskip('en_core_web_sm')
+    monkeypatch.chdir(ROOT)
+    full = oaa_module.OnlineActivityAnnotator()
+    windowed = oaa_module.OnlineActivityAnnotator(windowed=True)
+    assert isinstance(windowed.nlp.get_pipe('tagger'), oaa_module.WindowedTagger)
+    for text in read_example_texts():
+        assert windowed.annotate_mentions(text) == full.annotate_mentions(text), text
@@ -7,21 +7,63 @@
     Rules match tokens on (linguistic) attributes and annotations are added to
     matching sequences.
     
+    Grammar files are validated and compiled when they are first loaded. The
+    compiled grammar is cached on disk (see rule_cache.py) and reused by later
+    processes for as long as the grammar file is unchanged.
+    
     See sthe following spaCy documentation for further implementation details:
     - rule-based matching: https://spacy.io/usage/rule-based-matching
     - custom extension attributes: https://spacy.io/usage/processing-pipelines#custom-components-attributes
-    
-    # TODO remove use of hard-coded conditional imports to load rule files.
-    # Replace this with a grammar rule parser (e.g. PLY).
 """
 
+import bisect
+import hashlib
+import importlib.util
+import json
+import numpy as np
+import os
+import re
 import spacy
 import sys
+import time
 
+from annotation_store import get_bitset_predicate, get_columns, get_store, get_token_attributes, is_bitset, register_extension
+from collections import OrderedDict
+from functools import partial
+from rule_cache import file_digest, get_cache_path, load_cache, save_cache
 from spacy.matcher import Matcher
-from spacy.tokens import Span
+from spacy.symbols import LEMMA, LOWER, ORTH
+from spacy.tokens import Doc, Token
+from trace_sink import DEBUG, get_tracer
+from vocab_flags import get_vocab_flag
+
+RESOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources')
+
+# Grammar files that can be loaded by name
+RULE_FILES = {'test': os.path.join(RESOURCE_DIR, 'token_sequence_rules_test.py'),
+              'level0': os.path.join(RESOURCE_DIR, 'token_sequence_rules_smi.py')}
+
+# Version of the compiled grammar structure - change this to invalidate caches
+GRAMMAR_FORMAT = 3
+
+# Maximum number of matchers (one per distinct set of active rules) to keep
+MAX_MATCHERS = 64
+
+# Maximum number of lemmas for which REGEX predicate results are cached
+REGEX_CACHE_SIZE = 100000
+
+# Pipeline stages at which rules can be matched, from earliest to latest:
+# - surface: after the tokenizer (lexeme attributes only)
+# - tagged: after the tagger and lemma corrector (POS, TAG, LEMMA)
+# - lexical: at the end of the pipeline (custom attributes and anything else)
+STAGES = ['surface', 'tagged', 'lexical']
+
+TAGGED_ATTRIBUTES = ['LEMMA', 'POS', 'TAG']
+
+LEXICAL_ATTRIBUTES = ['_', 'DEP', 'ENT_TYPE', 'HEAD', 'SENT_START']
 
-# Ad hoc import selection
+# Token attributes that can be used as rule anchors by the prefilter
+ANCHOR_ATTRIBUTES = {'LEMMA': LEMMA, 'LOWER': LOWER, 'ORTH': ORTH, 'TEXT': ORTH}
 
 # This is an ad hoc workaround to avoid trying to overwrite default attributes
 # TODO Find a better, cleaner solution as this will not apply to version changes
@@ -33,6 +75,641 @@ DEFAULT_ATTRIBUTES = ['DEP', 'HEAD', 'IS_ALPHA', 'IS_ASCII', 'IS_BRACKET',
                       'ORTH', 'POS', 'PREFIX', 'SENT_START', 'SHAPE', 'SUFFIX',
                       'TAG']
 
+# Keys that may be used in a token specification of a rule pattern
+PATTERN_KEYS = set(DEFAULT_ATTRIBUTES) | {'ENT_TYPE', 'NORM', 'TEXT', 'OP', '_'}
+
+PATTERN_OPERATORS = ['!', '?', '+', '*']
+
+
+def get_rule_keys(rules):
+    """
+    Get a unique matcher key for each rule. Rule names are not necessarily
+    unique in a grammar (e.g. CHAT_ON_LINE), so repeated names are suffixed
+    with their occurrence number.
+    
+    Arguments:
+        - rules: list; the token sequence rules.
+    
+    Return:
+        - keys: list; the matcher key of each rule, in rule order.
+    """
+    keys = []
+    seen = set()
+    for rule in rules:
+        key = rule['name']
+        n = 1
+        while key in seen:
+            n += 1
+            key = rule['name'] + '_' + str(n)
+        seen.add(key)
+        keys.append(key)
+    return keys
+
+
+def get_longest_spans(offsets):
+    """
+    Select the longest non-overlapping spans from a list of (possibly nested
+    or overlapping) spans. Spans are considered longest first, and earliest
+    first for spans of equal length, and a span is kept if it does not overlap
+    a span that has already been kept. The kept spans are held in sorted lists
+    so that each overlap check is a binary search, i.e. O(n log n) overall.
+    
+    Arguments:
+        - offsets: list; the (start, end) token offsets of the spans.
+    
+    Return:
+        - longest: list; the (start, end) offsets of the longest spans, sorted
+                   by start offset.
+    """
+    starts = []
+    ends = []
+    for (start, end) in sorted(set(offsets), key=lambda x: (x[0] - x[1], x[0])):
+        k = bisect.bisect_right(starts, start)
+        # kept spans do not overlap, so only the neighbours need checking
+        if k > 0 and ends[k - 1] > start:
+            continue
+        if k < len(starts) and starts[k] < end:
+            continue
+        starts.insert(k, start)
+        ends.insert(k, end)
+    return list(zip(starts, ends))
+
+
+def parse_grammar(path):
+    """
+    Read the rules from a grammar file. The grammar file is a Python script
+    that defines a list of rules in a variable called RULES (or, failing that,
+    in a single variable with a name ending in RULES).
+    
+    Arguments:
+        - path: str; the path to the grammar file.
+    
+    Return:
+        - rules: list; the rules as specified in the grammar file.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    
+    rules = getattr(module, 'RULES', None)
+    if rules is None:
+        candidates = [value for (key, value) in vars(module).items() if key.endswith('RULES') and isinstance(value, list)]
+        if len(candidates) != 1:
+            raise ValueError('-- Error: grammar file ' + path + ' must define a single list of rules called RULES.')
+        rules = candidates[0]
+    
+    return rules
+
+
+def validate_rule(rule, n):
+    """
+    Check that a rule is well-formed.
+    
+    Arguments:
+        - rule: dict; the rule to check.
+        - n: int; the index of the rule in the grammar (for error messages).
+    """
+    if not isinstance(rule, dict):
+        raise ValueError('-- Error: rule ' + str(n) + ' is not a dictionary.')
+    
+    name = rule.get('name', None)
+    if not isinstance(name, str) or name == '':
+        raise ValueError('-- Error: rule ' + str(n) + ' has no name.')
+    
+    pattern = rule.get('pattern', None)
+    if not isinstance(pattern, list) or len(pattern) == 0:
+        raise ValueError('-- Error: rule ' + name + ' has no pattern.')
+    for spec in pattern:
+        if not isinstance(spec, dict):
+            raise ValueError('-- Error: rule ' + name + ' has a token specification that is not a dictionary: ' + str(spec))
+        for key in spec:
+            if not isinstance(key, str) or key.upper() not in PATTERN_KEYS:
+                raise ValueError('-- Error: rule ' + name + ' uses an unknown token attribute: ' + str(key))
+        if spec.get('OP', '+') not in PATTERN_OPERATORS:
+            raise ValueError('-- Error: rule ' + name + ' uses an unknown operator: ' + str(spec['OP']))
+        if not isinstance(spec.get('_', {}), dict):
+            raise ValueError('-- Error: rule ' + name + ' has a custom attribute specification that is not a dictionary.')
+    
+    avm = rule.get('avm', None)
+    if not isinstance(avm, dict):
+        raise ValueError('-- Error: rule ' + name + ' has no attribute-value matrix (avm).')
+    for key in avm:
+        if key not in ['ALL', 'LAST'] and not isinstance(key, int):
+            raise ValueError('-- Error: rule ' + name + ' has an invalid avm key: ' + str(key))
+        if not isinstance(avm[key], dict):
+            raise ValueError('-- Error: rule ' + name + ' has an invalid avm value for key: ' + str(key))
+
+
+def get_rule_anchors(pattern):
+    """
+    Get the literal anchors of a rule pattern. An anchor group is the list of
+    literal values that a required token must have for one of its attributes,
+    e.g. {'LEMMA': {'IN': ['play', 'playing']}}. A rule can only match a
+    document that contains at least one value from each of its anchor groups.
+    
+    Arguments:
+        - pattern: list; the token specifications of a rule.
+    
+    Return:
+        - anchors: list; the anchor groups, each a list of (attribute, value)
+                   tuples.
+    """
+    anchors = []
+    for spec in pattern:
+        # optional and negated tokens cannot anchor a rule
+        if spec.get('OP', '+') != '+':
+            continue
+        for attr in spec:
+            if attr.upper() not in ANCHOR_ATTRIBUTES:
+                continue
+            value = spec[attr]
+            if isinstance(value, str):
+                anchors.append([(attr.upper(), value)])
+            elif isinstance(value, dict) and list(value.keys()) == ['IN']:
+                anchors.append([(attr.upper(), v) for v in value['IN']])
+    return anchors
+
+
+def get_rule_requirements(pattern):
+    """
+    Get the custom attributes that must have a value somewhere in a document
+    for a rule pattern to match, i.e. the custom attributes that a required
+    token tests against one or more string values.
+    
+    Arguments:
+        - pattern: list; the token specifications of a rule.
+    
+    Return:
+        - requires: list; the names of the required custom attributes.
+    """
+    requires = set()
+    for spec in pattern:
+        if spec.get('OP', '+') != '+':
+            continue
+        for attr, value in spec.get('_', {}).items():
+            if isinstance(value, str):
+                requires.add(attr)
+            elif isinstance(value, dict) and list(value.keys()) == ['IN'] and all(isinstance(v, str) for v in value['IN']):
+                requires.add(attr)
+    return sorted(requires)
+
+
+def get_rule_reads(pattern):
+    """
+    Get the custom attributes that a rule pattern tests, on any token.
+
+    Arguments:
+        - pattern: list; the token specifications of a rule.
+
+    Return:
+        - reads: list; the names of the custom attributes.
+    """
+    return sorted(set([attr for spec in pattern for attr in spec.get('_', {})]))
+
+
+def get_rule_writes(avm, values=False):
+    """
+    Get the custom attributes that a rule annotates.
+
+    Arguments:
+        - avm: dict; the attribute-value matrix of a rule.
+        - values: bool; only include the attributes that are given a value,
+                  i.e. not those that are only cleared (set to False).
+
+    Return:
+        - writes: list; the names of the custom attributes.
+    """
+    return sorted(set([attr for key in avm for attr, value in avm[key].items() if value or not values]))
+
+
+def get_rule_length(pattern):
+    """
+    Get the maximum number of tokens that a rule pattern can match.
+    
+    Arguments:
+        - pattern: list; the token specifications of a rule.
+    
+    Return:
+        - length: int; the maximum match length, or None if the pattern has
+                  repeated tokens (OP + or *).
+    """
+    if any(spec.get('OP', None) in ['+', '*'] for spec in pattern):
+        return None
+    return len(pattern)
+
+
+def get_rule_stage(pattern):
+    """
+    Get the earliest pipeline stage at which all the token attributes used by
+    a rule pattern are available (see STAGES).
+    
+    Arguments:
+        - pattern: list; the token specifications of a rule.
+    
+    Return:
+        - stage: str; the name of the stage.
+    """
+    attrs = set([attr.upper() for spec in pattern for attr in spec])
+    if len(attrs.intersection(LEXICAL_ATTRIBUTES)) > 0:
+        return 'lexical'
+    if len(attrs.intersection(TAGGED_ATTRIBUTES)) > 0:
+        return 'tagged'
+    return 'surface'
+
+
+def compile_grammar(rules, path):
+    """
+    Validate a list of rules and compile them into the structure used by the
+    TokenSequenceAnnotator.
+    
+    Arguments:
+        - rules: list; the rules as specified in the grammar file.
+        - path: str; the path to the grammar file.
+    
+    Return:
+        - grammar: dict; the compiled grammar.
+    """
+    keys = get_rule_keys(rules)
+    compiled_rules = []
+    extensions = set()
+    
+    for n, rule in enumerate(rules):
+        validate_rule(rule, n)
+        
+        # built-in attributes cannot be modified, so drop them once here
+        avm = {}
+        for key in rule['avm']:
+            new_annotations = {}
+            for new_attr in rule['avm'][key]:
+                if new_attr in DEFAULT_ATTRIBUTES:
+                    print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule['name'], file=sys.stderr)
+                else:
+                    new_annotations[new_attr] = rule['avm'][key][new_attr]
+                    extensions.add(new_attr)
+            avm[key] = new_annotations
+        
+        for spec in rule['pattern']:
+            extensions.update(spec.get('_', {}).keys())
+        
+        compiled_rules.append({'name': rule['name'],
+                               'key': keys[n],
+                               'pattern': rule['pattern'],
+                               'avm': avm,
+                               'merge': rule.get('merge', False),
+                               'anchors': get_rule_anchors(rule['pattern']),
+                               'requires': get_rule_requirements(rule['pattern']),
+                               'stage': get_rule_stage(rule['pattern'])
+                               })
+    
+    return {'format': GRAMMAR_FORMAT,
+            'path': os.path.abspath(path),
+            'rules': compiled_rules,
+            'extensions': sorted(extensions)
+            }
+
+
+def declare_extensions(extensions):
+    """
+    Declare the custom token attributes used by a grammar. Annotations are
+    written to the annotation store, so the attributes are (re-)registered as
+    views on the store, replacing any declaration made by the grammar file.
+    
+    Arguments:
+        - extensions: list; the names of the custom token attributes.
+    """
+    for attr in extensions:
+        register_extension(attr)
+
+
+def load_grammar(path, use_cache=True):
+    """
+    Load a grammar file. The compiled grammar is read from the cache if the
+    grammar file has not changed since it was last compiled, otherwise the file
+    is parsed, validated and compiled, and the cache is updated.
+    
+    Arguments:
+        - path: str; the path to the grammar file.
+        - use_cache: bool; read and write the compiled grammar cache.
+    
+    Return:
+        - grammar: dict; the compiled grammar.
+    """
+    digest = file_digest(path, 'grammar', GRAMMAR_FORMAT)
+    cache_path = get_cache_path(path, digest, 'grammar')
+    
+    grammar = None
+    if use_cache:
+        grammar = load_cache(cache_path)
+    
+    if grammar is None:
+        grammar = compile_grammar(parse_grammar(path), path)
+        grammar['digest'] = digest
+        if use_cache:
+            save_cache(cache_path, grammar)
+    
+    declare_extensions(grammar['extensions'])
+    
+    return grammar
+
+
+Doc.set_extension('skipped_rules', default=0, force=True)
+
+def match_regex_flag(regex, lower, text):
+    """
+    Flag getter for a REGEX predicate on a lexeme attribute.
+    
+    Arguments:
+        - regex: compiled regular expression; the predicate.
+        - lower: bool; match on the lowercase form of the lexeme.
+        - text: str; the lexeme text.
+    
+    Return: bool; True if the regular expression matches, else False.
+    """
+    if lower:
+        text = text.lower()
+    return regex.search(text) is not None
+
+
+def get_regex_flag_key(attr, regex):
+    """
+    Get the vocabulary flag key of a REGEX predicate (see vocab_flags).
+    
+    Arguments:
+        - attr: str; the lexeme attribute (ORTH or LOWER).
+        - regex: str; the regular expression.
+    
+    Return:
+        - key: tuple; the flag key.
+    """
+    return ('REGEX', attr, regex)
+
+
+def get_regex_flag(vocab, attr, regex):
+    """
+    Get a vocabulary flag that is set on all lexemes whose ORTH or LOWER
+    attribute matches a regular expression. The flag is computed once per
+    lexeme, when the flag is added or the lexeme is created, and is only
+    allocated once per vocabulary (see vocab_flags).
+    
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary.
+        - attr: str; the lexeme attribute (ORTH or LOWER).
+        - regex: str; the regular expression.
+    
+    Return:
+        - flag_id: int; the ID of the flag, or None if no flag is free.
+    """
+    flag_id = get_vocab_flag(vocab, get_regex_flag_key(attr, regex), partial(match_regex_flag, re.compile(regex), attr == 'LOWER'))
+    if flag_id is None:
+        get_tracer().warning('regex_flag', '-- Warning: no vocabulary flag available, REGEX predicate is not memoized: {}', regex)
+    return flag_id
+
+
+class LemmaRegexPredicate(object):
+    """
+    Lemma Regex Predicate
+    
+    Extension attribute getter for a REGEX predicate on token lemmas. Results
+    are cached by lemma ID in a bounded LRU cache, so repeated lemmas cost a
+    single dictionary lookup.
+    """
+    
+    def __init__(self, regex, max_size=REGEX_CACHE_SIZE):
+        """
+        Create a new LemmaRegexPredicate instance.
+        
+        Arguments:
+            - regex: str; the regular expression.
+            - max_size: int; the maximum number of cached lemmas.
+        """
+        self.regex = re.compile(regex)
+        self.max_size = max_size
+        self.cache = OrderedDict()
+    
+    def __call__(self, token):
+        key = token.lemma
+        result = self.cache.get(key, None)
+        if result is None:
+            result = self.regex.search(token.lemma_) is not None
+            self.cache[key] = result
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return result
+
+
+def get_lemma_regex_extension(regex):
+    """
+    Get the name of a custom token attribute that is True for all tokens whose
+    lemma matches a regular expression, registering it if needed.
+    
+    Arguments:
+        - regex: str; the regular expression.
+    
+    Return:
+        - name: str; the name of the custom attribute.
+    """
+    name = 'REGEX_LEMMA_' + hashlib.sha1(regex.encode('utf-8')).hexdigest()[:12]
+    if not Token.has_extension(name):
+        Token.set_extension(name, getter=LemmaRegexPredicate(regex))
+    return name
+
+
+def compile_bitset_predicate(attr, value):
+    """
+    Compile a predicate on a custom attribute with a bitset column into a
+    bitmask test.
+    
+    Arguments:
+        - attr: str; the custom attribute.
+        - value: object; the predicate value (a label, or a dictionary with
+                 a list of labels for IN or NOT_IN).
+    
+    Return:
+        - name: str; the name of the boolean custom attribute that tests the
+                bitmask, or None if the predicate cannot be compiled.
+    """
+    if not is_bitset(attr):
+        return None
+    if isinstance(value, str):
+        return get_bitset_predicate(attr, [value])
+    if isinstance(value, dict) and len(value) == 1:
+        op, labels = list(value.items())[0]
+        if op in ['IN', 'NOT_IN'] and isinstance(labels, list) and all(isinstance(label, str) for label in labels):
+            return get_bitset_predicate(attr, labels, negate=op == 'NOT_IN')
+    return None
+
+
+def compile_pattern(vocab, pattern, flag_keys=None):
+    """
+    Rewrite the REGEX predicates of a rule pattern into memoized predicates.
+    REGEX predicates on ORTH and LOWER become vocabulary flags and REGEX
+    predicates on LEMMA become cached custom attributes. Value, IN and NOT_IN
+    predicates on custom attributes with a bitset column (e.g. LA, see
+    annotation_store.register_bitset()) become bitmask tests, which match a
+    token that has any (or none) of the labels. Other predicates are left
+    unchanged.
+    
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary.
+        - pattern: list; the token specifications of a rule.
+        - flag_keys: set; if given, the keys of the vocabulary flags used by
+                     the pattern are added to it.
+    
+    Return:
+        - pattern: list; the compiled token specifications.
+    """
+    compiled = []
+    for spec in pattern:
+        new_spec = {}
+        for attr in spec:
+            value = spec[attr]
+            attr_name = attr.upper() if isinstance(attr, str) else attr
+            if isinstance(value, dict) and list(value.keys()) == ['REGEX']:
+                if attr_name in ['ORTH', 'TEXT', 'LOWER']:
+                    flag_attr = 'LOWER' if attr_name == 'LOWER' else 'ORTH'
+                    flag_id = get_regex_flag(vocab, flag_attr, value['REGEX'])
+                    # without a free flag, spaCy evaluates the REGEX predicate
+                    if flag_id is not None:
+                        new_spec[flag_id] = True
+                        if flag_keys is not None:
+                            flag_keys.add(get_regex_flag_key(flag_attr, value['REGEX']))
+                        continue
+                if attr_name == 'LEMMA':
+                    extensions = new_spec.setdefault('_', {})
+                    extensions[get_lemma_regex_extension(value['REGEX'])] = True
+                    continue
+            if attr == '_':
+                extensions = new_spec.setdefault('_', {})
+                for ext_attr, ext_value in value.items():
+                    predicate = compile_bitset_predicate(ext_attr, ext_value)
+                    if predicate is not None:
+                        extensions[predicate] = True
+                    else:
+                        extensions[ext_attr] = ext_value
+            else:
+                new_spec[attr] = value
+        compiled.append(new_spec)
+    return compiled
+
+
+class RuleProfiler(object):
+    """
+    Rule Profiler
+    
+    Records the cost and hit rate of each token sequence rule over a batch of
+    documents.
+    """
+    
+    def __init__(self, rule_keys):
+        """
+        Create a new RuleProfiler instance.
+        
+        Arguments:
+            - rule_keys: list; the unique keys of the rules to profile.
+        """
+        self.rule_keys = rule_keys
+        self.reset()
+    
+    def reset(self):
+        """
+        Clear all recorded statistics.
+        """
+        self.n_docs = 0
+        self.stats = OrderedDict()
+        for key in self.rule_keys:
+            self.stats[key] = {'rule': key,
+                               'time': 0.0,
+                               'match_time': 0.0,
+                               'annotation_time': 0.0,
+                               'calls': 0,
+                               'skipped': 0,
+                               'docs_matched': 0,
+                               'matches': 0,
+                               'tokens': 0
+                               }
+    
+    def record(self, key, match_time, annotation_time, matches):
+        """
+        Record a rule evaluation on a document.
+        
+        Arguments:
+            - key: str; the rule key.
+            - match_time: float; the time spent matching, in seconds.
+            - annotation_time: float; the time spent annotating, in seconds.
+            - matches: list; the matches of the rule.
+        """
+        stats = self.stats[key]
+        stats['time'] += match_time + annotation_time
+        stats['match_time'] += match_time
+        stats['annotation_time'] += annotation_time
+        stats['calls'] += 1
+        if len(matches) > 0:
+            stats['docs_matched'] += 1
+            stats['matches'] += len(matches)
+            stats['tokens'] += sum([end - start for (_, start, end) in matches])
+    
+    def skip(self, key):
+        """
+        Record that a rule was skipped by the prefilter.
+        
+        Arguments:
+            - key: str; the rule key.
+        """
+        self.stats[key]['skipped'] += 1
+    
+    def get_report(self):
+        """
+        Get the statistics of all rules, most expensive rules first.
+        
+        Return:
+            - report: list; a dictionary of statistics for each rule.
+        """
+        return sorted(self.stats.values(), key=lambda x: x['time'], reverse=True)
+    
+    def to_json(self, path=None):
+        """
+        Export the report as JSON.
+        
+        Arguments:
+            - path: str; the path to write the report to. If None, the report
+                    is only returned.
+        
+        Return:
+            - report: str; the JSON report.
+        """
+        report = json.dumps({'documents': self.n_docs, 'rules': self.get_report()}, indent=2)
+        if path is not None:
+            with open(path, 'w') as fout:
+                fout.write(report)
+        return report
+    
+    def to_table(self):
+        """
+        Export the report as a plain text table. Rules that never matched are
+        flagged with an asterisk.
+        
+        Return:
+            - table: str; the report table.
+        """
+        report = self.get_report()
+        total_time = sum([stats['time'] for stats in report]) or 1.0
+        
+        s = 'Documents: ' + str(self.n_docs) + '\n'
+        s += '{:<32}{:>10}{:>8}{:>8}{:>8}{:>10}{:>10}{:>10}\n'.format('RULE', 'TIME (s)', '%', 'CALLS', 'SKIPPED', 'HIT RATE', 'MATCHES', 'TOKENS')
+        s += '{:<32}{:>10}{:>8}{:>8}{:>8}{:>10}{:>10}{:>10}\n'.format('----', '--------', '-', '-----', '-------', '--------', '-------', '------')
+        for stats in report:
+            name = stats['rule'] + (' *' if stats['matches'] == 0 else '')
+            hit_rate = stats['docs_matched'] / stats['calls'] if stats['calls'] > 0 else 0.0
+            s += '{:<32}{:>10.3f}{:>8.1f}{:>8}{:>8}{:>10.3f}{:>10}{:>10}\n'.format(name, stats['time'], stats['time'] / total_time * 100,
+                                                                           stats['calls'], stats['skipped'], hit_rate,
+                                                                           stats['matches'], stats['tokens'])
+        s += '* rule never matched'
+        
+        return s
+
 
 class TokenSequenceAnnotator(object):
     """
@@ -40,126 +717,467 @@ class TokenSequenceAnnotator(object):
     
     Initialises a single new spaCy pipeline component that annotates tokens 
     according to a set of grammar rules specified in an external file.
+    
+    The component can be pickled (e.g. to send it to a spawned process): the
+    compiled rules are pickled with the vocabulary, so the grammar file is
+    not imported again, and the matchers are rebuilt when it is unpickled.
     """
 
-    def __init__(self, nlp, name, verbose=True):
+    def __init__(self, nlp, name, verbose=True, shared_matcher=True, path=None, use_cache=True, prefilter=True, profile=False, staged=False):
         """
         Create a new TokenSequenceAnnotator instance.
         
         Arguments:
             - nlp: spaCy Language; a spaCy text processing pipeline instance.
             - name: str; the name suffix of the component.
-            - verbose: bool; print all messages
+            - verbose: bool; trace all rules and matches (sets the shared
+                       tracer to DEBUG, see trace_sink).
+            - shared_matcher: bool; compile all rules once into a single
+                              matcher that is run in one pass per document
+                              (one pass per group of dependent rules, see
+                              get_rule_groups()). REGEX predicates are
+                              memoized per lexeme or lemma (see
+                              compile_pattern()). If False, a new matcher is
+                              built for each rule on every document.
+            - path: str; the path to the grammar file. If None, the grammar
+                    file registered for name in RULE_FILES is used.
+            - use_cache: bool; use the compiled grammar cache.
+            - prefilter: bool; only evaluate the rules whose anchor tokens
+                         occur in the document. The number of rules skipped
+                         is stored in the doc._.skipped_rules attribute.
+            - profile: bool; record the time, matches and annotated tokens of
+                       each rule in self.profiler. Rules are then matched one
+                       at a time, which is slower than the shared matcher.
+            - staged: bool; match each rule at the earliest pipeline stage
+                      where its input attributes exist (see STAGES and
+                      add_stage_components()). Annotations are still added by
+                      this component in rule order. Staging requires the
+                      shared matcher and is disabled when profiling.
         """
         self.name = 'token_sequence_annotator_' + name
-        # using conditional import while waiting to implement gramar parser
-        self.rules = []
-        if name == 'test':
-            from resources.token_sequence_rules_test import TEST_RULES
-            self.rules = TEST_RULES
-        elif name == 'level0':
-            from resources.token_sequence_rules_smi import RULES
-            self.rules = RULES
+        if path is None:
+            path = RULE_FILES.get(name, None)
+            if path is None:
+                raise ValueError('-- Error: no grammar file for token sequence annotator ' + name + '.')
         self.nlp = nlp
+        self.vocab = nlp.vocab
         self.matcher = None
         self.matches = {}
         self.verbose = verbose
+        self.tracer = get_tracer()
+        if verbose:
+            self.tracer.set_level(DEBUG)
+        self.shared_matcher = shared_matcher
+        self.use_cache = use_cache
+        self.prefilter = prefilter
+        self.matchers = OrderedDict()
+        self.rule_matchers = {}
+        self.skipped_rules = 0
+        self.profiler = None
+        self.staged = staged and shared_matcher and not profile
+        self.pending_key = 'pending_matches_' + self.name
+        self.load_rules(path)
+        if profile:
+            self.profiler = RuleProfiler(self.rule_keys)
 
-    def __call__(self, doc):
+    def __getstate__(self):
+        # the matchers and compiled patterns refer to lexeme flags and
+        # extensions of this process, so they are rebuilt when unpickled
+        state = dict(self.__dict__)
+        for key in ['nlp', 'tracer', 'matcher', 'matchers', 'rule_matchers', 'patterns', 'matches']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.nlp = None
+        self.tracer = get_tracer()
         if self.verbose:
-            print('-- Token sequence annotator:', self.name)
+            self.tracer.set_level(DEBUG)
+        self.matcher = None
+        self.matches = {}
+        self.matchers = OrderedDict()
+        self.rule_matchers = {}
+        declare_extensions(self.extensions)
+        self.compile_patterns()
+        if self.shared_matcher:
+            self.build_matcher()
+
+    def __call__(self, doc):
+        tracer = self.tracer
+        debug = tracer.enabled(DEBUG)
+        if debug:
+            tracer.debug('annotator', '-- Token sequence annotator: {}', self.name)
         
         # clear matches - this is required as we initialise this component only
         # once and matches from previous documents need to be erased
         self.matches = {}
-        
-        for rule in self.rules:
-            pattern = rule['pattern']
-            name = rule['name']
-            avm = rule['avm']
-            merge = rule.get('merge', False)
-            # TODO add possibility of setting new attributes for merged spans in the rules
-            # attrs = rule.get('attrs', [])
 
-            self.matcher = Matcher(self.nlp.vocab)  # Need to do this for each rule separately unfortunately
-            self.matcher.add(name, None, pattern)
+        # realign the annotations once if an earlier component retokenized
+        # the document, as the rule predicates read them
+        get_store(doc)
 
-            matches = self.matcher(doc)
+        # only evaluate rules that can possibly fire on this document
+        if self.prefilter:
+            active_rules = self.get_active_rules(doc)
+        else:
+            active_rules = list(range(len(self.rules)))
+        doc._.skipped_rules = len(self.rules) - len(active_rules)
+        self.skipped_rules += doc._.skipped_rules
 
-            # store all matched spans for subsequent merging
-            spans = {}
-            for match in matches:
-                start = match[1]
-                end = match[2]
-                span = Span(doc, start, end)  # store offsets for longest match selection
-                spans[(start, end)] = span
+        if debug:
+            tracer.debug('skipped_rules', '  -- Skipped {} rules.', doc._.skipped_rules, annotator=self.name, n=doc._.skipped_rules)
 
-            if len(spans) > 0:
-                self.matches[rule['name']] = [matches, spans, merge]
-            self.add_annotation(doc, matches, name, avm)
+        groups = [active_rules]
+        pending = {}
+        prematched = set()
+        if self.profiler is not None:
+            doc.user_data.pop(self.pending_key, None)
+            self.profiler.n_docs += 1
+            for i in set(range(len(self.rules))).difference(active_rules):
+                self.profiler.skip(self.rule_keys[i])
+        elif self.shared_matcher:
+            if self.staged:
+                # the rules of the earlier stages only read token attributes
+                # that rules cannot annotate, so their matches are still valid
+                length, pending, prematched = doc.user_data.pop(self.pending_key, (len(doc), {}, set()))
+                if length != len(doc):
+                    # the document was retokenized after an earlier stage, match all rules again
+                    pending = {}
+                    prematched = set()
+                # finish early when no earlier stage rule fired and no other rule can fire
+                if len(pending) == 0 and prematched.issuperset(active_rules):
+                    return doc
+            # rules that read an attribute annotated by an earlier rule are
+            # matched in a later pass, once the earlier rule has annotated
+            groups = self.get_rule_groups(active_rules)
+        
+        merge_offsets = []
+        for group in groups:
+            if self.shared_matcher and self.profiler is None:
+                # run the rules of the group in a single pass, annotations are still added rule by rule
+                rule_matches = self.match_rules(doc, [i for i in group if i not in prematched])
+                rule_matches.update([(i, pending[i]) for i in group if i in pending])
+            
+            for i in group:
+                rule = self.rules[i]
+                name = rule['name']
+                avm = rule['avm']
+                merge = rule['merge']
+                # TODO add possibility of setting new attributes for merged spans in the rules
+                # attrs = rule.get('attrs', [])
 
-            if self.verbose:
-                print('  -- Rule ' + name + ': ' + str(len(matches)) + ' matches.', file=sys.stderr)
+                if self.profiler is not None:
+                    t0 = time.perf_counter()
+                    matches = self.get_rule_matcher(i)(doc)
+                    t1 = time.perf_counter()
+                elif self.shared_matcher:
+                    matches = rule_matches.get(i, [])
+                else:
+                    self.matcher = Matcher(self.vocab)  # Need to do this for each rule separately unfortunately
+                    self.matcher.add(name, None, self.patterns[i])
+                    matches = self.matcher(doc)
 
-        # retain only longest matching spans
-        """
-        self.get_longest_matches()
+                # store matches for subsequent merging
+                if len(matches) > 0:
+                    self.matches[rule['key']] = matches
+                    if merge:
+                        merge_offsets.extend([(match[1], match[2]) for match in matches])
+                self.add_annotation(doc, matches, name, avm)
+
+                if self.profiler is not None:
+                    self.profiler.record(self.rule_keys[i], t1 - t0, time.perf_counter() - t1, matches)
+
+                if debug:
+                    tracer.debug('rule_matches', '  -- Rule {}: {} matches.', name, len(matches), rule=rule['key'], n=len(matches))
 
         # perform merging where specified by the rule
-        for rule_name in self.matches:
-            rule_matches = self.matches[rule_name]
-            spans = rule_matches[1]
-            merge = rule_matches[2]
-            if merge:
-                with doc.retokenize() as retokenizer:
-                    for offsets in spans:
-                        span = spans[offsets]
-                        try:
-                            if self.verbose:
-                                print('  -- Merging span from rule ' + rule_name + ':', [token for token in span], file=sys.stderr)
-                            retokenizer.merge(span)
-                            #span.merge() # old API, more error-prone apparently
-                        except IndexError as e:
-                            print('  -- Warning: unable to merge span at', offsets, '(token may have been merged previously).', file=sys.stderr)
-                            print(e, file=sys.stderr)
-        """
+        if len(merge_offsets) > 0:
+            self.merge_spans(doc, merge_offsets)
 
         return doc
     
-    def load_rules(self):
-        # TODO write grammar parser
-        pass
-
-    def get_longest_matches(self):
-        """
-        Remove all shortest matching overlapping spans.
-        """
-
-        def get_overlapping_spans(spans):
-            """ Get a unique list of all overlapping span offsets """
-            offsets = spans.keys()
-            overlaps = {}
-            for offset in offsets:
-                o = [(i[0], i[1]) for i in offsets if
-                     i[0] >= offset[0] and i[0] <= offset[1] or i[1] >= offset[0] and i[1] <= offset[1] if
-                     (i[0], i[1]) != offset and (i[0], i[1]) and (i[0], i[1]) not in overlaps]
-                if len(o) > 0:
-                    overlaps[offset] = o
-
-            return [[k] + v for (k, v) in overlaps.items()]
-
-        rule_names = self.matches.keys()
-        for rule_name in rule_names:
-            match = self.matches[rule_name]
-            all_spans = match[1]
-            overlapping_spans = get_overlapping_spans(all_spans)
-            for os in overlapping_spans:
-                shortest_spans = sorted(os, key=lambda x: x[1] - x[0], reverse=True)[1:]
-                # pop shortest spans
-                for ss in shortest_spans:
-                    # avoid trying to remove a span more than once
-                    if ss in all_spans:
-                        all_spans.pop(ss)
+    def build_matcher(self):
+        """
+        Compile all rules into a single matcher. Each rule is added under its
+        own key so that matches can be assigned back to the rule that produced
+        them.
+        """
+        self.matchers = OrderedDict()
+        self.rule_ids = {}
+        for i, key in enumerate(self.rule_keys):
+            self.rule_ids[self.vocab.strings.add(key)] = i
+        self.matcher = self.get_matcher(list(range(len(self.rules))))
+
+    def get_matcher(self, rule_indices):
+        """
+        Get a matcher for a subset of the rules. Matchers are built on demand
+        and the most recently used ones are kept for reuse.
+        
+        Arguments:
+            - rule_indices: list; the indices of the rules to match.
+        
+        Return:
+            - matcher: spaCy Matcher; a matcher containing the rules.
+        """
+        key = tuple(rule_indices)
+        matcher = self.matchers.get(key, None)
+        if matcher is None:
+            matcher = Matcher(self.vocab)
+            for i in rule_indices:
+                matcher.add(self.rule_keys[i], None, self.patterns[i])
+            self.matchers[key] = matcher
+            if len(self.matchers) > MAX_MATCHERS:
+                self.matchers.popitem(last=False)
+        else:
+            self.matchers.move_to_end(key)
+        return matcher
+
+    def get_rule_matcher(self, i):
+        """
+        Get a matcher that contains a single rule (used for profiling).
+        
+        Arguments:
+            - i: int; the index of the rule.
+        
+        Return:
+            - matcher: spaCy Matcher; a matcher containing the rule.
+        """
+        matcher = self.rule_matchers.get(i, None)
+        if matcher is None:
+            matcher = Matcher(self.vocab)
+            matcher.add(self.rule_keys[i], None, self.patterns[i])
+            self.rule_matchers[i] = matcher
+        return matcher
+
+    def match_rules(self, doc, rule_indices):
+        """
+        Run a shared matcher for the specified rules over a document and group
+        the matches by rule.
+        
+        Arguments:
+            - doc: spaCy Doc; the current spaCy document object.
+            - rule_indices: list; the indices of the rules to match.
+        
+        Return:
+            - rule_matches: dict; the list of matches for each rule index, in
+                            the order returned by the matcher.
+        """
+        rule_matches = {}
+        if len(rule_indices) == 0:
+            return rule_matches
+        for match in self.get_matcher(rule_indices)(doc):
+            rule_matches.setdefault(self.rule_ids[match[0]], []).append(match)
+        return rule_matches
+
+    def get_rule_groups(self, rule_indices):
+        """
+        Split rules into consecutive groups that can each be matched in a
+        single pass: a new group starts at a rule that reads a custom
+        attribute annotated by a rule of the current group. Matching a group
+        after the annotations of the earlier groups have been added gives the
+        same matches as matching each rule in turn.
+        
+        Arguments:
+            - rule_indices: list; the indices of the rules, in rule order.
+        
+        Return:
+            - groups: list; the lists of rule indices of each group.
+        """
+        groups = []
+        group = []
+        written = set()
+        for i in rule_indices:
+            if len(group) > 0 and not self.rule_reads[i].isdisjoint(written):
+                groups.append(group)
+                group = []
+                written = set()
+            group.append(i)
+            written.update(self.rule_writes[i])
+        if len(group) > 0:
+            groups.append(group)
+        return groups
+
+    def build_anchor_index(self):
+        """
+        Build the prefilter index that maps the ID of each anchor value to the
+        anchor groups that contain it.
+        """
+        self.anchor_index = {}
+        self.rule_anchor_groups = []
+        self.rule_requires = [set(rule['requires']) for rule in self.rules]
+        self.required_attrs = set().union(*self.rule_requires)
+        hashes = {}
+        groups = {}
+        n = 0
+        for i, rule in enumerate(self.rules):
+            rule_groups = []
+            for anchor_group in rule['anchors']:
+                for (attr, value) in anchor_group:
+                    attr_id = ANCHOR_ATTRIBUTES[attr]
+                    hashes.setdefault(attr_id, []).append(self.vocab.strings.add(value))
+                    groups.setdefault(attr_id, []).append(n)
+                rule_groups.append(n)
+                n += 1
+            self.rule_anchor_groups.append(rule_groups)
+        
+        for attr_id in hashes:
+            self.anchor_index[attr_id] = (np.array(hashes[attr_id], dtype='uint64'),
+                                          np.array(groups[attr_id], dtype='int64'))
+
+    def get_active_rules(self, doc, rule_indices=None):
+        """
+        Get the rules that can possibly match a document, i.e. the rules for
+        which every anchor group has a value in the document and every
+        required custom attribute has been set on at least one token, or can
+        be set by an earlier active rule.
+        
+        Arguments:
+            - doc: spaCy Doc; the current spaCy document object.
+            - rule_indices: list; the indices of the rules to check. If None,
+                            all rules are checked.
+        
+        Return:
+            - active_rules: list; the indices of the active rules, in rule order.
+        """
+        if rule_indices is None:
+            rule_indices = range(len(self.rules))
+        
+        present = set()
+        attr_ids = list(self.anchor_index.keys())
+        if len(attr_ids) > 0 and len(doc) > 0:
+            # a single attribute is returned as a 1-dimensional array
+            values = doc.to_array(attr_ids).reshape((len(doc), len(attr_ids)))
+            for j, attr_id in enumerate(attr_ids):
+                anchor_hashes, anchor_groups = self.anchor_index[attr_id]
+                present.update(anchor_groups[np.isin(anchor_hashes, values[:, j])].tolist())
+        
+        present_attrs = set()
+        columns = get_columns(doc)
+        if columns is not None:
+            present_attrs = set([attr for attr in self.required_attrs if attr in columns and columns[attr].any()])
+        
+        active_rules = []
+        for i in rule_indices:
+            if not all(n in present for n in self.rule_anchor_groups[i]):
+                continue
+            if not self.rule_requires[i].issubset(present_attrs):
+                continue
+            active_rules.append(i)
+            # the annotations of the rule can satisfy the requirements of later rules
+            present_attrs.update(self.rule_values[i])
+        return active_rules
+
+    def load_rules(self, path):
+        """
+        Load the rules from a grammar file and compile the matcher.
+        
+        Arguments:
+            - path: str; the path to the grammar file.
+        """
+        grammar = load_grammar(path, use_cache=self.use_cache)
+        self.path = grammar['path']
+        self.digest = grammar['digest']
+        self.rules = grammar['rules']
+        self.extensions = grammar['extensions']
+        self.rule_keys = [rule['key'] for rule in self.rules]
+        self.stage_rules = {}
+        for stage in STAGES:
+            self.stage_rules[stage] = [i for i, rule in enumerate(self.rules) if rule['stage'] == stage]
+        self.rule_reads = [set(get_rule_reads(rule['pattern'])) for rule in self.rules]
+        self.rule_writes = [set(get_rule_writes(rule['avm'])) for rule in self.rules]
+        self.rule_values = [set(get_rule_writes(rule['avm'], values=True)) for rule in self.rules]
+        self.compile_patterns()
+        self.rule_ids = {}
+        self.rule_matchers = {}
+        self.build_anchor_index()
+        if self.shared_matcher:
+            self.build_matcher()
+
+    def compile_patterns(self):
+        """
+        Compile the patterns of the rules (see compile_pattern()) and record
+        the keys of the vocabulary flags they use, which are released when
+        the rules are reloaded.
+        """
+        self.vocab_flag_keys = set()
+        self.patterns = [compile_pattern(self.vocab, rule['pattern'], self.vocab_flag_keys) for rule in self.rules]
+
+    def is_modified(self):
+        """
+        Check whether the grammar file has changed since the rules were loaded.
+        
+        Return:
+            - modified: bool; True if the grammar file has changed.
+        """
+        return file_digest(self.path, 'grammar', GRAMMAR_FORMAT) != self.digest
+
+    def make_stage_components(self):
+        """
+        Create the components that match the rules of the earlier stages,
+        without adding them to the pipeline (see add_stage_components()).
+        
+        Return:
+            - components: list; the (name, component) pairs.
+        """
+        if not self.staged:
+            return []
+        components = []
+        for stage in STAGES[:-1]:
+            component = TokenSequenceStage(self, stage)
+            components.append((component.name, component))
+        return components
+
+    def add_stage_components(self, nlp):
+        """
+        Add the components that match the rules of the earlier stages to the
+        pipeline: surface rules right after the tokenizer and tagged rules
+        after the lemma corrector (or the tagger). This component must be
+        added to the end of the pipeline separately.
+        
+        Arguments:
+            - nlp: spaCy Language; the spaCy pipeline.
+        
+        Return:
+            - nlp: spaCy Language; the spaCy pipeline with the stage components.
+        """
+        if not self.staged:
+            return nlp
+        
+        surface = TokenSequenceStage(self, 'surface')
+        if surface.name not in nlp.pipe_names:
+            nlp.add_pipe(surface, first=True)
+        
+        tagged = TokenSequenceStage(self, 'tagged')
+        if tagged.name not in nlp.pipe_names:
+            if 'pronoun_lemma_corrector' in nlp.pipe_names:
+                nlp.add_pipe(tagged, after='pronoun_lemma_corrector')
+            elif 'tagger' in nlp.pipe_names:
+                nlp.add_pipe(tagged, after='tagger')
+            else:
+                nlp.add_pipe(tagged, last=True)
+        
+        return nlp
+
+    def merge_spans(self, doc, offsets):
+        """
+        Merge the longest matching spans into single tokens. Nested and
+        overlapping matches are resolved first so that all merges can be done
+        in a single retokenization pass.
+        
+        Arguments:
+            - doc: spaCy Doc; the current spaCy document object.
+            - offsets: list; the (start, end) offsets of the spans to merge.
+        """
+        debug = self.tracer.enabled(DEBUG)
+        with doc.retokenize() as retokenizer:
+            for (start, end) in get_longest_spans(offsets):
+                if end - start < 2:
+                    continue
+                if debug:
+                    self.tracer.debug('merge_span', '  -- Merging span: {}', doc[start:end], start=start, end=end)
+                retokenizer.merge(doc[start:end])
+        get_store(doc)
 
     def add_annotation(self, doc, matches, rule_name, rule_avm):
         """
@@ -169,55 +1187,50 @@ class TokenSequenceAnnotator(object):
         Arguments:
             - doc: spaCy Doc; the current spaCy document object.
             - matches: list; the matched token sequences
+            - rule_name: str; the name of the rule.
             - rule_avm: dict; the attribute-value pair dictionary specified in
                         the annotation rule
-            - merge: bool; merge matched spans
         """
-        # TODO this is really ugly, tidy it up
+        if len(matches) == 0:
+            return
+        
+        store = get_store(doc)
+        
+        if self.tracer.enabled(DEBUG):
+            for match in matches:
+                self.tracer.debug('match', '  -- Match: {} {} {}', rule_name, match, doc[match[1]:match[2]],
+                                  rule=rule_name, start=match[1], end=match[2])
+        
+        # First check if rule annotates ALL tokens (this is to deal with multi-token operators (+, *)
+        new_annotations = rule_avm.get('ALL', None)
+        if new_annotations is not None:
+            for new_attr in new_annotations:
+                column = store.column(new_attr)
+                code = store.encode(new_annotations[new_attr])
+                for match in matches:
+                    column[match[1]:match[2]] = code
+                if is_bitset(new_attr):
+                    for match in matches:
+                        store.set_bits(new_attr, slice(match[1], match[2]), new_annotations[new_attr])
+            return
+        
+        new_annotations = rule_avm.get('LAST', None)
+        if new_annotations is not None:
+            for new_attr in new_annotations:
+                indices = [match[2] - 1 for match in matches]
+                store.set_codes(new_attr, indices, store.encode(new_annotations[new_attr]))
+        
+        # Now annotate token-by-token according to rule (for rules with LAST and integers)
+        int_keys = sorted([key for key in rule_avm.keys() if isinstance(key, int)])
         for match in matches:
             start = match[1]
             end = match[2]
-            span = doc[start:end] # why was this end + 1?
-            if self.verbose:
-                print('  -- Match:', rule_name, match, doc[start:end], file=sys.stderr)
-            # First check if rule annotates ALL tokens (this is to deal with multi-token operators (+, *)
-            new_annotations = rule_avm.get('ALL', None)
-            if new_annotations is not None:
+            for j in int_keys:
+                if j >= end - start:
+                    break
+                new_annotations = rule_avm[j]
                 for new_attr in new_annotations:
-                    for j in range(len(span)):
-                        token = span[j]
-                        val = new_annotations[new_attr]
-                        if new_attr in DEFAULT_ATTRIBUTES:
-                            print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule_name, file=sys.stderr)
-                        else:
-                            token._.set(new_attr, val)
-            else:
-                new_annotations = rule_avm.get('LAST', None)
-
-                if new_annotations is not None:
-                    for new_attr in new_annotations:
-                        token = span[len(span) - 1]
-                        val = new_annotations[new_attr]
-                        if new_attr in DEFAULT_ATTRIBUTES:
-                            print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule_name,  file=sys.stderr)
-                        else:
-                            token._.set(new_attr, val)
-
-                # Now annotate token-by-token according to rule (for rules with LAST and integers)
-                int_keys = [key for key in rule_avm.keys() if isinstance(key, int)]
-                for key in int_keys:
-                    new_annotations = rule_avm.get(key, None)
-                    for j in range(len(span)):
-                        if j in rule_avm.keys():
-                            new_annotations = rule_avm.get(j, None)
-                            if new_annotations is not None:
-                                for new_attr in new_annotations:
-                                    token = span[j]
-                                    val = new_annotations[new_attr]
-                                    if new_attr in DEFAULT_ATTRIBUTES:
-                                        print('  -- Warning: cannot modify built-in attribute', new_attr, ' in rule', rule_name,  file=sys.stderr)
-                                    else:
-                                        token._.set(new_attr, val)
+                    store.set(new_attr, start + j, start + j + 1, new_annotations[new_attr])
 
     def print_spans(self, doc):
         """
@@ -229,11 +1242,7 @@ class TokenSequenceAnnotator(object):
         s = '\n'
         s += '{:<10}{:<10}{:<10}{:<10}{:<10}'.format('INDEX', 'WORD', 'LEMMA', 'POS1', 'POS2')
 
-        cext = set()        
-        for a in doc.user_data:
-            cext.add(a[1])
-
-        cext = sorted(cext)
+        cext = get_token_attributes(doc)
 
         for a in cext:
             s += '{:<10}'.format(a)
@@ -255,6 +1264,49 @@ class TokenSequenceAnnotator(object):
             print(s, file=sys.stderr)
 
 
+class TokenSequenceStage(object):
+    """
+    Token Sequence Stage
+    
+    Pipeline component that matches the rules of a TokenSequenceAnnotator that
+    only depend on attributes available at an earlier stage of the pipeline.
+    The matches are kept in the document and the annotations are added by the
+    TokenSequenceAnnotator itself, so that they are still applied in rule order.
+    These rules do not read custom attributes, so their matches do not depend
+    on the annotations of the other rules. If the document is retokenized
+    between the stages, the pending matches are discarded and all rules are
+    matched again by the TokenSequenceAnnotator.
+    """
+    
+    def __init__(self, annotator, stage):
+        """
+        Create a new TokenSequenceStage instance.
+        
+        Arguments:
+            - annotator: TokenSequenceAnnotator; the annotator the rules belong to.
+            - stage: str; the name of the stage (see STAGES).
+        """
+        self.annotator = annotator
+        self.stage = stage
+        self.name = annotator.name + '_' + stage
+    
+    def __call__(self, doc):
+        annotator = self.annotator
+        rules = annotator.stage_rules[self.stage]
+        pending = doc.user_data.get(annotator.pending_key, None)
+        if pending is None or pending[0] != len(doc):
+            # (length, matches by rule, rules matched)
+            pending = (len(doc), {}, set())
+            doc.user_data[annotator.pending_key] = pending
+        # rules skipped by the prefilter cannot match either
+        pending[2].update(rules)
+        if annotator.prefilter:
+            rules = annotator.get_active_rules(doc, rules)
+        if len(rules) > 0:
+            pending[1].update(annotator.match_rules(doc, rules))
+        return doc
+
+
 if __name__ == '__main__':
     nlp = spacy.load('en_core_web_sm')
 
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+    Trace Sink
+
+    Structured, low-overhead tracing for the annotation pipeline. Components
+    emit trace records (a level, an event name, an optional message and
+    fields) to a shared Tracer instead of printing to stderr. Records below the
+    tracer level are dropped before anything is formatted, message arguments
+    and callable field values are only evaluated for records that are actually
+    written, and debug/info records can be sampled per document.
+
+    By default records of level WARNING and above are printed to stderr. For
+    production runs, records can be written as JSON lines to a buffered file:
+
+        get_tracer().configure(path='trace.jsonl', level=INFO, sample_rate=0.01)
+"""
+
+import atexit
+import json
+import random
+import sys
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = {name: level for (level, name) in LEVEL_NAMES.items()}
+
+
+def get_level(level):
+    """
+    Get the numeric value of a trace level.
+
+    Arguments:
+        - level: int or str; the level value or name (e.g. 'DEBUG').
+
+    Return:
+        - level: int; the numeric level.
+    """
+    if isinstance(level, str):
+        if level.upper() not in LEVELS:
+            raise ValueError('-- Error: unknown trace level: ' + level)
+        return LEVELS[level.upper()]
+    return level
+
+
+class StreamSink(object):
+    """
+    Stream Sink
+
+    Writes trace records as human-readable lines to a stream (stderr by
+    default), in the same format as the annotators' former verbose output.
+    """
+
+    def __init__(self, stream=None):
+        """
+        Create a new StreamSink instance.
+
+        Arguments:
+            - stream: file; the output stream (default: sys.stderr).
+        """
+        self.stream = stream
+
+    def write(self, record):
+        """
+        Write a trace record.
+
+        Arguments:
+            - record: dict; the trace record.
+        """
+        message = record.get('message', None)
+        if message is None:
+            fields = [k + '=' + str(v) for (k, v) in record.items() if k not in ['time', 'level', 'event', 'doc']]
+            message = '-- ' + record['level'].capitalize() + ': ' + record['event'] + ' ' + ' '.join(fields)
+        print(message, file=self.stream or sys.stderr)
+
+    def flush(self):
+        (self.stream or sys.stderr).flush()
+
+    def close(self):
+        self.flush()
+
+
+class FileSink(object):
+    """
+    File Sink
+
+    Writes trace records as JSON lines to a file. Records are buffered in
+    memory and written in blocks, so tracing does not add a write call per
+    record. The buffer is flushed when the sink is closed and at exit.
+    """
+
+    def __init__(self, path, buffer_size=1000):
+        """
+        Create a new FileSink instance.
+
+        Arguments:
+            - path: str; the path to the output file (appended to).
+            - buffer_size: int; the number of records to buffer before writing.
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.fout = open(path, 'a', encoding='utf-8')
+        atexit.register(self.close)
+
+    def write(self, record):
+        """
+        Write a trace record.
+
+        Arguments:
+            - record: dict; the trace record.
+        """
+        self.buffer.append(json.dumps(record, default=str))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.fout is None or len(self.buffer) == 0:
+            return
+        self.fout.write('\n'.join(self.buffer) + '\n')
+        self.fout.flush()
+        self.buffer = []
+
+    def close(self):
+        if self.fout is None:
+            return
+        self.flush()
+        self.fout.close()
+        self.fout = None
+
+
+class Tracer(object):
+    """
+    Tracer
+
+    Filters trace records by level and by document sample, and passes the
+    remaining records to a sink.
+    """
+
+    def __init__(self, sink=None, level=WARNING, sample_rate=1.0, seed=None):
+        """
+        Create a new Tracer instance.
+
+        Arguments:
+            - sink: StreamSink or FileSink; the record sink (default: stderr).
+            - level: int or str; the minimum level of the records to write.
+            - sample_rate: float; the proportion of documents for which debug
+                           and info records are written. Warnings and errors
+                           are always written.
+            - seed: int; the random seed for document sampling.
+        """
+        self.sink = sink or StreamSink()
+        self.level = get_level(level)
+        self.sample_rate = sample_rate
+        self.random = random.Random(seed)
+        self.doc_id = None
+        self.sampled = True
+
+    def configure(self, path=None, level=None, sample_rate=None, buffer_size=1000, sink=None):
+        """
+        Change the tracer settings in place, so that components that already
+        hold a reference to the tracer use the new settings.
+
+        Arguments:
+            - path: str; write records as JSON lines to this file.
+            - level: int or str; the minimum level of the records to write.
+            - sample_rate: float; the proportion of documents to trace.
+            - buffer_size: int; the number of records buffered by a file sink.
+            - sink: StreamSink or FileSink; a sink to use instead of path.
+        """
+        if path is not None:
+            sink = FileSink(path, buffer_size=buffer_size)
+        if sink is not None:
+            self.sink.close()
+            self.sink = sink
+        if level is not None:
+            self.level = get_level(level)
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def set_level(self, level):
+        """
+        Lower the tracer level, e.g. to DEBUG for verbose components. The level
+        is never raised, so a verbose component does not silence others.
+
+        Arguments:
+            - level: int or str; the minimum level of the records to write.
+        """
+        self.level = min(self.level, get_level(level))
+
+    def begin_document(self, doc_id=None):
+        """
+        Start tracing a new document and decide whether it is sampled. If this
+        is never called, all documents are traced.
+
+        Arguments:
+            - doc_id: str; the document identifier added to all records.
+        """
+        self.doc_id = doc_id
+        self.sampled = self.sample_rate >= 1.0 or self.random.random() < self.sample_rate
+
+    def enabled(self, level):
+        """
+        Check whether records of a level are written for the current document.
+        Use this to guard expensive tracing code.
+
+        Arguments:
+            - level: int; the record level.
+
+        Return:
+            - enabled: bool; True if records of this level are written.
+        """
+        if level < self.level:
+            return False
+        return self.sampled or level >= WARNING
+
+    def trace(self, level, event, message=None, *args, **fields):
+        """
+        Write a trace record. The message is only formatted with its arguments
+        (str.format) and callable field values are only called when the record
+        is written.
+
+        Arguments:
+            - level: int; the record level.
+            - event: str; the event name (e.g. rule_matches).
+            - message: str; the human-readable message template.
+            - args: object; the message arguments.
+            - fields: object; additional record fields.
+        """
+        if not self.enabled(level):
+            return
+        record = {'time': time.time(), 'level': LEVEL_NAMES.get(level, str(level)), 'event': event}
+        if self.doc_id is not None:
+            record['doc'] = self.doc_id
+        if message is not None:
+            record['message'] = message.format(*args) if len(args) > 0 else message
+        for key in fields:
+            value = fields[key]
+            record[key] = value() if callable(value) else value
+        self.sink.write(record)
+
+    def debug(self, event, message=None, *args, **fields):
+        self.trace(DEBUG, event, message, *args, **fields)
+
+    def info(self, event, message=None, *args, **fields):
+        self.trace(INFO, event, message, *args, **fields)
+
+    def warning(self, event, message=None, *args, **fields):
+        self.trace(WARNING, event, message, *args, **fields)
+
+    def error(self, event, message=None, *args, **fields):
+        self.trace(ERROR, event, message, *args, **fields)
+
+    def flush(self):
+        self.sink.flush()
+
+
+# Shared tracer for all pipeline components
+TRACER = Tracer()
+
+
+def get_tracer():
+    """
+    Get the tracer shared by all pipeline components.
+
+    Return:
+        - tracer: Tracer; the shared tracer.
+    """
+    return TRACER
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    Vocabulary Flags
+
+    Registry of the boolean lexeme flags that the annotators add to a spaCy
+    vocabulary (REGEX predicates of the token sequence rules, single-token
+    lexicon terms). A flag is computed once per lexeme, and a vocabulary only
+    has a few free flags, so a flag is registered once per vocabulary and key
+    and reused afterwards.
+
+    Vocabularies cannot be weakly referenced, so the registry is indexed by
+    id(vocab). A dead vocabulary's id can be reused by a new one, so an entry
+    is only reused if its getter is still the one registered in the
+    vocabulary at that flag ID.
+
+    spaCy cannot remove a flag, so the flags of the components replaced by a
+    reload are released (see release_vocab_flags()) and their slots are
+    overwritten by the next flags registered in the vocabulary.
+"""
+
+# Flags registered per vocabulary: {id(vocab): {key: (flag_id, getter)}}
+VOCAB_FLAGS = {}
+# Released flags per vocabulary: {id(vocab): [(flag_id, getter)]}
+FREE_FLAGS = {}
+
+
+def is_registered(vocab, entry):
+    """
+    Check whether a registry entry is the flag registered in a vocabulary.
+
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary.
+        - entry: tuple; the (flag_id, getter) entry.
+
+    Return:
+        - registered: bool; True if the vocabulary holds the getter of the
+                      entry at its flag ID.
+    """
+    return vocab.lex_attr_getters.get(entry[0], None) is entry[1]
+
+
+def get_vocab_flag(vocab, key, getter):
+    """
+    Get the flag of a key in a vocabulary, registering it if needed.
+
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary.
+        - key: tuple; the key of the flag, e.g. ('REGEX', 'LOWER', regex).
+        - getter: callable; the flag getter, f(str) -> bool, used if the
+                  flag is registered.
+
+    Return:
+        - flag_id: int; the flag ID, or None if the vocabulary has no free
+                   flag.
+    """
+    flags = VOCAB_FLAGS.setdefault(id(vocab), {})
+    entry = flags.get(key, None)
+    if entry is not None and is_registered(vocab, entry):
+        return entry[0]
+    free = FREE_FLAGS.get(id(vocab), [])
+    while len(free) > 0:
+        entry = free.pop()
+        if is_registered(vocab, entry):
+            flag_id = vocab.add_flag(getter, flag_id=entry[0])
+            flags[key] = (flag_id, getter)
+            return flag_id
+    try:
+        flag_id = vocab.add_flag(getter)
+    except ValueError:
+        return None
+    flags[key] = (flag_id, getter)
+    return flag_id
+
+
+def release_vocab_flags(vocab, keys):
+    """
+    Release the flags of keys that are no longer used, so that their slots
+    can be reused (see get_vocab_flag()). The flags must not be read after
+    they are released.
+
+    Arguments:
+        - vocab: spaCy Vocab; the vocabulary.
+        - keys: iterable; the keys of the flags.
+    """
+    flags = VOCAB_FLAGS.get(id(vocab), {})
+    for key in keys:
+        entry = flags.pop(key, None)
+        if entry is not None and is_registered(vocab, entry):
+            FREE_FLAGS.setdefault(id(vocab), []).append(entry)